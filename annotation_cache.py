@@ -0,0 +1,373 @@
+"""
+Columnar annotation cache for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Keeps every box of an Annotations directory in memory-mapped NumPy arrays next to the directory,
+so label counts and box statistics run as vectorized queries instead of re-parsing the xml files.
+Cached files are re-parsed only when their mtime changes.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import json
+import numpy as np
+import tqdm
+from annotation_index import parse_annotation, BLANK_CLASS_ID
+
+CACHE_VERSION = 1
+
+# one .npy file per column so every column can be memory-mapped on its own
+IMAGE_COLUMNS = ('xml', 'mtime', 'filename', 'path', 'size')
+BOX_COLUMNS = ('image', 'class_id', 'bbox', 'flags')
+
+
+def get_cache_dir(xml_directory):
+    """
+    :param xml_directory: Annotations directory
+    :return: cache directory that sits next to it (output/Annotations -> output/Annotations.cache)
+    """
+    return f'{os.path.normpath(xml_directory)}.cache'
+
+
+def scan_xml_mtimes(xml_directory):
+    """
+    :param xml_directory: directory of xml files (walked recursively)
+    :return: dictionary of xml path relative to xml_directory -> mtime in nanoseconds
+    """
+    mtimes = {}
+    pending = [xml_directory]
+    while pending:
+        current = pending.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.name.lower().endswith('.xml'):
+                    rel_path = os.path.relpath(entry.path, xml_directory).replace(os.sep, '/')
+                    mtimes[rel_path] = entry.stat().st_mtime_ns
+    return mtimes
+
+
+def _empty_columns():
+    images = {'xml': np.array([], dtype='U1'),
+              'mtime': np.array([], dtype=np.int64),
+              'filename': np.array([], dtype='U1'),
+              'path': np.array([], dtype='U1'),
+              'size': np.zeros((0, 3), dtype=np.int32)}
+    boxes = {'image': np.array([], dtype=np.int32),
+             'class_id': np.array([], dtype=np.int32),
+             'bbox': np.zeros((0, 4), dtype=np.float32),
+             'flags': np.zeros((0, 2), dtype=np.int8)}
+    return images, boxes
+
+
+class AnnotationCache:
+    """
+    image table and box table of an Annotations directory
+    images: xml (relative path), mtime, filename, path, size (width, height, depth)
+    boxes: image (row in the image table), class_id, bbox (xmin, ymin, xmax, ymax), flags (difficult, truncated)
+    """
+
+    def __init__(self, xml_directory, images, boxes, class_names):
+        self.xml_directory = xml_directory
+        self.images = images
+        self.boxes = boxes
+        self.class_names = class_names
+        self.class_ids = {name: class_id for class_id, name in enumerate(class_names)}
+
+    @property
+    def image_count(self):
+        return len(self.images['xml'])
+
+    @property
+    def box_count(self):
+        return len(self.boxes['image'])
+
+    @classmethod
+    def open(cls, xml_directory, cache_dir=None):
+        """
+        loads the cache for an Annotations directory, re-parsing only new or modified xml files
+        :param xml_directory: Annotations directory
+        :param cache_dir: cache location, defaults to get_cache_dir(xml_directory)
+        :return: AnnotationCache that matches the current contents of xml_directory
+        """
+        cache_dir = cache_dir or get_cache_dir(xml_directory)
+        mtimes = scan_xml_mtimes(xml_directory)
+        cached = cls._load(xml_directory, cache_dir)
+
+        if cached is not None and cached.image_count == len(mtimes):
+            cached_mtimes = dict(zip(cached.images['xml'].tolist(), cached.images['mtime'].tolist()))
+            if cached_mtimes == mtimes:
+                return cached
+
+        cache = cls._refresh(xml_directory, cached, mtimes)
+        cached = None  # release the memory maps before their files are replaced
+        cache.save(cache_dir)
+        return cache
+
+    @classmethod
+    def _load(cls, xml_directory, cache_dir):
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path, 'r') as file:
+                meta = json.load(file)
+            if meta.get('version') != CACHE_VERSION:
+                return None
+
+            images = {column: np.load(os.path.join(cache_dir, f'images_{column}.npy'), mmap_mode='r')
+                      for column in IMAGE_COLUMNS}
+            boxes = {column: np.load(os.path.join(cache_dir, f'boxes_{column}.npy'), mmap_mode='r')
+                     for column in BOX_COLUMNS}
+        except (IOError, ValueError) as e:
+            print(f'Annotation cache {cache_dir} could not be read, rebuilding: {e}')
+            return None
+
+        if len(images['xml']) != meta['images'] or len(boxes['image']) != meta['boxes']:
+            return None
+
+        return cls(xml_directory, images, boxes, meta['classes'])
+
+    @classmethod
+    def _refresh(cls, xml_directory, cached, mtimes):
+        """
+        builds a new in-memory cache, keeping the rows of unchanged files and parsing the rest
+        """
+        if cached is None:
+            images, boxes = _empty_columns()
+            class_names = []
+        else:
+            images, boxes, class_names = cached.images, cached.boxes, list(cached.class_names)
+
+        row_by_xml = {xml: row for row, xml in enumerate(images['xml'].tolist())}
+        cached_mtimes = images['mtime'].tolist()
+        keep_rows = []
+        to_parse = []
+        for rel_path in sorted(mtimes):
+            row = row_by_xml.get(rel_path)
+            if row is not None and cached_mtimes[row] == mtimes[rel_path]:
+                keep_rows.append(row)
+            else:
+                to_parse.append(rel_path)
+
+        keep_rows = np.array(keep_rows, dtype=np.int64)
+
+        # kept boxes: vectorized remap of their image row onto the new image table
+        new_row = np.full(len(images['xml']), -1, dtype=np.int64)
+        new_row[keep_rows] = np.arange(len(keep_rows))
+        box_keep = new_row[boxes['image']] >= 0
+
+        class_ids = {name: class_id for class_id, name in enumerate(class_names)}
+        parsed = [parse_annotation(os.path.join(xml_directory, rel_path), class_ids)
+                  for rel_path in tqdm.tqdm(to_parse, disable=len(to_parse) < 1000)]
+        class_names = [name for name, _ in sorted(class_ids.items(), key=lambda item: item[1])]
+
+        first_new_row = len(keep_rows)
+        new_box_image = [first_new_row + i for i, record in enumerate(parsed) for _ in record.objects]
+        new_objects = [obj for record in parsed for obj in record.objects]
+
+        images = {
+            'xml': np.concatenate([np.asarray(images['xml'])[keep_rows], np.array(to_parse, dtype=str)]),
+            'mtime': np.concatenate([np.asarray(images['mtime'])[keep_rows],
+                                     np.array([mtimes[rel_path] for rel_path in to_parse], dtype=np.int64)]),
+            'filename': np.concatenate([np.asarray(images['filename'])[keep_rows],
+                                        np.array([record.filename for record in parsed], dtype=str)]),
+            'path': np.concatenate([np.asarray(images['path'])[keep_rows],
+                                    np.array([record.path for record in parsed], dtype=str)]),
+            'size': np.concatenate([np.asarray(images['size'])[keep_rows],
+                                    np.array([(record.width, record.height, record.depth) for record in parsed],
+                                             dtype=np.int32).reshape(-1, 3)]),
+        }
+        boxes = {
+            'image': np.concatenate([new_row[boxes['image'][box_keep]].astype(np.int32),
+                                     np.array(new_box_image, dtype=np.int32)]),
+            'class_id': np.concatenate([np.asarray(boxes['class_id'])[box_keep],
+                                        np.array([obj.class_id for obj in new_objects], dtype=np.int32)]),
+            'bbox': np.concatenate([np.asarray(boxes['bbox'])[box_keep],
+                                    np.array([(obj.xmin, obj.ymin, obj.xmax, obj.ymax) for obj in new_objects],
+                                             dtype=np.float32).reshape(-1, 4)]),
+            'flags': np.concatenate([np.asarray(boxes['flags'])[box_keep],
+                                     np.array([(obj.difficult, obj.truncated) for obj in new_objects],
+                                              dtype=np.int8).reshape(-1, 2)]),
+        }
+        return cls(xml_directory, images, boxes, class_names)
+
+    def save(self, cache_dir):
+        """
+        writes every column to cache_dir, meta.json is written last so a partial save is never loaded
+        :param cache_dir: cache directory
+        """
+        from voc_helpers import atomic_write  # voc_helpers imports this module
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            meta_path = os.path.join(cache_dir, 'meta.json')
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+            columns = [(f'images_{column}', self.images[column]) for column in IMAGE_COLUMNS] + \
+                      [(f'boxes_{column}', self.boxes[column]) for column in BOX_COLUMNS]
+            for name, array in columns:
+                with atomic_write(os.path.join(cache_dir, f'{name}.npy'), 'wb') as file:
+                    np.save(file, np.ascontiguousarray(array))
+
+            with atomic_write(meta_path) as file:
+                json.dump({'version': CACHE_VERSION,
+                           'images': self.image_count,
+                           'boxes': self.box_count,
+                           'classes': list(self.class_names)}, file)
+        except IOError as e:
+            raise IOError(f'error writing annotation cache {cache_dir}: {e}') from e
+
+    def get_class_ids(self, names):
+        """
+        :param names: iterable of class names
+        :return: int32 array of the class ids that exist in the cache
+        """
+        return np.array([self.class_ids[name] for name in names if name in self.class_ids], dtype=np.int32)
+
+    def label_counts(self, lbl_list):
+        """
+        :param lbl_list: a list of label names to count
+        :return: dictionary of labels and their counts
+        """
+        counts = np.bincount(self.boxes['class_id'][self.boxes['class_id'] >= 0], minlength=len(self.class_names))
+        return {label: int(counts[self.class_ids[label]]) if label in self.class_ids else 0 for label in lbl_list}
+
+    def blank_count(self):
+        """
+        :return: number of objects with a missing or empty name
+        """
+        return int(np.count_nonzero(self.boxes['class_id'] == BLANK_CLASS_ID))
+
+    def box_stats(self):
+        """
+        per-class box statistics
+        :return: dictionary of class name -> count, images, mean/min/max width, height and area, difficult, truncated
+        """
+        bbox = np.asarray(self.boxes['bbox'], dtype=np.float64)
+        widths = bbox[:, 2] - bbox[:, 0]
+        heights = bbox[:, 3] - bbox[:, 1]
+        areas = widths * heights
+        class_id = np.asarray(self.boxes['class_id'])
+
+        stats = {}
+        for name, cid in self.class_ids.items():
+            mask = class_id == cid
+            count = int(np.count_nonzero(mask))
+            if not count:
+                continue
+            stats[name] = {
+                'count': count,
+                'images': int(len(np.unique(self.boxes['image'][mask]))),
+                'mean_width': float(widths[mask].mean()),
+                'mean_height': float(heights[mask].mean()),
+                'min_area': float(areas[mask].min()),
+                'mean_area': float(areas[mask].mean()),
+                'max_area': float(areas[mask].max()),
+                'difficult': int(np.count_nonzero(self.boxes['flags'][mask, 0])),
+                'truncated': int(np.count_nonzero(self.boxes['flags'][mask, 1])),
+            }
+        return stats
+
+    def filter_boxes(self, class_names=None, min_area=None, max_area=None, difficult=None, truncated=None):
+        """
+        selects boxes matching all of the given conditions
+        :param class_names: only boxes of these classes
+        :param min_area: only boxes with at least this area in pixels
+        :param max_area: only boxes with at most this area in pixels
+        :param difficult: only boxes with this difficult flag (True/False)
+        :param truncated: only boxes with this truncated flag (True/False)
+        :return: boolean mask over the box table
+        """
+        mask = np.ones(self.box_count, dtype=bool)
+        if class_names is not None:
+            mask &= np.isin(self.boxes['class_id'], self.get_class_ids(class_names))
+        if min_area is not None or max_area is not None:
+            bbox = self.boxes['bbox']
+            areas = (bbox[:, 2] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 1])
+            if min_area is not None:
+                mask &= areas >= min_area
+            if max_area is not None:
+                mask &= areas <= max_area
+        if difficult is not None:
+            mask &= (self.boxes['flags'][:, 0] != 0) == difficult
+        if truncated is not None:
+            mask &= (self.boxes['flags'][:, 1] != 0) == truncated
+        return mask
+
+    def images_for_boxes(self, mask):
+        """
+        :param mask: boolean mask over the box table (see filter_boxes)
+        :return: xml paths (relative to the Annotations directory) of the images owning those boxes
+        """
+        return self.images['xml'][np.unique(self.boxes['image'][mask])]
+
+    def image_stems(self):
+        """
+        :return: array of image names without extension, one per row of the image table
+        """
+        if not len(self.images['xml']):
+            return np.array([], dtype=str)  # np.char.rpartition has no result shape for an empty array
+        stems = np.char.rpartition(self.images['xml'].astype(str), '/')[:, 2]
+        return np.char.rpartition(stems, '.')[:, 0]
+
+    def _image_class_pairs(self):
+        """
+        :return: tuple of (image row, class id) arrays, one pair per image and named class it contains
+        """
+        named = np.asarray(self.boxes['class_id']) >= 0
+        class_count = max(len(self.class_names), 1)
+        pairs = np.unique(np.asarray(self.boxes['image'])[named].astype(np.int64) * class_count +
+                          np.asarray(self.boxes['class_id'])[named])
+        return pairs // class_count, pairs % class_count
+
+    def images_per_class(self):
+        """
+        :return: int64 array with the number of images each class id appears in
+        """
+        _, pair_class = self._image_class_pairs()
+        return np.bincount(pair_class, minlength=len(self.class_names))
+
+    def rarest_class_per_image(self):
+        """
+        for every image, the class it contains that appears in the fewest images, ties go to the class
+        whose name sorts first (see voc_helpers.get_rarest_class)
+        :return: int32 array over the image table, -1 for images without named objects
+        """
+        pair_image, pair_class = self._image_class_pairs()
+        images_per_class = np.bincount(pair_class, minlength=len(self.class_names))
+        rank_of_class = np.empty(len(self.class_names), dtype=np.int64)
+        rank_of_class[np.argsort(np.array(self.class_names, dtype=object))] = np.arange(len(self.class_names))
+
+        # sort pairs by image, then by how rare their class is, and keep the first pair of each image
+        order = np.lexsort((rank_of_class[pair_class], images_per_class[pair_class], pair_image))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pair_image[order][1:] != pair_image[order][:-1]
+
+        rarest = np.full(self.image_count, -1, dtype=np.int32)
+        rarest[pair_image[order][first]] = pair_class[order][first]
+        return rarest
+
+    def class_membership(self, labels):
+        """
+        PASCAL VOC image/class membership flags for every image in one vectorized pass
+        :param labels: list of class names, one column each
+        :return: int8 array (images x labels): 1 object present, 0 only difficult objects, -1 not present
+        """
+        membership = np.full((self.image_count, len(labels)), -1, dtype=np.int8)
+        column_of_class = np.full(max(len(self.class_names), 1) + 1, -1, dtype=np.int64)
+        for column, label in enumerate(labels):
+            if label in self.class_ids:
+                column_of_class[self.class_ids[label]] = column
+
+        # blank names (-1) index the spare last slot, which never maps to a column
+        columns = column_of_class[np.asarray(self.boxes['class_id'])]
+        listed = columns >= 0
+        images = np.asarray(self.boxes['image'])[listed]
+        columns = columns[listed]
+        difficult = np.asarray(self.boxes['flags'])[listed, 0] != 0
+
+        membership[images[difficult], columns[difficult]] = 0
+        membership[images[~difficult], columns[~difficult]] = 1
+        return membership
@@ -0,0 +1,241 @@
+"""
+Annotation index for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Parses an Annotations directory once with a streaming expat parser and keeps a compact record per file,
+so counting, fixing and removing labels no longer re-parse every xml file each time
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import tqdm
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from xml.parsers import expat
+
+# class id given to objects whose name is missing or empty
+BLANK_CLASS_ID = -1
+
+AnnotationObject = namedtuple('AnnotationObject',
+                              ['class_id', 'xmin', 'ymin', 'xmax', 'ymax', 'difficult', 'truncated'])
+
+
+class AnnotationRecord:
+    """
+    compact summary of a single annotation xml file
+    """
+    __slots__ = ('xml_path', 'mtime', 'filename', 'path', 'width', 'height', 'depth', 'objects')
+
+    def __init__(self, xml_path, mtime, filename, path, width, height, depth, objects):
+        self.xml_path = xml_path
+        self.mtime = mtime
+        self.filename = filename
+        self.path = path
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.objects = objects
+
+
+def _to_number(text, default=0):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_annotation(xml_path, class_ids):
+    """
+    streams a single annotation xml file without building an element tree
+    :param xml_path: xml file to parse
+    :param class_ids: dictionary of class name -> class id, new names are added to it
+    :return: AnnotationRecord for the file
+    """
+    stack = []
+    text = []
+    fields = {}
+    objects = []
+    current = {}
+
+    def start_element(tag, _attributes):
+        stack.append(tag)
+        text.clear()
+        if tag == 'object' and len(stack) == 2:
+            current.clear()
+
+    def end_element(tag):
+        value = ''.join(text).strip()
+        text.clear()
+        depth = len(stack)
+        parent = stack[-2] if depth > 1 else None
+
+        if depth == 2 and tag in ('filename', 'path'):
+            fields[tag] = value
+        elif parent == 'size' and depth == 3:
+            fields[tag] = value
+        elif parent == 'object' and depth == 3:
+            current[tag] = value
+        elif parent == 'bndbox' and depth == 4 and stack[1] == 'object':
+            current[tag] = value
+        elif tag == 'object' and depth == 2:
+            name = current.get('name')
+            class_id = class_ids.setdefault(name, len(class_ids)) if name else BLANK_CLASS_ID
+            objects.append(AnnotationObject(class_id,
+                                            _to_number(current.get('xmin')),
+                                            _to_number(current.get('ymin')),
+                                            _to_number(current.get('xmax')),
+                                            _to_number(current.get('ymax')),
+                                            int(_to_number(current.get('difficult'))),
+                                            int(_to_number(current.get('truncated')))))
+        stack.pop()
+
+    def character_data(data):
+        text.append(data)
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.buffer_text = True
+
+    try:
+        with open(xml_path, 'rb') as file:
+            parser.ParseFile(file)
+        mtime = os.stat(xml_path).st_mtime_ns
+    except expat.ExpatError as e:
+        raise ElementTree.ParseError(f'error parsing {os.path.basename(xml_path)}: {e}')
+    except IOError as e:
+        raise IOError(f'error reading {xml_path}: {e}')
+
+    return AnnotationRecord(xml_path, mtime,
+                            fields.get('filename', ''),
+                            fields.get('path', ''),
+                            int(_to_number(fields.get('width'))),
+                            int(_to_number(fields.get('height'))),
+                            int(_to_number(fields.get('depth'))),
+                            objects)
+
+
+def _is_blank_name(name_element):
+    return name_element is None or not (name_element.text or '').strip()
+
+
+class AnnotationIndex:
+    """
+    parses an Annotations directory once and lets label operations run against the parsed records
+    xml files are only rewritten when an operation actually changes them
+    """
+
+    def __init__(self, xml_directory, records, class_ids):
+        self.xml_directory = xml_directory
+        self.records = records
+        self.class_ids = class_ids
+        self.class_names = {class_id: name for name, class_id in class_ids.items()}
+
+    @classmethod
+    def build(cls, xml_directory):
+        """
+        :param xml_directory: directory of xml files to index (walked recursively)
+        :return: AnnotationIndex for the directory
+        """
+        xml_paths = [os.path.join(dir_path, xml_file)
+                     for dir_path, _, files in os.walk(xml_directory)
+                     for xml_file in files if xml_file.lower().endswith('.xml')]
+
+        class_ids = {}
+        records = [parse_annotation(xml_path, class_ids) for xml_path in tqdm.tqdm(xml_paths)]
+        return cls(xml_directory, records, class_ids)
+
+    def get_class_id(self, name):
+        """
+        :param name: class name
+        :return: class id, registering the name if it has not been seen before
+        """
+        class_id = self.class_ids.get(name)
+        if class_id is None:
+            class_id = len(self.class_ids)
+            self.class_ids[name] = class_id
+            self.class_names[class_id] = name
+        return class_id
+
+    def count_labels(self, lbl_list):
+        """
+        :param lbl_list: a list of label names to count
+        :return: dictionary of labels and their counts
+        """
+        counts_by_id = {}
+        for record in self.records:
+            for obj in record.objects:
+                counts_by_id[obj.class_id] = counts_by_id.get(obj.class_id, 0) + 1
+
+        return {label: counts_by_id.get(self.class_ids.get(label), 0) for label in lbl_list}
+
+    def _rewrite(self, record, edit_objects):
+        """
+        applies an edit to the full element tree of a single file and writes it back
+        :param record: record of the file to rewrite
+        :param edit_objects: function taking the tree root, returns True if it changed anything
+        """
+        from voc_helpers import write_xml_atomic  # voc_helpers imports this module
+
+        try:
+            tree = ElementTree.parse(record.xml_path)
+            if edit_objects(tree.getroot()):
+                write_xml_atomic(tree, record.xml_path)
+                record.mtime = os.stat(record.xml_path).st_mtime_ns
+        except ElementTree.ParseError as e:
+            raise ElementTree.ParseError(f'error parsing {os.path.basename(record.xml_path)}: {e}')
+        except IOError as e:
+            raise IOError(f'error writing changes to {os.path.basename(record.xml_path)}: {e}')
+
+    def remove_objects(self, object_names_set):
+        """
+        removes objects with the given names from every file that contains them
+        :param object_names_set: a set of object names to be removed
+        :return: number of files rewritten
+        """
+        remove_ids = {self.class_ids[name] for name in object_names_set if name in self.class_ids}
+        if not remove_ids:
+            return 0
+
+        def edit_objects(root):
+            objects_to_remove = [obj for obj in root.findall('object')
+                                 if not _is_blank_name(obj.find('name'))
+                                 and obj.find('name').text.strip() in object_names_set]
+            for obj in objects_to_remove:
+                root.remove(obj)
+            return bool(objects_to_remove)
+
+        changed = [record for record in self.records
+                   if any(obj.class_id in remove_ids for obj in record.objects)]
+        for record in tqdm.tqdm(changed):
+            self._rewrite(record, edit_objects)
+            record.objects = [obj for obj in record.objects if obj.class_id not in remove_ids]
+
+        return len(changed)
+
+    def fix_missing_names(self, label_text):
+        """
+        names every object with a missing or empty name according to label_text
+        :param label_text: label to replace object name with
+        :return: number of files rewritten
+        """
+        label_id = self.get_class_id(label_text)
+
+        def edit_objects(root):
+            updated = False
+            for obj in root.findall('object'):
+                class_name = obj.find('name')
+                if _is_blank_name(class_name):
+                    if class_name is None:
+                        class_name = ElementTree.SubElement(obj, 'name')
+                    class_name.text = label_text
+                    updated = True
+            return updated
+
+        changed = [record for record in self.records
+                   if any(obj.class_id == BLANK_CLASS_ID for obj in record.objects)]
+        for record in tqdm.tqdm(changed):
+            self._rewrite(record, edit_objects)
+            record.objects = [obj._replace(class_id=label_id) if obj.class_id == BLANK_CLASS_ID else obj
+                              for obj in record.objects]
+
+        return len(changed)
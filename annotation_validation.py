@@ -0,0 +1,200 @@
+"""
+Annotation validation for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Checks every box of an Annotations directory at once with NumPy operations on the AnnotationCache columns:
+blank names, degenerate (zero area), inverted and out-of-bounds boxes, plus image level problems
+(missing size, filename/path not matching the xml name, missing image file).
+Boxes can optionally be repaired: inverted corners are swapped, boxes are clipped to the image and boxes
+left without area are dropped. Only the xml files that change are rewritten.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import numpy as np
+import tqdm
+import xml.etree.ElementTree as ElementTree
+from annotation_index import BLANK_CLASS_ID
+from voc_helpers import atomic_write, write_xml_atomic
+
+BOX_ISSUES = ('blank_name', 'degenerate', 'inverted', 'out_of_bounds')
+IMAGE_ISSUES = ('missing_size', 'filename_mismatch', 'path_mismatch', 'missing_image')
+
+
+def _basename(paths):
+    # paths written on windows use backslashes
+    paths = np.char.replace(np.asarray(paths).astype(str), '\\', '/')
+    return np.char.rpartition(paths, '/')[:, 2]
+
+
+def _object_index(cache, rows):
+    """
+    :return: position of each box row within its xml file
+    """
+    # boxes of an image are stored together in file order, so their position in the file is
+    # their row minus the first row of the image
+    box_image = np.asarray(cache.boxes['image'])
+    images_with_boxes, first_rows = np.unique(box_image, return_index=True)
+    first_row_of_image = np.zeros(cache.image_count, dtype=np.int64)
+    first_row_of_image[images_with_boxes] = first_rows
+    return rows - first_row_of_image[box_image[rows]]
+
+
+def check_boxes(cache):
+    """
+    :param cache: AnnotationCache
+    :return: dictionary of issue (see BOX_ISSUES) -> boolean mask over the box table
+    """
+    bbox = np.asarray(cache.boxes['bbox'], dtype=np.float64)
+    size = np.asarray(cache.images['size'], dtype=np.float64)[np.asarray(cache.boxes['image'])]
+    xmin, ymin, xmax, ymax = bbox.T
+    width, height = size[:, 0], size[:, 1]
+
+    inverted = (xmax < xmin) | (ymax < ymin)
+    has_size = (width > 0) & (height > 0)
+    return {'blank_name': np.asarray(cache.boxes['class_id']) == BLANK_CLASS_ID,
+            'degenerate': ~inverted & ((xmax == xmin) | (ymax == ymin)),
+            'inverted': inverted,
+            'out_of_bounds': has_size & ((np.minimum(xmin, xmax) < 0) | (np.minimum(ymin, ymax) < 0) |
+                                         (np.maximum(xmin, xmax) > width) | (np.maximum(ymin, ymax) > height))}
+
+
+def check_images(cache, jpg_dir=None, image_store=None):
+    """
+    :param cache: AnnotationCache
+    :param jpg_dir: optional JPEGImages directory, images whose filename is not in it are missing
+    :param image_store: optional PackedImageStore, images in it are not missing
+    :return: dictionary of issue (see IMAGE_ISSUES) -> boolean mask over the image table
+    """
+    size = np.asarray(cache.images['size'])
+    filenames = _basename(cache.images['filename'])
+    paths = _basename(cache.images['path'])
+    filename_stems = np.char.rpartition(filenames, '.')[:, 0]
+    stems = cache.image_stems()
+
+    issues = {'missing_size': (size[:, 0] <= 0) | (size[:, 1] <= 0),
+              'filename_mismatch': filename_stems != stems,
+              'path_mismatch': (paths != '') & (paths != filenames),
+              'missing_image': np.zeros(cache.image_count, dtype=bool)}
+
+    if jpg_dir is not None:
+        with os.scandir(jpg_dir) as entries:
+            image_names = np.array([entry.name for entry in entries], dtype=str)
+        missing = ~np.isin(filenames, image_names)
+        if image_store is not None:
+            missing &= ~np.isin(filename_stems, np.array(image_store.stems(), dtype=str))
+        issues['missing_image'] = missing
+
+    return issues
+
+
+def validate_annotations(cache, jpg_dir=None, image_store=None):
+    """
+    :param cache: AnnotationCache
+    :param jpg_dir: optional JPEGImages directory, see check_images
+    :param image_store: optional PackedImageStore, see check_images
+    :return: tuple of (box issue masks, image issue masks)
+    """
+    return check_boxes(cache), check_images(cache, jpg_dir, image_store)
+
+
+def write_validation_report(report_path, cache, box_issues, image_issues):
+    """
+    writes a tab separated report, one line per problem: xml file, issue, box index in the file and box
+    (box columns are empty for image level issues)
+    :param report_path: report file
+    :param cache: AnnotationCache the issues were found in
+    :param box_issues: box issue masks from check_boxes
+    :param image_issues: image issue masks from check_images
+    :return: number of lines written
+    """
+    xml_paths = np.asarray(cache.images['xml'])
+    box_image = np.asarray(cache.boxes['image'])
+    bbox = np.asarray(cache.boxes['bbox'])
+
+    lines = 0
+    try:
+        with atomic_write(report_path) as file:
+            for issue, mask in image_issues.items():
+                rows = np.flatnonzero(mask)
+                file.write(''.join(f'{xml}\t{issue}\t\t\n' for xml in xml_paths[rows].tolist()))
+                lines += len(rows)
+            for issue, mask in box_issues.items():
+                rows = np.flatnonzero(mask)
+                object_index = _object_index(cache, rows)
+                file.write(''.join(f'{xml}\t{issue}\t{index}\t{",".join(f"{v:g}" for v in box)}\n'
+                                   for xml, index, box in zip(xml_paths[box_image[rows]].tolist(),
+                                                              object_index.tolist(), bbox[rows].tolist())))
+                lines += len(rows)
+    except IOError as e:
+        raise IOError(f'error writing validation report {report_path}: {e}') from e
+
+    return lines
+
+
+def repair_boxes(cache, box_issues):
+    """
+    computes repaired boxes for every inverted, degenerate or out-of-bounds box in one vectorized pass
+    :param cache: AnnotationCache
+    :param box_issues: box issue masks from check_boxes
+    :return: tuple of (rows of changed boxes, their new bbox array, boolean mask of those rows to drop)
+    """
+    rows = np.flatnonzero(box_issues['inverted'] | box_issues['degenerate'] | box_issues['out_of_bounds'])
+    bbox = np.asarray(cache.boxes['bbox'], dtype=np.float64)[rows]
+    size = np.asarray(cache.images['size'], dtype=np.float64)[np.asarray(cache.boxes['image'])[rows]]
+
+    # swap inverted corners, then clip to the image where its size is known
+    repaired = np.column_stack([np.minimum(bbox[:, 0], bbox[:, 2]), np.minimum(bbox[:, 1], bbox[:, 3]),
+                                np.maximum(bbox[:, 0], bbox[:, 2]), np.maximum(bbox[:, 1], bbox[:, 3])])
+    has_size = (size[:, 0] > 0) & (size[:, 1] > 0)
+    repaired[has_size] = np.clip(repaired[has_size], 0, size[has_size][:, [0, 1, 0, 1]])
+
+    drop = (repaired[:, 2] <= repaired[:, 0]) | (repaired[:, 3] <= repaired[:, 1])
+    return rows, repaired, drop
+
+
+def repair_annotations(cache, box_issues):
+    """
+    rewrites the xml files with boxes that repair_boxes changes
+    :param cache: AnnotationCache
+    :param box_issues: box issue masks from check_boxes
+    :return: tuple of (number of boxes fixed, number of boxes dropped, number of files rewritten)
+    """
+    rows, repaired, drop = repair_boxes(cache, box_issues)
+    if not len(rows):
+        return 0, 0, 0
+
+    images = np.asarray(cache.boxes['image'])[rows]
+    object_index = _object_index(cache, rows)
+    order = np.argsort(images, kind='stable')
+    boundaries = np.flatnonzero(np.diff(images[order])) + 1
+    xml_paths = np.asarray(cache.images['xml'])
+
+    for group in tqdm.tqdm(np.split(order, boundaries)):
+        xml_path = os.path.join(cache.xml_directory, xml_paths[images[group[0]]])
+        try:
+            tree = ElementTree.parse(xml_path)
+        except ElementTree.ParseError as e:
+            raise ElementTree.ParseError(f'error parsing {xml_path}: {e}')
+
+        root = tree.getroot()
+        objects = root.findall('object')
+        for i in group.tolist():
+            obj = objects[object_index[i]]
+            if drop[i]:
+                root.remove(obj)
+                continue
+            for tag, value in zip(('xmin', 'ymin', 'xmax', 'ymax'), repaired[i].tolist()):
+                element = obj.find(f'bndbox/{tag}')
+                if element is not None:
+                    element.text = f'{value:g}'
+        write_xml_atomic(tree, xml_path)
+
+    dropped = int(np.count_nonzero(drop))
+    return len(rows) - dropped, dropped, len(boundaries) + 1
+
+
+def print_validation_summary(cache, box_issues, image_issues):
+    print(f'{cache.image_count} images, {cache.box_count} boxes checked')
+    for issue, mask in list(image_issues.items()) + list(box_issues.items()):
+        count = int(np.count_nonzero(mask))
+        if count:
+            print(f'{issue}: {count}')
@@ -0,0 +1,325 @@
+"""
+Benchmark for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+
+Synthesizes a Dark Label style data set (png + xml pairs, a few already converted jpg + xml pairs, blank object
+names, mixed case extensions) plus a folder of negatives, then times every voc_helpers entry point on it.
+Each stage runs in a fresh process so peak RSS is per stage. Results are printed (or saved) as JSON, only
+positional arguments that every version accepts are used so runs stay comparable across versions.
+
+Usage Instructions:
+-------------------
+    py benchmark.py --images 2000 --objects 3 --output bench.json
+
+License:
+-------
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import queue
+import tempfile
+import subprocess
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+LABELS = ['Angry_Nick', 'cat', 'dog', 'bird']
+# how often run_benchmark checks that a stage process is still alive while waiting for its result
+RESULT_POLL_SECONDS = 1
+
+XML_TEMPLATE = '''<annotation>
+\t<folder>JPEGImages</folder>
+\t<filename>{filename}</filename>
+\t<path>{filename}</path>
+\t<source>
+\t\t<database>Unknown</database>
+\t</source>
+\t<size>
+\t\t<width>{width}</width>
+\t\t<height>{height}</height>
+\t\t<depth>3</depth>
+\t</size>
+\t<segmented>0</segmented>
+{objects}</annotation>'''
+
+OBJECT_TEMPLATE = '''\t<object>
+\t\t<name>{name}</name>
+\t\t<pose>Unspecified</pose>
+\t\t<truncated>0</truncated>
+\t\t<difficult>0</difficult>
+\t\t<bndbox>
+\t\t\t<xmin>{xmin}</xmin>
+\t\t\t<ymin>{ymin}</ymin>
+\t\t\t<xmax>{xmax}</xmax>
+\t\t\t<ymax>{ymax}</ymax>
+\t\t</bndbox>
+\t</object>
+'''
+
+
+def make_workspace(root, images, objects, blank_fraction, jpg_fraction, negatives, width, height, seed):
+    """
+    writes a synthetic data set in the folder layout prepare_dataset.py expects
+    :param root: workspace directory, created if missing
+    :param images: number of labelled images in input/
+    :param objects: objects per image
+    :param blank_fraction: fraction of objects exported with a blank name
+    :param jpg_fraction: fraction of images that are already jpg (an existing data set) instead of png
+    :param negatives: number of images in negativesInput/
+    :param width: image width
+    :param height: image height
+    :param seed: random seed, the same seed always gives the same data set
+    """
+    rng = random.Random(seed)
+    for folder in ['input', 'negativesInput', 'negativeDataSet', 'output/Annotations', 'output/JPEGImages',
+                   'output/ImageSets/Main']:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'negative.xml')
+    destination = os.path.join(root, 'negative.xml')
+    if not os.path.exists(destination) or not os.path.samefile(template, destination):
+        shutil.copy(template, destination)  # the repository itself already has the template
+    with open(os.path.join(root, 'output', 'labels.txt'), 'w') as file:
+        file.write('\n'.join(LABELS))
+
+    # a handful of noise tiles reused across frames, like consecutive video frames
+    tiles = [Image.effect_noise((width, height), rng.randint(10, 80)).convert('RGB') for _ in range(8)]
+
+    for i in range(images):
+        is_jpg = rng.random() < jpg_fraction
+        ext = rng.choice(['jpg', 'jpeg']) if is_jpg else rng.choice(['png', 'png', 'PNG'])
+        stem = f'frame_{i:07d}'
+        image_name = f'{stem}.{ext}'
+        tiles[i % len(tiles)].save(os.path.join(root, 'input', image_name), 'JPEG' if is_jpg else 'PNG')
+
+        object_xml = []
+        for _ in range(objects):
+            xmin, ymin = rng.randint(0, width // 2), rng.randint(0, height // 2)
+            name = '' if rng.random() < blank_fraction else rng.choice(LABELS)
+            object_xml.append(OBJECT_TEMPLATE.format(name=name, xmin=xmin, ymin=ymin,
+                                                     xmax=rng.randint(xmin + 1, width),
+                                                     ymax=rng.randint(ymin + 1, height)))
+
+        with open(os.path.join(root, 'input', f'{stem}.xml'), 'w') as file:
+            file.write(XML_TEMPLATE.format(filename=image_name, width=width, height=height,
+                                           objects=''.join(object_xml)))
+
+    for i in range(negatives):
+        tiles[i % len(tiles)].save(os.path.join(root, 'negativesInput', f'negative_{i:07d}.jpg'), 'JPEG')
+
+
+def _input_names(root):
+    return {os.path.splitext(file)[0] for file in os.listdir(os.path.join(root, 'input'))
+            if file.lower().endswith(('.jpg', '.jpeg'))}
+
+
+def _run_collect(helpers, root):
+    helpers.collect_current_data_set('input', 'output/JPEGImages', 'output/Annotations')
+
+
+def _run_prepare_voc(helpers, root):
+    helpers.prepare_voc('input', 'output/JPEGImages', 'output/Annotations', _input_names(root))
+
+
+def _run_generate_txt_files(helpers, root):
+    helpers.generate_txt_files('output/JPEGImages', 'output/ImageSets/Main', 20)
+
+
+def _run_count_xml_labels(helpers, root):
+    helpers.count_xml_labels('output/Annotations', LABELS)
+
+
+def _run_generate_negatives(helpers, root):
+    existing_names = {os.path.splitext(file)[0] for file in os.listdir('output/JPEGImages')}
+    helpers.generate_negative_data_set(existing_names, 'negativesInput', 'negativeDataSet', 'negative.xml')
+
+
+def _run_inject_negatives(helpers, root):
+    helpers.inject_negative_data_set('negativeDataSet', 'output/JPEGImages', 'output/Annotations',
+                                     'output/ImageSets/Main', 20)
+
+
+def _run_remove_objects(helpers, root):
+    helpers.remove_object_from_xml_files('output/Annotations', {'bird'})
+
+
+# stage name, runner, (directory, extensions) the stage reads - used for files/sec and MB/s
+STAGES = [
+    ('collect_current_data_set', _run_collect, ('input', ('.jpg', '.jpeg', '.xml'))),
+    ('prepare_voc', _run_prepare_voc, ('input', ('.png', '.xml'))),
+    ('generate_txt_files', _run_generate_txt_files, ('output/JPEGImages', ('.jpg',))),
+    ('count_xml_labels', _run_count_xml_labels, ('output/Annotations', ('.xml',))),
+    ('generate_negative_data_set', _run_generate_negatives, ('negativesInput', ('.jpg', '.jpeg'))),
+    ('inject_negative_data_set', _run_inject_negatives, ('negativeDataSet', ('.jpg', '.jpeg', '.xml'))),
+    ('remove_object_from_xml_files', _run_remove_objects, ('output/Annotations', ('.xml',))),
+]
+
+
+def _measure_inputs(root, directory, extensions):
+    files = 0
+    size = 0
+    for dir_path, _, file_names in os.walk(os.path.join(root, directory)):
+        for file_name in file_names:
+            if file_name.lower().endswith(extensions):
+                files += 1
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+    return files, size
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def _stage_process(stage_index, root, repo_dir, results):
+    """
+    runs a single stage in a fresh process with its output silenced
+    """
+    sys.path.insert(0, repo_dir)
+    os.chdir(root)
+    name, runner, _ = STAGES[stage_index]
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        try:
+            import voc_helpers
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            runner(voc_helpers, root)
+            error = None
+        except BaseException as e:  # sys.exit in the helpers included
+            error = f'{type(e).__name__}: {e}'
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+
+    results.put({'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_mb': _peak_rss_mb(), 'error': error})
+
+
+def _wait_for_result(process, results, poll_seconds=RESULT_POLL_SECONDS):
+    """
+    waits for the stage result without hanging on a child that died before putting one (killed, out of memory)
+    :return: result dictionary, an error result if the child exited without one
+    """
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        try:
+            return results.get(timeout=poll_seconds)  # put just before exiting, still in the pipe
+        except queue.Empty:
+            return {'seconds': None, 'cpu_seconds': None, 'peak_rss_mb': None,
+                    'error': f'stage process exited with code {process.exitcode} without a result'}
+
+
+def get_version(repo_dir):
+    """
+    :return: git description of the checked out version, or None outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=repo_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(root, stages=None):
+    """
+    times each stage on a workspace created by make_workspace
+    :param root: workspace directory
+    :param stages: names of the stages to run, all of them by default (they build on each other in order)
+    :return: list of per-stage result dictionaries
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for stage_index, (name, _, (directory, extensions)) in enumerate(STAGES):
+        if stages and name not in stages:
+            continue
+
+        files, size = _measure_inputs(root, directory, extensions)
+        stage_results = context.Queue()
+        process = context.Process(target=_stage_process, args=(stage_index, root, repo_dir, stage_results))
+        process.start()
+        result = _wait_for_result(process, stage_results)
+        process.join()
+
+        seconds = result['seconds']
+        result.update({'stage': name,
+                       'files': files,
+                       'bytes': size,
+                       'files_per_sec': files / seconds if seconds else None,
+                       'mb_per_sec': size / 1e6 / seconds if seconds else None})
+        results.append(result)
+        print(f'{name}: {seconds or 0:.2f}s, {result["files_per_sec"] or 0:.0f} files/s, '
+              f'{result["mb_per_sec"] or 0:.1f} MB/s' + (f' ({result["error"]})' if result['error'] else ''),
+              file=sys.stderr)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VOC data set tools benchmark")
+    parser.add_argument("--images", type=int, default=1000, help="Labelled images in input (default: 1000)")
+    parser.add_argument("--objects", type=int, default=3, help="Objects per image (default: 3)")
+    parser.add_argument("--blank-fraction", type=float, default=0.05,
+                        help="Fraction of objects with a blank name (default: 0.05)")
+    parser.add_argument("--jpg-fraction", type=float, default=0.1,
+                        help="Fraction of input images that are already jpg (default: 0.1)")
+    parser.add_argument("--negatives", type=int, default=200, help="Images in negativesInput (default: 200)")
+    parser.add_argument("--width", type=int, default=640, help="Image width (default: 640)")
+    parser.add_argument("--height", type=int, default=360, help="Image height (default: 360)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data set (default: 0)")
+    parser.add_argument("--stages", nargs='*', help="Only run these stages")
+    parser.add_argument("--workdir", help="Workspace directory (default: a temporary directory, removed after)")
+    parser.add_argument("--output", help="Write the JSON report here instead of printing it")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('workdir', 'output')}
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='voc_bench_')
+
+    try:
+        print(f'Generating synthetic data set in {root}...', file=sys.stderr)
+        start = time.perf_counter()
+        make_workspace(root, args.images, args.objects, args.blank_fraction, args.jpg_fraction, args.negatives,
+                       args.width, args.height, args.seed)
+        print(f'..done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+        report = {'version': get_version(os.path.dirname(os.path.abspath(__file__))),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'cpu_count': os.cpu_count(),
+                  'config': config,
+                  'stages': run_benchmark(root, args.stages)}
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Build journal for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Append-only json lines file of the units of work a build has allocated and completed, so a build that
+dies halfway (disk full, killed, power loss) can be resumed with --resume instead of started over.
+A name is journaled before anything is written under it, and a unit is journaled as complete only once
+its outputs have been renamed into place, so a resumed build reuses names and never skips a half done unit.
+The journal is removed when a build finishes.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import json
+import threading
+
+
+class BuildJournal:
+    """
+    records (stage, key) units: the output name allocated for them and whether they are complete
+    """
+
+    def __init__(self, journal_path, sync_every=256):
+        self.journal_path = journal_path
+        self.sync_every = sync_every
+        self._names = {}
+        self._complete = set()
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+
+    @classmethod
+    def open(cls, journal_path, resume=False, sync_every=256):
+        """
+        :param journal_path: journal file
+        :param resume: True to continue the journal of an unfinished build, False to start a new one
+        :param sync_every: number of records between fsyncs, records are always flushed to the OS
+        :return: BuildJournal
+        """
+        journal = cls(journal_path, sync_every)
+        if resume and os.path.exists(journal_path):
+            journal._replay()
+            print(f'Resuming build: {len(journal._complete)} completed units in {journal_path}')
+        elif os.path.exists(journal_path):
+            print(f'Starting a new build journal, the unfinished build in {journal_path} is discarded '
+                  f'(use --resume to continue it)')
+
+        try:
+            journal._file = open(journal_path, 'a' if resume else 'w', encoding='utf-8')
+        except IOError as e:
+            raise IOError(f'error opening build journal {journal_path}: {e}') from e
+        return journal
+
+    def _replay(self):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a crashed build
+                    unit = (record['stage'], record['key'])
+                    if 'name' in record:
+                        self._names[unit] = record['name']
+                    if record.get('complete'):
+                        self._complete.add(unit)
+        except IOError as e:
+            raise IOError(f'error reading build journal {self.journal_path}: {e}') from e
+
+    def _append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        """
+        makes every record written so far durable
+        """
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def get_name(self, stage, key):
+        """
+        :return: name allocated for the unit by this or an earlier run, or None
+        """
+        return self._names.get((stage, key))
+
+    def names(self):
+        """
+        :return: set of every name allocated in the journal
+        """
+        return set(self._names.values())
+
+    def is_complete(self, stage, key):
+        return (stage, key) in self._complete
+
+    def allocate(self, stage, key, name):
+        """
+        records the output name of a unit before any output is written under it
+        """
+        if self._names.get((stage, key)) == name:
+            return
+        self._names[(stage, key)] = name
+        self._append({'stage': stage, 'key': key, 'name': name})
+
+    def complete(self, stage, key, name=None):
+        """
+        records a unit whose outputs are all in place
+        :param name: output name of the unit, if it was not allocated up front
+        """
+        record = {'stage': stage, 'key': key, 'complete': True}
+        if name is not None:
+            self._names[(stage, key)] = name
+            record['name'] = name
+        self._complete.add((stage, key))
+        self._append(record)
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """
+        closes and removes the journal once the build it describes has finished
+        """
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
@@ -0,0 +1,274 @@
+"""
+Duplicate image index for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Keeps an exact content hash and a 64 bit perceptual hash (dHash or pHash) of every image added to the
+data set, so exact copies and near-identical frames can be dropped or flagged before they are copied.
+Near-duplicate lookups use multi-index hashing: the hash is cut into max_distance + 1 bands, and any hash
+within max_distance bits shares at least one band exactly, so only those buckets are compared.
+Dropped sources are kept with their size and mtime, so later runs skip them without hashing them again.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import io
+import hashlib
+import numpy as np
+from PIL import Image
+
+HASH_KINDS = ('dhash', 'phash')
+DEDUP_MODES = ('off', 'flag', 'drop')
+# every hash within the distance must share a band, so there can be at most one band per bit
+MAX_DEDUP_DISTANCE = 63
+
+
+def _bits_to_int(bits):
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def compute_dhash(img):
+    """
+    difference hash: compares neighbouring pixels of a 9x8 grayscale thumbnail
+    :param img: PIL image
+    :return: 64 bit hash as int
+    """
+    pixels = np.asarray(img.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return _bits_to_int((pixels[:, 1:] > pixels[:, :-1]).ravel())
+
+
+def _dct_matrix(size):
+    k = np.arange(size)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def compute_phash(img):
+    """
+    perceptual hash: low frequency DCT coefficients of a 32x32 grayscale image compared to their median
+    :param img: PIL image
+    :return: 64 bit hash as int
+    """
+    pixels = np.asarray(img.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    low_frequencies = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].ravel()
+    return _bits_to_int(low_frequencies > np.median(low_frequencies[1:]))
+
+
+def compute_image_hashes(image_path, hash_kind='dhash'):
+    """
+    reads an image once and hashes it both ways
+    runs in worker processes, so it only takes and returns plain values
+    :param image_path: image file
+    :param hash_kind: one of HASH_KINDS
+    :return: tuple of (sha1 hex digest of the file, perceptual hash as int)
+    """
+    with open(image_path, 'rb') as file:
+        data = file.read()
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft('L', (64, 64))  # jpeg only: decode at reduced size, the hash only needs a thumbnail
+        perceptual_hash = compute_phash(img) if hash_kind == 'phash' else compute_dhash(img)
+
+    return hashlib.sha1(data).hexdigest(), perceptual_hash
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+class DuplicateIndex:
+    """
+    persistent index of exact and perceptual image hashes
+    """
+
+    def __init__(self, max_distance=4, hash_kind='dhash'):
+        if hash_kind not in HASH_KINDS:
+            raise ValueError(f'unknown hash kind {hash_kind}, expected one of {HASH_KINDS}')
+        if not 0 <= max_distance <= MAX_DEDUP_DISTANCE:
+            raise ValueError(f'max distance must be between 0 and {MAX_DEDUP_DISTANCE}, not {max_distance}')
+
+        self.max_distance = max_distance
+        self.hash_kind = hash_kind
+        self.names = []
+        self.sources = []
+        self.digests = []
+        self.hashes = []
+        self.duplicates = {}  # source -> (name of the matching image, hamming distance)
+        self.dropped = {}  # source -> (size, mtime) of the file when it was dropped
+        self._by_digest = {}
+        self._by_source = {}
+
+        band_count = max_distance + 1
+        band_width = 64 // band_count
+        self._bands = [(band * band_width, 64 - band * band_width if band == band_count - 1 else band_width)
+                       for band in range(band_count)]
+        self._buckets = [{} for _ in self._bands]
+
+    def _band_keys(self, perceptual_hash):
+        return [(perceptual_hash >> shift) & ((1 << width) - 1) for shift, width in self._bands]
+
+    def add(self, name, source, digest, perceptual_hash):
+        """
+        :param name: name the image has in the data set
+        :param source: source path of the image, re-adding the same source is never a duplicate of itself
+        :param digest: exact content hash
+        :param perceptual_hash: 64 bit perceptual hash
+        """
+        entry = self._by_source.get(source)
+        if entry is not None and self.digests[entry] == digest:
+            # same file processed again, it only gets a new name
+            self.names[entry] = name
+            return
+
+        entry = len(self.names)
+        self.names.append(name)
+        self.sources.append(source)
+        self.digests.append(digest)
+        self.hashes.append(perceptual_hash)
+        self._by_digest.setdefault(digest, entry)
+        self._by_source[source] = entry
+        for bucket, key in zip(self._buckets, self._band_keys(perceptual_hash)):
+            bucket.setdefault(key, []).append(entry)
+
+    def remove(self, source):
+        """
+        takes back the image added for a source that never made it into the data set, images dropped as
+        duplicates of it are forgotten as well so they are checked again
+        :param source: source path the image was added with
+        """
+        entry = self._by_source.pop(source, None)
+        if entry is None:
+            return
+
+        name = self.names[entry]
+        self.names[entry] = None  # the entry number stays taken, it is left out when the index is saved
+        if self._by_digest.get(self.digests[entry]) == entry:
+            del self._by_digest[self.digests[entry]]
+        for bucket, key in zip(self._buckets, self._band_keys(self.hashes[entry])):
+            bucket[key].remove(entry)
+        for duplicate_source, (match, _) in list(self.duplicates.items()):
+            if match == name:
+                del self.duplicates[duplicate_source]
+                self.dropped.pop(duplicate_source, None)
+
+    def find_duplicate(self, source, digest, perceptual_hash):
+        """
+        :param source: source path of the image being checked
+        :param digest: exact content hash
+        :param perceptual_hash: 64 bit perceptual hash
+        :return: tuple of (name of the matching image, hamming distance) or None
+        """
+        entry = self._by_digest.get(digest)
+        if entry is not None and self.sources[entry] != source:
+            return self.names[entry], 0
+
+        best = None
+        for bucket, key in zip(self._buckets, self._band_keys(perceptual_hash)):
+            for entry in bucket.get(key, ()):
+                if self.sources[entry] == source:
+                    continue
+                distance = hamming_distance(self.hashes[entry], perceptual_hash)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (self.names[entry], distance)
+        return best
+
+    def check(self, source, digest, perceptual_hash):
+        """
+        looks an image up and records it as a duplicate if it matches one already in the index
+        :return: tuple of (name of the matching image, hamming distance) or None
+        """
+        self.dropped.pop(source, None)
+        duplicate = self.find_duplicate(source, digest, perceptual_hash)
+        if duplicate is not None:
+            self.duplicates[source] = duplicate
+        else:
+            self.duplicates.pop(source, None)
+        return duplicate
+
+    def drop(self, source, size, mtime):
+        """
+        records a duplicate that was left out of the data set
+        :param source: source path of the image
+        :param size: file size
+        :param mtime: file mtime in ns
+        """
+        self.dropped[source] = (size, mtime)
+
+    def is_dropped(self, source, size, mtime):
+        """
+        :return: True if the source was dropped as a duplicate and has not changed since
+        """
+        return self.dropped.get(source) == (size, mtime)
+
+    @classmethod
+    def load(cls, index_path, max_distance=4, hash_kind='dhash'):
+        """
+        :param index_path: .npz index file, a new empty index is returned if it does not exist
+        :param max_distance: maximum hamming distance for near duplicates
+        :param hash_kind: one of HASH_KINDS, an index saved with another kind is rebuilt from scratch
+        :return: DuplicateIndex
+        """
+        index = cls(max_distance, hash_kind)
+        if not os.path.exists(index_path):
+            return index
+
+        try:
+            with np.load(index_path) as data:
+                if str(data['hash_kind']) != hash_kind:
+                    print(f'Duplicate index {index_path} uses {data["hash_kind"]}, starting a new {hash_kind} index')
+                    return index
+                for name, source, digest, perceptual_hash in zip(data['names'].tolist(), data['sources'].tolist(),
+                                                                 data['digests'].tolist(), data['hashes'].tolist()):
+                    index.add(name, source, digest, perceptual_hash)
+                if 'duplicate_sources' in data.files:  # not in indexes saved before duplicates were kept
+                    for source, match, distance in zip(data['duplicate_sources'].tolist(),
+                                                       data['duplicate_matches'].tolist(),
+                                                       data['duplicate_distances'].tolist()):
+                        index.duplicates[source] = (match, distance)
+                    for source, size, mtime in zip(data['dropped_sources'].tolist(), data['dropped_sizes'].tolist(),
+                                                   data['dropped_mtimes'].tolist()):
+                        index.dropped[source] = (size, mtime)
+        except (IOError, ValueError, KeyError) as e:
+            raise IOError(f'error reading duplicate index {index_path}: {e}') from e
+
+        return index
+
+    def save(self, index_path):
+        """
+        :param index_path: .npz index file
+        """
+        from voc_helpers import atomic_write  # voc_helpers imports this module
+
+        entries = [entry for entry, name in enumerate(self.names) if name is not None]
+        try:
+            with atomic_write(index_path, 'wb') as file:
+                np.savez(file,
+                         hash_kind=np.array(self.hash_kind),
+                         names=np.array([self.names[entry] for entry in entries], dtype=str),
+                         sources=np.array([self.sources[entry] for entry in entries], dtype=str),
+                         digests=np.array([self.digests[entry] for entry in entries], dtype=str),
+                         hashes=np.array([self.hashes[entry] for entry in entries], dtype=np.uint64),
+                         duplicate_sources=np.array(list(self.duplicates), dtype=str),
+                         duplicate_matches=np.array([match for match, _ in self.duplicates.values()], dtype=str),
+                         duplicate_distances=np.array([distance for _, distance in self.duplicates.values()],
+                                                      dtype=np.int64),
+                         dropped_sources=np.array(list(self.dropped), dtype=str),
+                         dropped_sizes=np.array([size for size, _ in self.dropped.values()], dtype=np.int64),
+                         dropped_mtimes=np.array([mtime for _, mtime in self.dropped.values()], dtype=np.int64))
+        except IOError as e:
+            raise IOError(f'error writing duplicate index {index_path}: {e}') from e
+
+    def write_report(self, report_path):
+        """
+        writes every duplicate in the index to a tab separated report, replacing the previous one
+        :param report_path: report file
+        """
+        from voc_helpers import atomic_write  # voc_helpers imports this module
+
+        try:
+            with atomic_write(report_path) as file:
+                for source, (match, distance) in self.duplicates.items():
+                    file.write(f'{source}\t{match}\t{distance}\n')
+        except IOError as e:
+            raise IOError(f'error writing duplicate report {report_path}: {e}') from e
@@ -0,0 +1,246 @@
+"""
+COCO and YOLO export for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Converts output/Annotations into the formats other detectors train on, per ImageSets/Main split, using
+output/labels.txt as the class map:
+    coco: <output>/coco/instances_<split>.json, category ids are the line numbers in labels.txt (from 1)
+    yolo: <output>/labels/<name>.txt (class x_center y_center width height, normalised) next to JPEGImages,
+          the layout darknet looks labels up in, plus <output>/yolo/<split>.txt lists of image paths
+The xml files are parsed by a pool of worker processes and the json is streamed to disk as the
+results come in, so the size of an export is not limited by memory.
+Boxes with labels that are not in labels.txt are left out and counted.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import json
+import tqdm
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import ParseError
+from annotation_index import parse_annotation
+from shard_export import EXPORT_SPLITS, read_split_names
+from voc_helpers import atomic_write, get_tmp_path
+
+EXPORT_FORMATS = ('coco', 'yolo')
+
+
+def _clip(value, upper):
+    return min(max(value, 0.0), upper)
+
+
+def get_yolo_lines(width, height, boxes):
+    """
+    :param width: image width
+    :param height: image height
+    :param boxes: list of (class index, xmin, ymin, xmax, ymax)
+    :return: list of yolo label lines, boxes without area inside the image are left out
+    """
+    lines = []
+    if width <= 0 or height <= 0:
+        return lines
+    for class_index, xmin, ymin, xmax, ymax in boxes:
+        xmin, xmax = _clip(xmin, width), _clip(xmax, width)
+        ymin, ymax = _clip(ymin, height), _clip(ymax, height)
+        if xmax <= xmin or ymax <= ymin:
+            continue
+        lines.append(f'{class_index} {(xmin + xmax) / 2 / width:.6f} {(ymin + ymax) / 2 / height:.6f} '
+                     f'{(xmax - xmin) / width:.6f} {(ymax - ymin) / height:.6f}\n')
+    return lines
+
+
+def parse_export_chunk(task):
+    """
+    parses a chunk of annotations and writes their yolo label files, runs in a worker process
+    :param task: tuple of (image names, annotations directory, class map of label -> index,
+    yolo labels directory or None)
+    :return: list of (name, width, height, boxes, unknown labels, error message or None) per image,
+    boxes being (class index, xmin, ymin, xmax, ymax)
+    """
+    names, annotations_dir, class_map, yolo_dir = task
+    results = []
+    for name in names:
+        class_ids = dict(class_map)
+        try:
+            record = parse_annotation(os.path.join(annotations_dir, f'{name}.xml'), class_ids)
+        except (ParseError, IOError) as e:
+            results.append((name, 0, 0, [], 0, str(e)))
+            continue
+
+        # labels that are not in the class map were given ids past its end by parse_annotation
+        boxes = [(obj.class_id, obj.xmin, obj.ymin, obj.xmax, obj.ymax) for obj in record.objects
+                 if 0 <= obj.class_id < len(class_map)]
+        unknown = len(record.objects) - len(boxes)
+
+        if yolo_dir is not None:
+            label_path = os.path.join(yolo_dir, f'{name}.txt')
+            try:
+                with atomic_write(label_path) as file:
+                    file.writelines(get_yolo_lines(record.width, record.height, boxes))
+            except IOError as e:
+                results.append((name, 0, 0, [], 0, f'error writing {label_path}: {e}'))
+                continue
+
+        results.append((name, record.width, record.height, boxes, unknown, None))
+    return results
+
+
+def _parse_chunks(tasks, workers):
+    """
+    yields the results of parse_export_chunk in task order, with at most workers * 2 chunks in flight
+    so parsed chunks never pile up in memory ahead of the writer
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield parse_export_chunk(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+            pending.append(executor.submit(parse_export_chunk, task))
+        while pending:
+            yield pending.popleft().result()
+
+
+class CocoWriter:
+    """
+    streams a COCO instances file: images are written straight into the file while annotations go to a
+    spill file that is appended once every image has been written
+    """
+
+    def __init__(self, json_path, labels):
+        self.json_path = json_path
+        self.images = 0
+        self.annotations = 0
+        self._file = open(get_tmp_path(json_path), 'w')
+        try:
+            self._spill = open(f'{json_path}.annotations.tmp', 'w+')
+        except BaseException:
+            self._file.close()
+            os.remove(get_tmp_path(json_path))
+            raise
+        categories = [{'id': index + 1, 'name': label, 'supercategory': 'none'}
+                      for index, label in enumerate(labels)]
+        self._file.write(f'{{"info":{{"description":"PASCAL VOC Data Set Tools export"}},'
+                         f'"categories":{json.dumps(categories, separators=(",", ":"))},"images":[')
+
+    def add_image(self, name, width, height, boxes):
+        self.images += 1
+        self._file.write(('' if self.images == 1 else ',') +
+                         json.dumps({'id': self.images, 'file_name': f'{name}.jpg', 'width': width,
+                                     'height': height}, separators=(',', ':')))
+        for class_index, xmin, ymin, xmax, ymax in boxes:
+            self.annotations += 1
+            box_width, box_height = xmax - xmin, ymax - ymin
+            self._spill.write(('' if self.annotations == 1 else ',') +
+                              json.dumps({'id': self.annotations, 'image_id': self.images,
+                                          'category_id': class_index + 1,
+                                          'bbox': [xmin, ymin, box_width, box_height],
+                                          'area': box_width * box_height, 'iscrowd': 0},
+                                         separators=(',', ':')))
+
+    def close(self):
+        self._file.write('],"annotations":[')
+        self._spill.seek(0)
+        for chunk in iter(lambda: self._spill.read(1 << 20), ''):
+            self._file.write(chunk)
+        self._file.write(']}')
+        self._file.close()
+        self._spill.close()
+        os.remove(f'{self.json_path}.annotations.tmp')
+        os.replace(get_tmp_path(self.json_path), self.json_path)
+
+    def abort(self):
+        """
+        closes and removes the temp files of an unfinished export
+        """
+        for file, path in ((self._file, get_tmp_path(self.json_path)),
+                           (self._spill, f'{self.json_path}.annotations.tmp')):
+            file.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def export_annotations(annotations_dir, jpg_dir, txt_dir, output_dir, labels, formats=EXPORT_FORMATS,
+                       splits=EXPORT_SPLITS, workers=1, chunk_size=256):
+    """
+    exports every split listed in ImageSets/Main in the given formats, see the module docstring for the layout
+    :param annotations_dir: Annotations directory
+    :param jpg_dir: JPEGImages directory, listed in the yolo split files
+    :param txt_dir: ImageSets/Main directory
+    :param output_dir: VOC output directory the coco, yolo and labels directories are written to
+    :param labels: class names, in labels.txt order
+    :param formats: formats to export, some of EXPORT_FORMATS
+    :param splits: splits to export
+    :param workers: number of worker processes parsing xml files
+    :param chunk_size: number of xml files parsed per worker task
+    :return: list of error messages for images that could not be exported
+    """
+    unknown_formats = set(formats) - set(EXPORT_FORMATS)
+    if unknown_formats:
+        raise ValueError(f'unknown export formats {sorted(unknown_formats)}, expected some of {EXPORT_FORMATS}')
+    labels = [label for label in labels if label]
+    if not labels:
+        raise ValueError('no labels to export, labels.txt is empty')
+
+    print('Exporting annotations...')
+    class_map = {label: index for index, label in enumerate(labels)}
+    coco_dir = os.path.join(output_dir, 'coco')
+    yolo_dir = os.path.join(output_dir, 'labels') if 'yolo' in formats else None
+    yolo_lists_dir = os.path.join(output_dir, 'yolo')
+    for directory, wanted in ((coco_dir, 'coco' in formats), (yolo_dir, 'yolo' in formats),
+                              (yolo_lists_dir, 'yolo' in formats)):
+        if wanted:
+            os.makedirs(directory, exist_ok=True)
+
+    errors = []
+    for split in splits:
+        names = read_split_names(txt_dir, split)
+        tasks = [(names[i:i + chunk_size], annotations_dir, class_map, yolo_dir)
+                 for i in range(0, len(names), chunk_size)]
+
+        coco = None
+        yolo_list = None
+        unknown = 0
+        try:
+            with ExitStack() as stack:
+                if 'coco' in formats:
+                    coco = CocoWriter(os.path.join(coco_dir, f'instances_{split}.json'), labels)
+                    # runs on any exit but a finished export, interrupts and dead worker pools included
+                    coco_cleanup = stack.enter_context(ExitStack())
+                    coco_cleanup.callback(coco.abort)
+                if yolo_dir is not None:
+                    yolo_list = stack.enter_context(atomic_write(os.path.join(yolo_lists_dir, f'{split}.txt')))
+                progress = stack.enter_context(tqdm.tqdm(total=len(names)))
+
+                for results in _parse_chunks(tasks, workers):
+                    for name, width, height, boxes, unknown_boxes, error in results:
+                        progress.update()
+                        if error is not None:
+                            errors.append(f'{name}: {error}')
+                            continue
+                        unknown += unknown_boxes
+                        if coco is not None:
+                            coco.add_image(name, width, height, boxes)
+                        if yolo_list is not None:
+                            yolo_list.write(f'{os.path.abspath(os.path.join(jpg_dir, f"{name}.jpg"))}\n')
+
+                if coco is not None:
+                    coco.close()
+                    coco_cleanup.pop_all()
+        except IOError as e:
+            raise IOError(f'error exporting {split}: {e}') from e
+
+        if coco is not None:
+            print(f'{split}: {coco.images} images, {coco.annotations} boxes saved in {coco.json_path}')
+        if yolo_list is not None:
+            print(f'{split}: yolo labels saved in {yolo_dir}')
+        if unknown:
+            print(f'{split}: {unknown} boxes with labels not in labels.txt left out')
+
+    for error in errors:
+        print(error)
+    return errors
@@ -0,0 +1,184 @@
+"""
+Packed image store for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Keeps encoded JPEG bytes in one append-only blob file (JPEGImages.pack) with a NumPy offset/length index
+keyed by the VOC file name stem (JPEGImages.pack.idx.npz). Readers memory-map the blob and slice images
+out of it without copying, instead of opening one file per image.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import io
+import mmap
+import numpy as np
+import tqdm
+from PIL import Image
+from voc_helpers import atomic_write, LISTED_IMAGE_EXTENSION
+
+
+def get_index_path(blob_path):
+    return f'{blob_path}.idx.npz'
+
+
+class PackedImageStore:
+    """
+    append-only image blob with a stem -> (offset, length) index
+    the index is written on flush/close; bytes appended after the last flush (e.g. by a crashed run)
+    are not indexed and are cut off the next time the store is opened
+    """
+
+    def __init__(self, blob_path):
+        self.blob_path = blob_path
+        self.index_path = get_index_path(blob_path)
+        self._rows = {}
+        self._stems = []
+        self._offsets = []
+        self._lengths = []
+        self._writer = None
+        self._mmap = None
+        self._blob_file = None
+        self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with np.load(self.index_path) as data:
+                    self._stems = data['stems'].tolist()
+                    self._offsets = data['offsets'].tolist()
+                    self._lengths = data['lengths'].tolist()
+            except (IOError, ValueError, KeyError) as e:
+                raise IOError(f'error reading image store index {self.index_path}: {e}') from e
+            self._rows = {stem: row for row, stem in enumerate(self._stems)}
+
+        indexed_end = max((offset + length for offset, length in zip(self._offsets, self._lengths)), default=0)
+        if os.path.exists(self.blob_path) and os.path.getsize(self.blob_path) > indexed_end:
+            with open(self.blob_path, 'r+b') as file:
+                file.truncate(indexed_end)
+
+    def __len__(self):
+        return len(self._stems)
+
+    def __contains__(self, stem):
+        return stem in self._rows
+
+    def stems(self):
+        """
+        :return: list of stems in the order they were appended
+        """
+        return list(self._stems)
+
+    def append(self, stem, data):
+        """
+        appends encoded image bytes, a stem that is appended again points at the newest bytes
+        :param stem: VOC file name without extension
+        :param data: encoded image bytes
+        """
+        self._close_reader()
+        if self._writer is None:
+            self._writer = open(self.blob_path, 'ab')
+
+        offset = self._writer.tell()
+        self._writer.write(data)
+
+        row = self._rows.get(stem)
+        if row is None:
+            self._rows[stem] = len(self._stems)
+            self._stems.append(stem)
+            self._offsets.append(offset)
+            self._lengths.append(len(data))
+        else:
+            self._offsets[row] = offset
+            self._lengths[row] = len(data)
+
+    def append_file(self, stem, image_path):
+        """
+        :param stem: VOC file name without extension
+        :param image_path: encoded image file to append
+        """
+        try:
+            with open(image_path, 'rb') as file:
+                self.append(stem, file.read())
+        except IOError as e:
+            raise IOError(f'error appending {image_path} to {self.blob_path}: {e}') from e
+
+    def flush(self):
+        """
+        makes appended bytes durable, then writes the index that points at them
+        """
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+        try:
+            with atomic_write(self.index_path, 'wb') as file:
+                np.savez(file,
+                         stems=np.array(self._stems, dtype=str),
+                         offsets=np.array(self._offsets, dtype=np.int64),
+                         lengths=np.array(self._lengths, dtype=np.int64))
+        except IOError as e:
+            raise IOError(f'error writing image store index {self.index_path}: {e}') from e
+
+    def _close_reader(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # images handed out by get() still use it, it is released with them
+            self._blob_file.close()
+            self._mmap = None
+            self._blob_file = None
+
+    def get(self, stem):
+        """
+        :param stem: VOC file name without extension
+        :return: memoryview of the encoded image bytes, backed by the memory-mapped blob
+        """
+        row = self._rows[stem]
+        if self._mmap is None:
+            if self._writer is not None:
+                self._writer.flush()
+            self._blob_file = open(self.blob_path, 'rb')
+            self._mmap = mmap.mmap(self._blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = self._offsets[row]
+        return memoryview(self._mmap)[offset:offset + self._lengths[row]]
+
+    def open_image(self, stem):
+        """
+        :param stem: VOC file name without extension
+        :return: PIL image decoded from the store
+        """
+        return Image.open(io.BytesIO(self.get(stem)))
+
+    def close(self):
+        """
+        flushes the index and releases the blob
+        """
+        if self._writer is not None:
+            self.flush()
+            self._writer.close()
+            self._writer = None
+        self._close_reader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def pack_directory(jpg_dir, store):
+    """
+    appends every .jpg in jpg_dir that is not in the store yet, the images the ImageSets lists take
+    :param jpg_dir: JPEGImages directory
+    :param store: PackedImageStore
+    :return: number of images appended
+    """
+    with os.scandir(jpg_dir) as entries:
+        to_pack = [(entry.name.rsplit('.', 1)[0], entry.path) for entry in entries
+                   if entry.name.lower().endswith(LISTED_IMAGE_EXTENSION) and entry.name.rsplit('.', 1)[0] not in store]
+
+    for stem, image_path in tqdm.tqdm(to_pack):
+        store.append_file(stem, image_path)
+
+    store.flush()
+    return len(to_pack)
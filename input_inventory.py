@@ -0,0 +1,106 @@
+"""
+Input inventory for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Scans an input directory once with os.scandir and classifies every file into a table of
+(directory, stem, extension, size, mtime, paired annotation), so the stages of a build share a single
+pass over the directory instead of each walking it and looking up annotations in lists.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+PNG_EXTENSIONS = ('.png',)
+ANNOTATION_EXTENSION = '.xml'
+
+
+class InventoryEntry:
+    """
+    a single file of the inventory, annotation is the InventoryEntry of the xml file with the same stem
+    in the same directory (None if there is none, or if the file is an xml file itself)
+    """
+    __slots__ = ('dir_path', 'name', 'stem', 'ext', 'size', 'mtime', 'annotation')
+
+    def __init__(self, dir_path, name, stem, ext, size, mtime):
+        self.dir_path = dir_path
+        self.name = name
+        self.stem = stem
+        self.ext = ext
+        self.size = size
+        self.mtime = mtime
+        self.annotation = None
+
+    @property
+    def path(self):
+        return os.path.join(self.dir_path, self.name)
+
+
+def scan_directory(dir_path):
+    """
+    lists a single directory, pairing every file with the xml file of the same stem
+    :param dir_path: directory to list
+    :return: tuple of (sub directory paths, list of InventoryEntry sorted by name)
+    """
+    sub_directories = []
+    files = []
+    try:
+        with os.scandir(dir_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir():
+                    sub_directories.append(dir_entry.path)
+                elif dir_entry.is_file():
+                    files.append(dir_entry)
+
+        # annotations are paired by stem with a dictionary, not looked up in the file list
+        entries = []
+        annotations = {}
+        for dir_entry in sorted(files, key=lambda item: item.name):
+            stem, ext = os.path.splitext(dir_entry.name)
+            stat = dir_entry.stat()
+            entry = InventoryEntry(dir_path, dir_entry.name, stem, ext.lower(), stat.st_size, stat.st_mtime_ns)
+            entries.append(entry)
+            if entry.ext == ANNOTATION_EXTENSION:
+                annotations[stem] = entry
+    except OSError as e:
+        raise IOError(f'error scanning {dir_path}: {e}') from e
+
+    for entry in entries:
+        if entry.ext != ANNOTATION_EXTENSION:
+            entry.annotation = annotations.get(entry.stem)
+    return sub_directories, entries
+
+
+class InputInventory:
+    """
+    every file below an input directory, in sorted (directory, name) order
+    """
+
+    def __init__(self, root, entries):
+        self.root = root
+        self.entries = entries
+
+    @classmethod
+    def scan(cls, root):
+        """
+        :param root: input directory (scanned recursively)
+        :return: InputInventory of the directory
+        """
+        directories = []
+        pending = [str(root)]
+        while pending:
+            dir_path = pending.pop()
+            sub_directories, entries = scan_directory(dir_path)
+            pending.extend(sub_directories)
+            directories.append((dir_path, entries))
+
+        directories.sort(key=lambda item: item[0])
+        return cls(root, [entry for _, entries in directories for entry in entries])
+
+    def files(self, extensions):
+        """
+        :param extensions: lower case extensions, including the dot
+        :return: list of entries with one of the extensions
+        """
+        return [entry for entry in self.entries if entry.ext in extensions]
+
+    def __len__(self):
+        return len(self.entries)
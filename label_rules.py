@@ -0,0 +1,205 @@
+"""
+Bulk label editing for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Applies a declarative rule set to every annotation xml file in a single (optionally parallel) pass:
+each file is parsed once, all rules run against it, and it is only written back when something changed.
+Rules file (json), every key is optional:
+    {
+        "rename": {"Angry_Nick": "nick"},
+        "merge": {"vehicle": ["car", "truck"]},
+        "drop": ["bird"],
+        "fill_blank": "Angry_Nick",
+        "drop_zero_area": true,
+        "drop_out_of_bounds": true
+    }
+Renames and merges apply to the names as they are in the files, they are not chained.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import json
+import tqdm
+import xml.etree.ElementTree as ElementTree
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from voc_helpers import write_xml_atomic
+
+RULE_KEYS = ('rename', 'merge', 'drop', 'fill_blank', 'drop_zero_area', 'drop_out_of_bounds')
+
+
+def compile_rules(rules):
+    """
+    checks a rule set and turns it into the form apply_rules_to_file uses
+    :param rules: rule dictionary, see the module docstring
+    :return: dictionary with a single 'names' map (old name -> new name, None to drop) and the other rules
+    """
+    unknown = set(rules) - set(RULE_KEYS)
+    if unknown:
+        raise ValueError(f'unknown label rules {sorted(unknown)}, expected some of {RULE_KEYS}')
+
+    names = {}
+
+    def map_name(old_name, new_name):
+        if old_name in names and names[old_name] != new_name:
+            raise ValueError(f'conflicting label rules for {old_name}: {names[old_name]} and {new_name}')
+        names[old_name] = new_name
+
+    for old_name, new_name in rules.get('rename', {}).items():
+        map_name(old_name, new_name)
+    for new_name, old_names in rules.get('merge', {}).items():
+        for old_name in old_names:
+            map_name(old_name, new_name)
+    for old_name in rules.get('drop', []):
+        map_name(old_name, None)
+
+    return {'names': names,
+            'fill_blank': rules.get('fill_blank') or None,
+            'drop_zero_area': bool(rules.get('drop_zero_area', False)),
+            'drop_out_of_bounds': bool(rules.get('drop_out_of_bounds', False))}
+
+
+def load_rules(rules_path):
+    """
+    :param rules_path: json rules file
+    :return: compiled rules, see compile_rules
+    """
+    try:
+        with open(rules_path, 'r') as file:
+            rules = json.load(file)
+    except (IOError, ValueError) as e:
+        raise IOError(f'error reading label rules {rules_path}: {e}') from e
+
+    return compile_rules(rules)
+
+
+def _box_value(bndbox, tag):
+    try:
+        return float(bndbox.find(tag).text)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _size_value(root, tag):
+    try:
+        return float(root.find(f'size/{tag}').text)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def _box_change(obj, width, height, rules):
+    """
+    :return: 'drop zero area', 'drop out of bounds' or None if the box is kept
+    """
+    bndbox = obj.find('bndbox')
+    if bndbox is None:
+        return None
+
+    xmin, ymin, xmax, ymax = (_box_value(bndbox, tag) for tag in ('xmin', 'ymin', 'xmax', 'ymax'))
+    if None in (xmin, ymin, xmax, ymax):
+        return None
+
+    if rules['drop_zero_area'] and (xmax <= xmin or ymax <= ymin):
+        return 'drop zero area'
+    if rules['drop_out_of_bounds'] and width > 0 and height > 0 and \
+            (xmin < 0 or ymin < 0 or xmax > width or ymax > height):
+        return 'drop out of bounds'
+    return None
+
+
+def apply_rules_to_file(xml_path, rules, dry_run=False):
+    """
+    applies every rule to a single xml file, runs in a worker process when edit_labels has more than one worker
+    :param xml_path: xml file to edit
+    :param rules: compiled rules, see compile_rules
+    :param dry_run: only count the changes, do not write the file
+    :return: tuple of (xml path, dictionary of change -> number of objects, error message or None)
+    """
+    changes = {}
+
+    def count(change):
+        changes[change] = changes.get(change, 0) + 1
+
+    try:
+        tree = ElementTree.parse(xml_path)
+        root = tree.getroot()
+        width, height = _size_value(root, 'width'), _size_value(root, 'height')
+
+        for obj in root.findall('object'):
+            name_element = obj.find('name')
+            name = (name_element.text or '').strip() if name_element is not None else ''
+
+            if not name:
+                if rules['fill_blank'] is not None:
+                    if name_element is None:
+                        name_element = ElementTree.SubElement(obj, 'name')
+                    name = name_element.text = rules['fill_blank']
+                    count(f'fill blank -> {name}')
+            elif name in rules['names']:
+                new_name = rules['names'][name]
+                if new_name is None:
+                    root.remove(obj)
+                    count(f'drop {name}')
+                    continue
+                if new_name != name:
+                    name_element.text = new_name
+                    count(f'rename {name} -> {new_name}')
+
+            box_change = _box_change(obj, width, height, rules)
+            if box_change is not None:
+                root.remove(obj)
+                count(box_change)
+
+        if changes and not dry_run:
+            write_xml_atomic(tree, xml_path)
+    except (ElementTree.ParseError, IOError) as e:
+        return xml_path, {}, str(e)
+
+    return xml_path, changes, None
+
+
+def edit_labels(xml_directory, rules, workers=1, dry_run=False, max_listed=10):
+    """
+    applies a rule set to every xml file in xml_directory in a single pass
+    :param xml_directory: Annotations directory (walked recursively)
+    :param rules: compiled rules, see load_rules and compile_rules
+    :param workers: number of worker processes
+    :param dry_run: print what would change without writing anything
+    :param max_listed: number of changed files listed in the dry run summary
+    :return: dictionary with the number of files scanned and changed, change counts and error messages
+    """
+    print('Dry run: editing labels...' if dry_run else 'Editing labels...')
+    xml_paths = sorted(os.path.join(dir_path, xml_file)
+                       for dir_path, _, files in os.walk(xml_directory)
+                       for xml_file in files if xml_file.lower().endswith('.xml'))
+
+    if workers > 1 and len(xml_paths) > 1:
+        chunk_size = max(1, min(256, len(xml_paths) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(tqdm.tqdm(executor.map(apply_rules_to_file, xml_paths, repeat(rules), repeat(dry_run),
+                                                  chunksize=chunk_size), total=len(xml_paths)))
+    else:
+        results = [apply_rules_to_file(xml_path, rules, dry_run) for xml_path in tqdm.tqdm(xml_paths)]
+
+    totals = {}
+    changed = []
+    errors = []
+    for xml_path, changes, error in results:
+        if error is not None:
+            errors.append(f'{xml_path}: {error}')
+            continue
+        if changes:
+            changed.append((xml_path, changes))
+        for change, objects in changes.items():
+            totals[change] = totals.get(change, 0) + objects
+
+    for change, objects in sorted(totals.items()):
+        print(f'{change}: {objects} objects')
+    if dry_run:
+        for xml_path, changes in changed[:max_listed]:
+            print(f'  {xml_path}: ' + ', '.join(f'{change} x{objects}' for change, objects in changes.items()))
+        if len(changed) > max_listed:
+            print(f'  ...and {len(changed) - max_listed} more files')
+    for error in errors:
+        print(error)
+
+    print(f'..{len(changed)} of {len(xml_paths)} xml files {"would be " if dry_run else ""}changed')
+    return {'files': len(xml_paths), 'changed': len(changed), 'changes': totals, 'errors': errors}
@@ -0,0 +1,152 @@
+"""
+Name allocator for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Hands out the random looking 15 character alphanumerical file names without rejection sampling:
+a counter is run through a keyed Feistel permutation of every possible name (62^15), so names never
+repeat and never look sequential. The key and counter are kept in output/name_allocator.json.
+Counter values are reserved in blocks and the state is saved before a block is used, so a crashed
+run can never hand out a name twice; at worst the rest of a block goes unused.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import json
+import string
+import secrets
+import hashlib
+import threading
+from voc_helpers import atomic_write
+
+ALLOCATOR_VERSION = 1
+NAME_ALPHABET = string.ascii_letters + string.digits
+# four rounds of a keyed pseudorandom function already make the Feistel network a pseudorandom permutation
+FEISTEL_ROUNDS = 4
+# names are encoded two characters at a time
+_PAIRS = [first + second for second in NAME_ALPHABET for first in NAME_ALPHABET]
+
+
+class NameAllocator:
+    """
+    keyed permutation of a counter onto the space of names of a fixed length
+    """
+
+    def __init__(self, state_path, key, counter=0, length=15, block_size=4096):
+        self.state_path = state_path
+        self.key = key
+        self.counter = counter
+        self.length = length
+        self.block_size = block_size
+        self.reserved_until = counter
+        self._lock = threading.Lock()
+
+        # smallest even bit width that covers every name, split into two halves for the Feistel network
+        self._domain = len(NAME_ALPHABET) ** length
+        self._half_bits = ((self._domain - 1).bit_length() + 1) // 2
+        self._half_mask = (1 << self._half_bits) - 1
+        self._round_hashes = [hashlib.blake2b(digest_size=8, key=key, person=round_number.to_bytes(16, 'big'))
+                              for round_number in range(FEISTEL_ROUNDS)]
+
+    @classmethod
+    def open(cls, state_path, length=15, block_size=4096):
+        """
+        :param state_path: json state file, a new allocator with a fresh random key is created if it does not exist
+        :param length: name length, must match the saved state
+        :param block_size: number of names reserved each time the state is saved
+        :return: NameAllocator
+        """
+        if not os.path.exists(state_path):
+            return cls(state_path, secrets.token_bytes(32), 0, length, block_size)
+
+        try:
+            with open(state_path, 'r') as file:
+                state = json.load(file)
+            if state['version'] != ALLOCATOR_VERSION:
+                raise ValueError(f'unsupported version {state["version"]}')
+            key = bytes.fromhex(state['key'])
+            counter = int(state['counter'])
+            saved_length = int(state['length'])
+        except (IOError, ValueError, KeyError) as e:
+            raise IOError(f'error reading name allocator state {state_path}: {e}') from e
+
+        if saved_length != length:
+            raise ValueError(f'{state_path} allocates names of length {saved_length}, not {length}')
+        return cls(state_path, key, counter, length, block_size)
+
+    def _save(self, counter):
+        try:
+            with atomic_write(self.state_path) as file:
+                json.dump({'version': ALLOCATOR_VERSION,
+                           'key': self.key.hex(),
+                           'counter': counter,
+                           'length': self.length}, file)
+                file.flush()
+                os.fsync(file.fileno())
+        except IOError as e:
+            raise IOError(f'error writing name allocator state {self.state_path}: {e}') from e
+
+    def _round(self, round_number, half):
+        round_hash = self._round_hashes[round_number].copy()
+        round_hash.update(half.to_bytes(8, 'big'))
+        return int.from_bytes(round_hash.digest(), 'big') & self._half_mask
+
+    def permute(self, number):
+        """
+        :param number: integer in [0, 62^length)
+        :return: its image under the keyed permutation, also in [0, 62^length)
+        """
+        # the Feistel network permutes a slightly bigger power of two range, results that land outside
+        # the name space are fed through again (cycle walking) until they land inside it
+        while True:
+            left, right = number >> self._half_bits, number & self._half_mask
+            for round_number in range(FEISTEL_ROUNDS):
+                left, right = right, left ^ self._round(round_number, right)
+            number = (left << self._half_bits) | right
+            if number < self._domain:
+                return number
+
+    def encode(self, number):
+        """
+        :param number: integer in [0, 62^length)
+        :return: name of self.length alphanumerical characters
+        """
+        pairs = []
+        for _ in range((self.length + 1) // 2):
+            number, pair = divmod(number, len(_PAIRS))
+            pairs.append(_PAIRS[pair])
+        return ''.join(pairs)[:self.length]
+
+    def allocate(self, existing_names=None):
+        """
+        :param existing_names: optional set of names already in use (e.g. from before the allocator was used),
+        names in it are skipped
+        :return: a name this allocator has never handed out before
+        """
+        return self.allocate_batch(1, existing_names)[0]
+
+    def allocate_batch(self, count, existing_names=None):
+        """
+        :param count: number of names
+        :param existing_names: optional set of names to skip, see allocate
+        :return: list of new names
+        """
+        names = []
+        with self._lock:
+            while len(names) < count:
+                if self.counter >= self.reserved_until:
+                    # reserve at least the whole batch with a single save
+                    self.reserved_until = self.counter + max(self.block_size, count - len(names))
+                    self._save(self.reserved_until)
+
+                name = self.encode(self.permute(self.counter))
+                self.counter += 1
+                if existing_names is None or name not in existing_names:
+                    names.append(name)
+        return names
+
+    def close(self):
+        """
+        saves the exact counter, releasing the unused part of the reserved block
+        """
+        with self._lock:
+            if self.reserved_until != self.counter:
+                self._save(self.counter)
+                self.reserved_until = self.counter
@@ -33,11 +33,27 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import argparse
+import atexit
+import cProfile
 import sys
 import traceback
 from pathlib import Path
 from voc_helpers import generate_negative_data_set, collect_current_data_set, inject_negative_data_set, \
-    count_xml_labels, generate_txt_files, prepare_voc
+    generate_txt_files, prepare_voc, load_manifest, save_manifest, get_jpeg_save_options, LINK_MODES, \
+    JPEG_SUBSAMPLING
+from annotation_cache import AnnotationCache
+from dedup_index import DuplicateIndex, DEDUP_MODES, HASH_KINDS, MAX_DEDUP_DISTANCE
+from shard_export import export_shards
+from export_formats import export_annotations, EXPORT_FORMATS
+from image_store import PackedImageStore, pack_directory
+from profiling import PROFILER
+from build_journal import BuildJournal
+from name_allocator import NameAllocator
+from input_inventory import InputInventory
+from watch_mode import WatchDaemon
+from label_rules import load_rules, edit_labels
+from annotation_validation import validate_annotations, write_validation_report, repair_annotations, \
+    print_validation_summary
 
 
 def read_labels(file_path):
@@ -49,12 +65,87 @@ def read_labels(file_path):
         return []
 
 
+def dedup_distance(value):
+    distance = int(value)
+    if not 0 <= distance <= MAX_DEDUP_DISTANCE:
+        raise argparse.ArgumentTypeError(f'must be between 0 and {MAX_DEDUP_DISTANCE}, not {distance}')
+    return distance
+
+
 # argument parser
 parser = argparse.ArgumentParser(description="VOC data set tools",
                                  formatter_class=argparse.RawTextHelpFormatter)
 
 parser.add_argument("--drk_lbl_voc", action='store_true', help="Dark Label to VOC data set")
 parser.add_argument("--gen_neg", action='store_true', help="Generate and Inject Negatives")
+parser.add_argument("--workers", type=int, default=1,
+                    help="Number of worker processes for PNG to JPG conversion (default: 1)")
+parser.add_argument("--jpeg-quality", type=int,
+                    help="JPEG quality 1-95 for converted PNGs (default: Pillow's 75)")
+parser.add_argument("--jpeg-optimize", action='store_true',
+                    help="Optimize the Huffman tables of converted JPGs (smaller files, slower encode)")
+parser.add_argument("--jpeg-progressive", action='store_true', help="Write converted JPGs as progressive JPEGs")
+parser.add_argument("--jpeg-subsampling", choices=list(JPEG_SUBSAMPLING),
+                    help="Chroma subsampling of converted JPGs (default: Pillow's 4:2:0)")
+parser.add_argument("--max-side", type=int, default=0,
+                    help="Scale converted PNGs down so their longest side is at most this many pixels,\n"
+                         "the xml size and boxes are rescaled to match (default: 0, full size)")
+parser.add_argument("--incremental", action='store_true',
+                    help="Only process files that are new or changed since the last run (uses output/manifest.json)")
+parser.add_argument("--resume", action='store_true',
+                    help="Continue a --drk_lbl_voc or --gen_neg build that was interrupted, files it already\n"
+                         "finished are skipped (uses output/build_journal.jsonl)")
+parser.add_argument("--link-mode", choices=LINK_MODES, default='copy',
+                    help="How existing images are placed in the output folders (default: copy)\n"
+                         "hardlink and reflink fall back to copy across filesystems")
+parser.add_argument("--io-threads", type=int, default=1,
+                    help="Number of files to stat and copy concurrently when collecting and injecting (default: 1)")
+parser.add_argument("--seed", type=int, default=0,
+                    help="Seed for the train/val/test split, a name always lands in the same split for a seed")
+parser.add_argument("--dedup", choices=DEDUP_MODES, default='off',
+                    help="Drop or flag exact and near-duplicate images before they are added (default: off)\n"
+                         "uses output/dedup_index.npz, flagged duplicates are listed in output/duplicates.txt")
+parser.add_argument("--dedup-distance", type=dedup_distance, default=4,
+                    help=f"Maximum perceptual hash distance (0 to {MAX_DEDUP_DISTANCE} bits out of 64) "
+                         f"for near duplicates (default: 4)")
+parser.add_argument("--dedup-hash", choices=HASH_KINDS, default='dhash',
+                    help="Perceptual hash used for near duplicates (default: dhash)")
+parser.add_argument("--export-shards", action='store_true',
+                    help="Pack each ImageSets/Main split into tar shards in output/shards (uses --workers)")
+parser.add_argument("--shard-size", type=int, default=1000,
+                    help="Maximum number of images per shard (default: 1000)")
+parser.add_argument("--shard-mb", type=int, default=0,
+                    help="Approximate maximum image megabytes per shard, 0 for no limit (default: 0)")
+parser.add_argument("--export", nargs='+', choices=EXPORT_FORMATS, metavar='FORMAT',
+                    help="Export each ImageSets/Main split as coco (output/coco/instances_<split>.json) and/or\n"
+                         "yolo (output/labels/<name>.txt, output/yolo/<split>.txt), classes from labels.txt\n"
+                         "(uses --workers)")
+parser.add_argument("--pack-images", action='store_true',
+                    help="Also keep every JPG in one packed blob (output/JPEGImages.pack) with an offset index,\n"
+                         "--gen_neg then appends negatives to it instead of copying them to JPEGImages")
+parser.add_argument("--stats", action='store_true',
+                    help="Print per-class box statistics for output/Annotations")
+parser.add_argument("--edit-labels", metavar='RULES_JSON',
+                    help="Apply a json rule set (rename, merge, drop, fill_blank, drop_zero_area,\n"
+                         "drop_out_of_bounds) to every file in output/Annotations in one pass")
+parser.add_argument("--dry-run", action='store_true',
+                    help="With --edit-labels, only print a summary of what would change")
+parser.add_argument("--validate", action='store_true',
+                    help="Check every box in output/Annotations (blank, zero area, inverted, out of bounds) and\n"
+                         "every file (size, filename/path, missing image), report in output/validation_report.txt")
+parser.add_argument("--repair", action='store_true',
+                    help="With --validate, swap inverted corners, clip boxes to the image and drop boxes without area")
+parser.add_argument("--watch", action='store_true',
+                    help="Keep running and add new files in input and negativesInput to the data set as they are\n"
+                         "exported, appending to ImageSets/Main instead of regenerating it (uses output/manifest.json)")
+parser.add_argument("--watch-interval", type=float, default=10,
+                    help="Seconds between polls in --watch mode, files unchanged for this long are complete "
+                         "(default: 10)")
+parser.add_argument("--profile", action='store_true',
+                    help="Record wall/CPU time, bytes, file counts and the slowest files of every stage,\n"
+                         "printed at the end and saved to output/profile/summary.json")
+parser.add_argument("--cprofile", action='store_true',
+                    help="With --profile, also dump cProfile stats to output/profile/prepare_dataset.prof")
 
 # parse arguments
 try:
@@ -74,6 +165,17 @@ JPEG_DIR = Path('output/JPEGImages/')
 SETS_DIR = Path('output/ImageSets/')
 TXT_DIR = Path('output/ImageSets/Main/')
 LABELS_TXT = Path('output/labels.txt')
+MANIFEST_JSON = Path('output/manifest.json')
+NEGATIVES_MANIFEST_JSON = Path('output/negatives_manifest.json')
+DEDUP_INDEX = Path('output/dedup_index.npz')
+DEDUP_REPORT = Path('output/duplicates.txt')
+SHARDS_DIR = Path('output/shards/')
+EXPORT_DIR = Path('output/')
+IMAGE_PACK = Path('output/JPEGImages.pack')
+PROFILE_DIR = Path('output/profile/')
+BUILD_JOURNAL = Path('output/build_journal.jsonl')
+NAME_ALLOCATOR = Path('output/name_allocator.json')
+VALIDATION_REPORT = Path('output/validation_report.txt')
 
 # read labels
 LABELS_FOR_COUNTING = read_labels(LABELS_TXT)
@@ -81,78 +183,352 @@ LABELS_FOR_COUNTING = read_labels(LABELS_TXT)
 # booleans from arguments
 PREPARE_VOC_FROM_DARK_LABEL = args.drk_lbl_voc
 INJECT_NEGATIVES = args.gen_neg
+WORKERS = max(1, args.workers)
+INCREMENTAL = args.incremental
+RESUME = args.resume
+MAX_SIDE = max(0, args.max_side) or None
+SHOW_STATS = args.stats
+LINK_MODE = args.link_mode
+IO_THREADS = max(1, args.io_threads)
+SPLIT_SEED = args.seed
+DEDUP_MODE = args.dedup
+EXPORT_SHARDS = args.export_shards
+EXPORT_FORMATS_SELECTED = args.export or []
+PACK_IMAGES = args.pack_images
+PROFILE = args.profile
+EDIT_LABELS_RULES = args.edit_labels
+VALIDATE = args.validate or args.repair
+WATCH = args.watch
 
 if __name__ == "__main__":
 
-    if PREPARE_VOC_FROM_DARK_LABEL == INJECT_NEGATIVES:
+    if PREPARE_VOC_FROM_DARK_LABEL and INJECT_NEGATIVES or \
+            not (PREPARE_VOC_FROM_DARK_LABEL or INJECT_NEGATIVES or SHOW_STATS or EXPORT_SHARDS or
+                 EXPORT_FORMATS_SELECTED or EDIT_LABELS_RULES or VALIDATE or WATCH):
         print('Please select either --drk_lbl_voc or --gen_neg.')
         sys.exit(0)
 
+    if WATCH and (PREPARE_VOC_FROM_DARK_LABEL or INJECT_NEGATIVES):
+        # the watcher catches up with everything not in the manifest on its first poll
+        print('--watch builds the data set itself, run it without --drk_lbl_voc or --gen_neg.')
+        sys.exit(0)
+
+    if PROFILE:
+        PROFILER.enable()
+        c_profile = cProfile.Profile() if args.cprofile else None
+
+        def write_profile():
+            # registered with atexit so the summary is also written when a stage fails and exits
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            if c_profile is not None:
+                c_profile.disable()
+                c_profile.dump_stats(PROFILE_DIR / 'prepare_dataset.prof')
+            PROFILER.print_summary()
+            PROFILER.write_summary(PROFILE_DIR / 'summary.json')
+            print(f'Profile saved in {PROFILE_DIR}')
+
+        atexit.register(write_profile)
+        if c_profile is not None:
+            c_profile.enable()
+
+    try:
+        JPEG_OPTIONS = get_jpeg_save_options(args.jpeg_quality, args.jpeg_optimize, args.jpeg_progressive,
+                                             args.jpeg_subsampling)
+    except ValueError as e:
+        print(f'error in jpeg options: {e}')
+        sys.exit(1)
+
+    if WATCH:
+        try:
+            name_allocator = NameAllocator.open(NAME_ALLOCATOR)
+            daemon = WatchDaemon(CURRENT_DATA_SET,
+                                 NEGATIVE_IMAGES,
+                                 NEGATIVE_DATA_SET_OUTPUT,
+                                 NEGATIVE_XML_TEMPLATE,
+                                 JPEG_DIR,
+                                 ANNOTATIONS_DIR,
+                                 TXT_DIR,
+                                 MANIFEST_JSON,
+                                 NEGATIVES_MANIFEST_JSON,
+                                 LABELS_FOR_COUNTING,
+                                 name_allocator=name_allocator,
+                                 seed=SPLIT_SEED,
+                                 interval=max(1.0, args.watch_interval),
+                                 workers=WORKERS,
+                                 io_threads=IO_THREADS,
+                                 link_mode=LINK_MODE,
+                                 jpeg_options=JPEG_OPTIONS,
+                                 max_side=MAX_SIDE)
+        except (IOError, ValueError) as e:
+            print(f'error starting watch mode: {e}')
+            sys.exit(1)
+
+        try:
+            daemon.run()
+        finally:
+            name_allocator.close()
+        sys.exit(0)
+
+    manifest = None
+    if INCREMENTAL:
+        try:
+            manifest = load_manifest(MANIFEST_JSON)
+        except IOError as e:
+            print(f'error loading manifest: {e}')
+            sys.exit(1)
+
+    duplicate_index = None
+    if DEDUP_MODE != 'off':
+        try:
+            duplicate_index = DuplicateIndex.load(DEDUP_INDEX, args.dedup_distance, args.dedup_hash)
+        except IOError as e:
+            print(f'error loading duplicate index: {e}')
+            sys.exit(1)
+
+    journal = None
+    name_allocator = None
+    if PREPARE_VOC_FROM_DARK_LABEL or INJECT_NEGATIVES:
+        try:
+            journal = BuildJournal.open(BUILD_JOURNAL, resume=RESUME)
+            name_allocator = NameAllocator.open(NAME_ALLOCATOR)
+        except (IOError, ValueError) as e:
+            print(f'error opening build state: {e}')
+            sys.exit(1)
+
+    def save_duplicate_index():
+        if duplicate_index is not None:
+            duplicate_index.save(DEDUP_INDEX)
+            duplicate_index.write_report(DEDUP_REPORT)
+
     if PREPARE_VOC_FROM_DARK_LABEL:
         try:
+            # a single scan of the input directory, shared by collecting and converting
+            with PROFILER.stage('inventory'):
+                inventory = InputInventory.scan(CURRENT_DATA_SET)
             existing_names = collect_current_data_set(CURRENT_DATA_SET,
                                                       JPEG_DIR,
-                                                      ANNOTATIONS_DIR)
+                                                      ANNOTATIONS_DIR,
+                                                      manifest=manifest,
+                                                      link_mode=LINK_MODE,
+                                                      io_threads=IO_THREADS,
+                                                      duplicate_index=duplicate_index,
+                                                      dedup_mode=DEDUP_MODE,
+                                                      journal=journal,
+                                                      inventory=inventory)
         except IOError as e:
             print(f'error collecting current data set: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
 
         try:
-            prepare_voc(CURRENT_DATA_SET,
-                        JPEG_DIR,
-                        ANNOTATIONS_DIR,
-                        existing_names)
+            conversion_failures = prepare_voc(CURRENT_DATA_SET,
+                                              JPEG_DIR,
+                                              ANNOTATIONS_DIR,
+                                              existing_names,
+                                              workers=WORKERS,
+                                              manifest=manifest,
+                                              duplicate_index=duplicate_index,
+                                              dedup_mode=DEDUP_MODE,
+                                              journal=journal,
+                                              jpeg_options=JPEG_OPTIONS,
+                                              max_side=MAX_SIDE,
+                                              name_allocator=name_allocator,
+                                              inventory=inventory)
         except (IOError, Exception) as e:
             print(f'error preparing voc: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
+        finally:
+            if manifest is not None:
+                save_manifest(MANIFEST_JSON, manifest)
+            save_duplicate_index()
+
+        image_store = None
+        if PACK_IMAGES:
+            try:
+                image_store = PackedImageStore(IMAGE_PACK)
+                with PROFILER.stage('pack images'):
+                    packed = pack_directory(JPEG_DIR, image_store)
+                print(f'{packed} images packed into {IMAGE_PACK}')
+            except IOError as e:
+                print(f'error packing images: {e}')
+                traceback.print_tb(e.__traceback__)
+                sys.exit(1)
 
         try:
-            generate_txt_files(JPEG_DIR, TXT_DIR, 20)
+            generate_txt_files(JPEG_DIR, TXT_DIR, 20, annotations_dir=ANNOTATIONS_DIR, seed=SPLIT_SEED,
+                               labels=LABELS_FOR_COUNTING, image_store=image_store)
         except (OSError, ValueError, IOError) as e:
             print(f'error generating txt files: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
+        finally:
+            if image_store is not None:
+                image_store.close()
 
     if INJECT_NEGATIVES:
         try:
             existing_names = collect_current_data_set(CURRENT_DATA_SET,
                                                       JPEG_DIR,
-                                                      ANNOTATIONS_DIR)
+                                                      ANNOTATIONS_DIR,
+                                                      manifest=manifest,
+                                                      link_mode=LINK_MODE,
+                                                      io_threads=IO_THREADS,
+                                                      duplicate_index=duplicate_index,
+                                                      dedup_mode=DEDUP_MODE,
+                                                      journal=journal)
         except IOError as e:
             print(f'error collecting current data set: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
+        finally:
+            if manifest is not None:
+                save_manifest(MANIFEST_JSON, manifest)
+            save_duplicate_index()
 
         try:
             generate_negative_data_set(existing_names,
                                        NEGATIVE_IMAGES,
                                        NEGATIVE_DATA_SET_OUTPUT,
-                                       NEGATIVE_XML_TEMPLATE)
+                                       NEGATIVE_XML_TEMPLATE,
+                                       link_mode=LINK_MODE,
+                                       duplicate_index=duplicate_index,
+                                       dedup_mode=DEDUP_MODE,
+                                       journal=journal,
+                                       name_allocator=name_allocator)
         except (IOError, Exception) as e:
             print(f'error generating negative data set: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
+        finally:
+            save_duplicate_index()
 
+        image_store = PackedImageStore(IMAGE_PACK) if PACK_IMAGES else None
         try:
             inject_negative_data_set(NEGATIVE_DATA_SET_OUTPUT,
                                      JPEG_DIR,
                                      ANNOTATIONS_DIR,
                                      TXT_DIR,
-                                     20)
+                                     20,
+                                     link_mode=LINK_MODE,
+                                     io_threads=IO_THREADS,
+                                     seed=SPLIT_SEED,
+                                     labels=LABELS_FOR_COUNTING,
+                                     image_store=image_store,
+                                     journal=journal)
         except (OSError, ValueError, IOError) as e:
             print(f'error injecting negative data set: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
+        finally:
+            if image_store is not None:
+                image_store.close()
+
+    if name_allocator is not None:
+        name_allocator.close()
+
+    if journal is not None:
+        if PREPARE_VOC_FROM_DARK_LABEL and conversion_failures:
+            # failed pngs are not journaled as complete, so --resume retries only those
+            journal.close()
+            print(f'Run again with --resume to retry the {len(conversion_failures)} files that failed')
+        else:
+            # the build is complete, a later --resume has nothing to continue
+            journal.finish()
+
+    if EDIT_LABELS_RULES:
+        try:
+            with PROFILER.stage('edit labels'):
+                edit_summary = edit_labels(ANNOTATIONS_DIR, load_rules(EDIT_LABELS_RULES), workers=WORKERS,
+                                           dry_run=args.dry_run)
+        except (IOError, ValueError) as e:
+            print(f'error editing labels: {e}')
+            traceback.print_tb(e.__traceback__)
+            sys.exit(1)
+
+        if edit_summary['changed'] and not args.dry_run and (TXT_DIR / 'train.txt').exists():
+            # listed images keep the split they are in whatever their labels now are, only the
+            # per-class lists are brought in line with the edited labels
+            image_store = PackedImageStore(IMAGE_PACK) if PACK_IMAGES else None
+            try:
+                generate_txt_files(JPEG_DIR, TXT_DIR, 20, annotations_dir=ANNOTATIONS_DIR, seed=SPLIT_SEED,
+                                   labels=LABELS_FOR_COUNTING, image_store=image_store)
+            except (OSError, ValueError, IOError) as e:
+                print(f'error generating txt files: {e}')
+                traceback.print_tb(e.__traceback__)
+                sys.exit(1)
+            finally:
+                if image_store is not None:
+                    image_store.close()
+
+    if VALIDATE:
+        image_store = PackedImageStore(IMAGE_PACK) if PACK_IMAGES else None
+        try:
+            with PROFILER.stage('validate'):
+                annotation_cache = AnnotationCache.open(ANNOTATIONS_DIR)
+                box_issues, image_issues = validate_annotations(annotation_cache, JPEG_DIR, image_store)
+                print_validation_summary(annotation_cache, box_issues, image_issues)
+                report_lines = write_validation_report(VALIDATION_REPORT, annotation_cache, box_issues, image_issues)
+            print(f'..{report_lines} problems listed in {VALIDATION_REPORT}')
+
+            if args.repair:
+                with PROFILER.stage('repair'):
+                    fixed, dropped, rewritten = repair_annotations(annotation_cache, box_issues)
+                print(f'..{fixed} boxes fixed and {dropped} dropped in {rewritten} xml files')
+            annotation_cache = None  # release the memory maps before the cache is refreshed
+        except (IOError, OSError, Exception) as e:
+            print(f'error validating annotations: {e}')
+            traceback.print_tb(e.__traceback__)
+            sys.exit(1)
+        finally:
+            if image_store is not None:
+                image_store.close()
 
-    if LABELS_FOR_COUNTING:
+    if EXPORT_SHARDS:
         try:
-            label_count = count_xml_labels(ANNOTATIONS_DIR,
-                                           LABELS_FOR_COUNTING)
+            with PROFILER.stage('export shards'):
+                export_shards(JPEG_DIR,
+                              ANNOTATIONS_DIR,
+                              TXT_DIR,
+                              SHARDS_DIR,
+                              max_samples=max(1, args.shard_size),
+                              max_bytes=args.shard_mb * 1000000 or None,
+                              workers=WORKERS)
+        except (OSError, IOError) as e:
+            print(f'error exporting shards: {e}')
+            traceback.print_tb(e.__traceback__)
+            sys.exit(1)
+
+    if EXPORT_FORMATS_SELECTED:
+        try:
+            with PROFILER.stage('export annotations'):
+                export_annotations(ANNOTATIONS_DIR,
+                                   JPEG_DIR,
+                                   TXT_DIR,
+                                   EXPORT_DIR,
+                                   LABELS_FOR_COUNTING,
+                                   formats=EXPORT_FORMATS_SELECTED,
+                                   workers=WORKERS)
+        except (OSError, IOError, ValueError) as e:
+            print(f'error exporting annotations: {e}')
+            traceback.print_tb(e.__traceback__)
+            sys.exit(1)
+
+    if LABELS_FOR_COUNTING or SHOW_STATS:
+        try:
+            # only xml files added or modified since the last run are parsed
+            with PROFILER.stage('annotation cache'):
+                annotation_cache = AnnotationCache.open(ANNOTATIONS_DIR)
         except Exception as e:
-            print(f'error counting labels: {e}')
+            print(f'error reading annotations: {e}')
             traceback.print_tb(e.__traceback__)
             sys.exit(1)
-        else:
-            print(label_count)
+
+        if LABELS_FOR_COUNTING:
+            print(annotation_cache.label_counts(LABELS_FOR_COUNTING))
+
+        if SHOW_STATS:
+            print(f'{annotation_cache.image_count} images, {annotation_cache.box_count} boxes, '
+                  f'{annotation_cache.blank_count()} blank labels')
+            for label, label_stats in annotation_cache.box_stats().items():
+                print(f'{label}: ' + ', '.join(f'{key}={value:g}' for key, value in label_stats.items()))
@@ -0,0 +1,157 @@
+"""
+Per-stage profiling for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Records wall time, CPU time, bytes read and written, file counts and the slowest files of each stage.
+Disabled by default: stage() then hands back a shared no-op context manager and record_file() returns at once.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import json
+import time
+import heapq
+import threading
+
+
+class StageMetrics:
+    """
+    totals for a single named stage
+    """
+    __slots__ = ('wall_seconds', 'cpu_seconds', 'calls', 'files', 'bytes_read', 'bytes_written', 'file_seconds',
+                 'slowest')
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.calls = 0
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.file_seconds = 0.0
+        self.slowest = []  # min-heap of (seconds, file name)
+
+    def as_dict(self):
+        return {'wall_seconds': self.wall_seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'calls': self.calls,
+                'files': self.files,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'files_per_sec': self.files / self.wall_seconds if self.wall_seconds else None,
+                'file_seconds': self.file_seconds,
+                'mean_file_seconds': self.file_seconds / self.files if self.files else None,
+                'slowest_files': [{'file': name, 'seconds': seconds}
+                                  for seconds, name in sorted(self.slowest, reverse=True)]}
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *_):
+        self.metrics.wall_seconds += time.perf_counter() - self.wall_start
+        self.metrics.cpu_seconds += time.process_time() - self.cpu_start
+        self.metrics.calls += 1
+        return False
+
+
+class Profiler:
+    """
+    collects StageMetrics by stage name, safe to record into from several threads
+    """
+
+    def __init__(self, slowest_count=10):
+        self.enabled = False
+        self.slowest_count = slowest_count
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def _metrics(self, name):
+        metrics = self.stages.get(name)
+        if metrics is None:
+            with self._lock:
+                metrics = self.stages.setdefault(name, StageMetrics())
+        return metrics
+
+    def stage(self, name):
+        """
+        times a block as part of a stage, the same stage can be entered several times
+        :param name: stage name
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self._metrics(name))
+
+    def record_file(self, name, file_name, seconds=None, bytes_read=0, bytes_written=0):
+        """
+        records a single file handled by a stage
+        :param name: stage name
+        :param file_name: file that was handled, kept if it is one of the slowest
+        :param seconds: time spent on the file, if measured
+        :param bytes_read: bytes read for the file
+        :param bytes_written: bytes written for the file
+        """
+        if not self.enabled:
+            return
+
+        metrics = self._metrics(name)
+        with self._lock:
+            metrics.files += 1
+            metrics.bytes_read += bytes_read
+            metrics.bytes_written += bytes_written
+            if seconds is not None:
+                metrics.file_seconds += seconds
+                if len(metrics.slowest) < self.slowest_count:
+                    heapq.heappush(metrics.slowest, (seconds, str(file_name)))
+                elif seconds > metrics.slowest[0][0]:
+                    heapq.heapreplace(metrics.slowest, (seconds, str(file_name)))
+
+    def summary(self):
+        """
+        :return: dictionary of stage name -> metrics
+        """
+        return {name: metrics.as_dict() for name, metrics in self.stages.items()}
+
+    def print_summary(self):
+        for name, metrics in self.stages.items():
+            if metrics.calls:
+                timing = f'{metrics.wall_seconds:.2f}s wall, {metrics.cpu_seconds:.2f}s cpu'
+            else:
+                # only recorded per file, e.g. by worker processes
+                timing = f'{metrics.file_seconds:.2f}s summed over files'
+            print(f'{name}: {timing}, {metrics.files} files, {metrics.bytes_read / 1e6:.1f} MB read, '
+                  f'{metrics.bytes_written / 1e6:.1f} MB written')
+
+    def write_summary(self, summary_path):
+        """
+        :param summary_path: json file to write the summary to
+        """
+        from voc_helpers import atomic_write  # voc_helpers imports this module
+
+        try:
+            with atomic_write(summary_path) as file:
+                json.dump(self.summary(), file, indent=2)
+        except IOError as e:
+            raise IOError(f'error writing profile summary {summary_path}: {e}') from e
+
+
+# shared by every module, enabled by prepare_dataset.py --profile
+PROFILER = Profiler()
@@ -0,0 +1,148 @@
+"""
+Sharded export for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Packs JPEGImages and Annotations into WebDataset-style tar shards per ImageSets/Main split,
+so data loaders read a few large sequential files instead of hundreds of thousands of small ones.
+Every shard gets a tab separated .idx file next to it: member name, byte offset of the data, size.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import tarfile
+import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from voc_helpers import atomic_write
+
+EXPORT_SPLITS = ('train', 'val', 'test')
+
+
+def read_split_names(txt_dir, split):
+    """
+    :param txt_dir: ImageSets/Main directory
+    :param split: split name (train, val, trainval, test)
+    :return: list of image names in the split
+    """
+    split_path = os.path.join(txt_dir, f'{split}.txt')
+    try:
+        with open(split_path, 'r') as file:
+            return [line.strip() for line in file if line.strip()]
+    except IOError as e:
+        raise IOError(f'error reading {split_path}: {e}')
+
+
+def write_shard(task):
+    """
+    writes one tar shard and its offset index, runs in a worker process
+    :param task: tuple of (shard path, list of image names, jpg directory, annotations directory)
+    :return: tuple of (shard path, samples written, bytes written, list of error messages)
+    """
+    shard_path, names, jpg_dir, annotations_dir = task
+    index_lines = []
+    errors = []
+    samples = 0
+
+    try:
+        with atomic_write(shard_path, 'wb') as shard_file, \
+                tarfile.open(fileobj=shard_file, mode='w', format=tarfile.USTAR_FORMAT) as shard:
+            for name in names:
+                members = [(f'{name}.jpg', os.path.join(jpg_dir, f'{name}.jpg')),
+                           (f'{name}.xml', os.path.join(annotations_dir, f'{name}.xml'))]
+                missing = [path for _, path in members if not os.path.isfile(path)]
+                if missing:
+                    errors.append(f'{name}: missing {", ".join(missing)}')
+                    continue
+
+                for member_name, path in members:
+                    tar_info = shard.gettarinfo(path, arcname=member_name)
+                    tar_info.uid = tar_info.gid = 0
+                    tar_info.uname = tar_info.gname = ''
+                    with open(path, 'rb') as file:
+                        shard.addfile(tar_info, file)
+                    # data is padded to whole blocks and ends where the archive offset now is
+                    data_offset = shard.offset - -(-tar_info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    index_lines.append(f'{member_name}\t{data_offset}\t{tar_info.size}\n')
+                samples += 1
+
+        with atomic_write(f'{os.path.splitext(shard_path)[0]}.idx') as file:
+            file.writelines(index_lines)
+    except (IOError, tarfile.TarError) as e:
+        errors.append(f'error writing {shard_path}: {e}')
+        return shard_path, 0, 0, errors
+
+    return shard_path, samples, os.path.getsize(shard_path), errors
+
+
+def plan_shards(names, jpg_dir, max_samples, max_bytes):
+    """
+    groups image names into shards of at most max_samples images and roughly max_bytes bytes
+    :param names: image names in the split
+    :param jpg_dir: jpg directory, used for the image sizes
+    :param max_samples: maximum number of images per shard
+    :param max_bytes: approximate maximum number of image bytes per shard (None for no limit)
+    :return: list of lists of image names
+    """
+    shards = []
+    current = []
+    current_bytes = 0
+    for name in names:
+        size = 0
+        if max_bytes:
+            try:
+                size = os.path.getsize(os.path.join(jpg_dir, f'{name}.jpg'))
+            except OSError:
+                size = 0  # reported by the shard writer
+
+        if current and (len(current) >= max_samples or (max_bytes and current_bytes + size > max_bytes)):
+            shards.append(current)
+            current = []
+            current_bytes = 0
+        current.append(name)
+        current_bytes += size
+
+    if current:
+        shards.append(current)
+    return shards
+
+
+def export_shards(jpg_dir, annotations_dir, txt_dir, output_dir, splits=EXPORT_SPLITS, max_samples=1000,
+                  max_bytes=None, workers=1):
+    """
+    exports each split listed in ImageSets/Main as numbered tar shards: <split>-000000.tar + <split>-000000.idx
+    :param jpg_dir: JPEGImages directory
+    :param annotations_dir: Annotations directory
+    :param txt_dir: ImageSets/Main directory
+    :param output_dir: directory the shards are written to
+    :param splits: splits to export
+    :param max_samples: maximum number of images per shard
+    :param max_bytes: approximate maximum number of image bytes per shard (None for no limit)
+    :param workers: number of shards written in parallel
+    :return: list of error messages for images that could not be exported
+    """
+    print('Exporting shards...')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # shards from an earlier, bigger export would otherwise be left behind
+    for file_name in os.listdir(output_dir):
+        if file_name.endswith(('.tar', '.idx', '.tmp')) and file_name.split('-', 1)[0] in splits:
+            os.remove(os.path.join(output_dir, file_name))
+
+    tasks = []
+    for split in splits:
+        shards = plan_shards(read_split_names(txt_dir, split), jpg_dir, max_samples, max_bytes)
+        tasks.extend((os.path.join(output_dir, f'{split}-{number:06d}.tar'), names, jpg_dir, annotations_dir)
+                     for number, names in enumerate(shards))
+        print(f'{split}: {len(shards)} shards')
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(tqdm.tqdm(executor.map(write_shard, tasks), total=len(tasks)))
+    else:
+        results = [write_shard(task) for task in tqdm.tqdm(tasks)]
+
+    errors = [error for _, _, _, shard_errors in results for error in shard_errors]
+    for error in errors:
+        print(error)
+
+    total_samples = sum(samples for _, samples, _, _ in results)
+    total_bytes = sum(size for _, _, size, _ in results)
+    print(f'..{total_samples} samples in {len(tasks)} shards ({total_bytes / 1e6:.1f} MB) saved in {output_dir}')
+    return errors
@@ -0,0 +1,55 @@
+"""
+shared fixtures for the PASCAL VOC Data Set Tools tests, run with `python -m pytest` from the repository root
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_annotation(xml_path, image_name, class_names, width=64, height=48):
+    """
+    writes a minimal VOC annotation with one 10x10 box per class name
+    """
+    objects = ''.join(f'\t<object>\n\t\t<name>{class_name}</name>\n\t\t<difficult>0</difficult>\n'
+                      f'\t\t<bndbox>\n\t\t\t<xmin>1</xmin>\n\t\t\t<ymin>1</ymin>\n'
+                      f'\t\t\t<xmax>11</xmax>\n\t\t\t<ymax>11</ymax>\n\t\t</bndbox>\n\t</object>\n'
+                      for class_name in class_names)
+    with open(xml_path, 'w') as file:
+        file.write(f'<annotation>\n\t<folder>JPEGImages</folder>\n\t<filename>{image_name}</filename>\n'
+                   f'\t<size>\n\t\t<width>{width}</width>\n\t\t<height>{height}</height>\n\t\t<depth>3</depth>\n'
+                   f'\t</size>\n{objects}</annotation>\n')
+
+
+class VOCOutput:
+    """
+    an output directory with JPEGImages, Annotations and ImageSets/Main
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        self.jpg_dir = os.path.join(self.root, 'JPEGImages')
+        self.annotations_dir = os.path.join(self.root, 'Annotations')
+        self.txt_dir = os.path.join(self.root, 'ImageSets', 'Main')
+        for directory in (self.jpg_dir, self.annotations_dir, self.txt_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def add_image(self, name, class_names):
+        """
+        adds an (empty, it is never decoded) jpg and its annotation
+        """
+        open(os.path.join(self.jpg_dir, f'{name}.jpg'), 'wb').close()
+        write_annotation(os.path.join(self.annotations_dir, f'{name}.xml'), f'{name}.jpg', class_names)
+
+    def read_list(self, file_name):
+        with open(os.path.join(self.txt_dir, file_name)) as file:
+            return [line.strip() for line in file if line.strip()]
+
+    def read_splits(self):
+        return {split: set(self.read_list(f'{split}.txt')) for split in ('train', 'val', 'test')}
+
+
+@pytest.fixture
+def voc_output(tmp_path):
+    return VOCOutput(tmp_path / 'output')
@@ -0,0 +1,16 @@
+import os
+import multiprocessing
+from benchmark import _wait_for_result
+
+
+def test_wait_for_result_reports_a_dead_stage_process():
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=os._exit, args=(3,))
+    process.start()
+
+    result = _wait_for_result(process, results, poll_seconds=0.1)
+    process.join()
+
+    assert result['seconds'] is None
+    assert 'code 3' in result['error']
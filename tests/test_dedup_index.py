@@ -0,0 +1,64 @@
+import os
+import pytest
+import numpy as np
+from PIL import Image
+import voc_helpers
+from dedup_index import DuplicateIndex, hamming_distance
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'negative.xml')
+
+
+def test_near_duplicates_are_found_through_the_bands():
+    rng = np.random.default_rng(0)
+    index = DuplicateIndex(max_distance=4)
+    hashes = [int(value) for value in rng.integers(0, 2 ** 63, size=200, dtype=np.int64)]
+    for number, perceptual_hash in enumerate(hashes):
+        index.add(f'name{number}', f'source{number}', f'digest{number}', perceptual_hash)
+
+    near = hashes[17] ^ 0b1011  # three bits off
+    assert index.find_duplicate('other', 'other digest', near) == ('name17', 3)
+    for perceptual_hash in rng.integers(0, 2 ** 63, size=50, dtype=np.int64).tolist():
+        match = index.find_duplicate('other', 'other digest', perceptual_hash)
+        nearest = min(hamming_distance(known, perceptual_hash) for known in hashes)
+        assert (match is None) == (nearest > 4)
+    assert index.find_duplicate('other', 'digest5', 0) == ('name5', 0)
+
+
+def test_removed_images_are_not_matched_or_saved(tmp_path):
+    index = DuplicateIndex(max_distance=2)
+    index.add('kept', 'a.jpg', 'digest a', 0b1111)
+    index.add('ghost', 'b.jpg', 'digest b', 0b11110000 << 40)
+    assert index.check('c.jpg', 'digest c', 0b11110001 << 40) == ('ghost', 1)
+    index.drop('c.jpg', 10, 20)
+
+    index.remove('b.jpg')
+    assert index.find_duplicate('c.jpg', 'digest c', 0b11110001 << 40) is None
+    assert not index.is_dropped('c.jpg', 10, 20)
+
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = DuplicateIndex.load(str(tmp_path / 'index.npz'), max_distance=2)
+    assert loaded.names == ['kept']
+
+
+def test_failed_negatives_are_not_added(tmp_path, monkeypatch):
+    negatives = tmp_path / 'negativesInput'
+    negatives.mkdir()
+    Image.new('RGB', (32, 32), (200, 10, 10)).save(negatives / 'red.jpg')
+    (tmp_path / 'negativeDataSet').mkdir()
+
+    def failing_transfer(source, destination, link_mode='copy'):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(voc_helpers, 'transfer_file', failing_transfer)
+    index = DuplicateIndex()
+    with pytest.raises(IOError):
+        voc_helpers.generate_negative_data_set(set(), str(negatives), str(tmp_path / 'negativeDataSet'), TEMPLATE,
+                                               duplicate_index=index)
+    assert index.names == []
+
+
+def test_dedup_distance_is_validated():
+    with pytest.raises(ValueError):
+        DuplicateIndex(max_distance=64)
+    with pytest.raises(ValueError):
+        DuplicateIndex(max_distance=-1)
@@ -0,0 +1,59 @@
+import os
+import json
+import pytest
+import export_formats
+from export_formats import export_annotations, get_yolo_lines
+from voc_helpers import generate_txt_files
+
+
+def test_yolo_lines_are_normalised_centre_and_size():
+    assert get_yolo_lines(200, 100, [(1, 50, 25, 150, 75)]) == ['1 0.500000 0.500000 0.500000 0.500000\n']
+
+
+def test_yolo_lines_clip_boxes_to_the_image():
+    lines = get_yolo_lines(100, 100, [(0, -10, -10, 50, 50), (2, 80, 90, 120, 130)])
+    assert lines == ['0 0.250000 0.250000 0.500000 0.500000\n', '2 0.900000 0.950000 0.200000 0.100000\n']
+
+
+def test_yolo_lines_leave_out_boxes_without_area():
+    boxes = [(0, 10, 10, 10, 20), (0, 120, 10, 150, 20), (0, 30, 30, 20, 40)]
+    assert get_yolo_lines(100, 100, boxes) == []
+    assert get_yolo_lines(0, 100, [(0, 10, 10, 20, 20)]) == []
+
+
+@pytest.fixture
+def listed_output(voc_output):
+    for i in range(20):
+        voc_output.add_image(f'image_{i:05d}', ['cat', 'dog'][i % 2:])
+    generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20)
+    return voc_output
+
+
+def test_coco_export_counts_every_listed_image(listed_output):
+    export_annotations(listed_output.annotations_dir, listed_output.jpg_dir, listed_output.txt_dir,
+                       listed_output.root, ['cat', 'dog'], formats=('coco',))
+
+    with open(os.path.join(listed_output.root, 'coco', 'instances_train.json')) as file:
+        coco = json.load(file)
+    train = listed_output.read_list('train.txt')
+    assert len(coco['images']) == len(train)
+    assert len(coco['annotations']) == sum(2 if int(name[-5:]) % 2 == 0 else 1 for name in train)
+
+
+def test_interrupted_export_leaves_no_temp_files(listed_output, monkeypatch):
+    parse_export_chunk = export_formats.parse_export_chunk
+    calls = []
+
+    def interrupted_chunk(task):
+        calls.append(task)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return parse_export_chunk(task)
+
+    monkeypatch.setattr(export_formats, 'parse_export_chunk', interrupted_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        export_annotations(listed_output.annotations_dir, listed_output.jpg_dir, listed_output.txt_dir,
+                           listed_output.root, ['cat', 'dog'], splits=('train',), chunk_size=4)
+
+    assert os.listdir(os.path.join(listed_output.root, 'coco')) == []
+    assert os.listdir(os.path.join(listed_output.root, 'yolo')) == []
@@ -0,0 +1,36 @@
+import os
+from PIL import Image
+from image_store import PackedImageStore, pack_directory
+from voc_helpers import inject_negative_data_set, generate_txt_files
+from conftest import write_annotation
+
+
+def test_pack_directory_only_packs_listed_images(tmp_path):
+    jpg_dir = tmp_path / 'JPEGImages'
+    jpg_dir.mkdir()
+    Image.new('RGB', (8, 8)).save(jpg_dir / 'a.jpg')
+    Image.new('RGB', (8, 8)).save(jpg_dir / 'b.jpeg', 'JPEG')
+
+    with PackedImageStore(str(tmp_path / 'JPEGImages.pack')) as store:
+        assert pack_directory(str(jpg_dir), store) == 1
+        assert sorted(store.stems()) == ['a']
+        assert store.open_image('a').size == (8, 8)
+
+
+def test_packed_negatives_are_listed_only_with_a_jpg(voc_output, tmp_path):
+    negatives = tmp_path / 'negativeDataSet'
+    negatives.mkdir()
+    for name, extension in (('neg1', 'jpg'), ('neg2', 'jpeg')):
+        Image.new('RGB', (8, 8)).save(negatives / f'{name}.{extension}', 'JPEG')
+        write_annotation(str(negatives / f'{name}.xml'), f'{name}.{extension}', [])
+    voc_output.add_image('positive', ['cat'])
+
+    with PackedImageStore(os.path.join(voc_output.root, 'JPEGImages.pack')) as store:
+        inject_negative_data_set(str(negatives), voc_output.jpg_dir, voc_output.annotations_dir, voc_output.txt_dir,
+                                 20, image_store=store)
+        assert sorted(store.stems()) == ['neg1']
+        generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20, image_store=store)
+
+    listed = set().union(*voc_output.read_splits().values())
+    assert listed == {'positive', 'neg1'}
+    assert all(os.path.exists(os.path.join(voc_output.jpg_dir, f'{name}.jpg')) for name in listed)
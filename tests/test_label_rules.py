@@ -0,0 +1,58 @@
+import pytest
+from label_rules import compile_rules, apply_rules_to_file, edit_labels
+from voc_helpers import generate_txt_files
+from conftest import write_annotation
+
+
+def read_names(xml_path):
+    with open(xml_path) as file:
+        return [line.strip()[len('<name>'):-len('</name>')] for line in file if line.strip().startswith('<name>')]
+
+
+def test_rules_rename_merge_drop_and_fill_blank(tmp_path):
+    xml_path = str(tmp_path / 'image.xml')
+    write_annotation(xml_path, 'image.jpg', ['Angry_Nick', 'car', 'truck', 'bird', ''])
+    rules = compile_rules({'rename': {'Angry_Nick': 'nick'}, 'merge': {'vehicle': ['car', 'truck']},
+                           'drop': ['bird'], 'fill_blank': 'cat'})
+
+    _, changes, error = apply_rules_to_file(xml_path, rules)
+
+    assert error is None
+    assert changes == {'rename Angry_Nick -> nick': 1, 'rename car -> vehicle': 1, 'rename truck -> vehicle': 1,
+                       'drop bird': 1, 'fill blank -> cat': 1}
+    assert read_names(xml_path) == ['nick', 'vehicle', 'vehicle', 'cat']
+
+
+def test_dry_run_counts_without_writing(tmp_path):
+    xml_path = str(tmp_path / 'image.xml')
+    write_annotation(xml_path, 'image.jpg', ['bird', 'cat'])
+
+    _, changes, _ = apply_rules_to_file(xml_path, compile_rules({'drop': ['bird']}), dry_run=True)
+
+    assert changes == {'drop bird': 1}
+    assert read_names(xml_path) == ['bird', 'cat']
+
+
+def test_conflicting_rules_are_rejected():
+    with pytest.raises(ValueError, match='car'):
+        compile_rules({'rename': {'car': 'auto'}, 'drop': ['car']})
+    with pytest.raises(ValueError, match='unknown'):
+        compile_rules({'renames': {}})
+
+
+def test_editing_labels_keeps_images_in_their_splits(voc_output):
+    classes = ['cat', 'dog', 'bird', '']
+    for i in range(200):
+        voc_output.add_image(f'image_{i:05d}', [classes[i % 4]] + (['bird'] if i % 7 == 0 else []))
+    generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20, annotations_dir=voc_output.annotations_dir,
+                       labels=['cat', 'dog', 'bird'])
+    splits = voc_output.read_splits()
+
+    # renaming, dropping and filling changes the rarest class of most images
+    summary = edit_labels(voc_output.annotations_dir,
+                          compile_rules({'rename': {'cat': 'dog'}, 'drop': ['bird'], 'fill_blank': 'cat'}))
+    assert summary['changed']
+    generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20, annotations_dir=voc_output.annotations_dir,
+                       labels=['cat', 'dog'])
+
+    assert voc_output.read_splits() == splits
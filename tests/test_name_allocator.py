@@ -0,0 +1,37 @@
+from name_allocator import NameAllocator, NAME_ALPHABET
+
+
+def test_permute_is_a_bijection_of_the_name_space(tmp_path):
+    allocator = NameAllocator(str(tmp_path / 'name_allocator.json'), b'k' * 32, length=2)
+    domain = len(NAME_ALPHABET) ** 2
+
+    images = [allocator.permute(number) for number in range(domain)]
+
+    assert sorted(images) == list(range(domain))
+    assert images != list(range(domain))
+
+
+def test_names_never_repeat_across_runs(tmp_path):
+    state_path = str(tmp_path / 'name_allocator.json')
+    allocator = NameAllocator.open(state_path, block_size=8)
+    first = allocator.allocate_batch(20)
+    allocator.close()
+
+    allocator = NameAllocator.open(state_path, block_size=8)
+    skipped = allocator.encode(allocator.permute(allocator.counter))
+    second = allocator.allocate_batch(20, existing_names={skipped})
+    allocator.close()
+
+    assert len(set(first + second)) == 40
+    assert skipped not in second
+    assert all(len(name) == 15 and set(name) <= set(NAME_ALPHABET) for name in first + second)
+
+
+def test_a_crashed_run_never_hands_out_a_name_twice(tmp_path):
+    state_path = str(tmp_path / 'name_allocator.json')
+    allocator = NameAllocator.open(state_path, block_size=8)
+    first = allocator.allocate_batch(5)  # no close, the reserved block is never released
+
+    second = NameAllocator.open(state_path, block_size=8).allocate_batch(5)
+
+    assert not set(first) & set(second)
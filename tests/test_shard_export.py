@@ -0,0 +1,43 @@
+import os
+from shard_export import write_shard
+
+
+def read_index(idx_path):
+    with open(idx_path) as file:
+        return [(member, int(offset), int(size)) for member, offset, size in
+                (line.rstrip('\n').split('\t') for line in file)]
+
+
+def test_index_offsets_point_at_the_member_data(voc_output, tmp_path):
+    for i, size in enumerate((0, 1, 511, 512, 513, 5000)):
+        name = f'image_{i:05d}'
+        voc_output.add_image(name, ['cat'])
+        with open(os.path.join(voc_output.jpg_dir, f'{name}.jpg'), 'wb') as file:
+            file.write(bytes(range(256)) * (size // 256) + bytes(size % 256))
+    names = sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(voc_output.jpg_dir))
+    shard_path = str(tmp_path / 'train-000000.tar')
+
+    _, samples, _, errors = write_shard((shard_path, names, voc_output.jpg_dir, voc_output.annotations_dir))
+
+    assert (samples, errors) == (len(names), [])
+    with open(shard_path, 'rb') as file:
+        shard = file.read()
+    index = read_index(str(tmp_path / 'train-000000.idx'))
+    assert [member for member, _, _ in index] == [f'{name}{ext}' for name in names for ext in ('.jpg', '.xml')]
+    for member, offset, size in index:
+        directory = voc_output.jpg_dir if member.endswith('.jpg') else voc_output.annotations_dir
+        with open(os.path.join(directory, member), 'rb') as file:
+            assert shard[offset:offset + size] == file.read()
+
+
+def test_missing_files_are_reported_and_left_out(voc_output, tmp_path):
+    voc_output.add_image('image_00000', ['cat'])
+    shard_path = str(tmp_path / 'train-000000.tar')
+
+    _, samples, _, errors = write_shard((shard_path, ['image_00000', 'missing'], voc_output.jpg_dir,
+                                         voc_output.annotations_dir))
+
+    assert samples == 1
+    assert len(errors) == 1 and errors[0].startswith('missing: missing')
+    assert [member for member, _, _ in read_index(str(tmp_path / 'train-000000.idx'))] == \
+        ['image_00000.jpg', 'image_00000.xml']
@@ -0,0 +1,84 @@
+import numpy as np
+from voc_helpers import assign_splits, split_stratum, get_stratum_quotas, get_rarest_class, \
+    find_missing_class_splits, generate_txt_files, SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST
+
+
+def test_stratum_quotas_round_half_up():
+    assert get_stratum_quotas(4, 20) == (0, 0)
+    assert get_stratum_quotas(5, 20) == (1, 1)
+    assert get_stratum_quotas(100, 20) == (10, 10)
+    assert get_stratum_quotas(1, 100) == (1, 0)
+
+
+def test_every_stratum_with_enough_images_reaches_every_split():
+    names = [f'image_{i:05d}' for i in range(1000)]
+    # one big class and a handful of rare ones, the rare ones would often miss test or val by chance
+    strata = np.array([i % 5 if i < 25 else 99 for i in range(len(names))])
+    splits = assign_splits(names, strata, 20, seed=0)
+
+    for stratum in np.unique(strata):
+        counts = np.bincount(splits[strata == stratum], minlength=3)
+        test_quota, val_quota = get_stratum_quotas(int(np.sum(strata == stratum)), 20)
+        assert counts[SPLIT_TEST] == test_quota and counts[SPLIT_VAL] == val_quota
+        assert counts.min() > 0
+
+
+def test_listed_names_keep_their_split():
+    names = [f'image_{i:05d}' for i in range(200)]
+    strata = np.zeros(len(names), dtype=np.int32)
+    splits = assign_splits(names, strata, 20, seed=3)
+
+    # more names, and every listed name moved to another stratum as if its labels had been edited
+    more_names = names + [f'new_{i:05d}' for i in range(300)]
+    more_strata = np.array([1] * len(names) + [0] * 300)
+    listed = np.concatenate([splits, np.full(300, -1, dtype=np.int8)])
+    more_splits = assign_splits(more_names, more_strata, 20, seed=3, listed_splits=listed)
+
+    assert np.array_equal(more_splits[:len(names)], splits)
+    assert set(np.unique(more_splits[len(names):]).tolist()) == {SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST}
+
+
+def test_split_is_deterministic_and_seeded():
+    names = [f'image_{i:05d}' for i in range(500)]
+    strata = np.zeros(len(names), dtype=np.int32)
+    assert np.array_equal(assign_splits(names, strata, 20, seed=1), assign_splits(names, strata, 20, seed=1))
+    assert not np.array_equal(assign_splits(names, strata, 20, seed=1), assign_splits(names, strata, 20, seed=2))
+
+
+def test_split_stratum_only_fills_what_the_listed_names_lack():
+    listed_counts = np.array([10, 1, 1])  # train, val, test
+    splits = split_stratum([0.5, 0.1, 0.9], listed_counts, 15, 20)
+    assert splits.tolist() == [SPLIT_VAL, SPLIT_TEST, SPLIT_TRAIN]
+
+
+def test_rarest_class_breaks_ties_by_name():
+    assert get_rarest_class({'dog', 'cat'}, {'dog': 3, 'cat': 10}) == 'dog'
+    assert get_rarest_class({'dog', 'cat'}, {'dog': 3, 'cat': 3}) == 'cat'
+    assert get_rarest_class(set(), {}) == ''
+
+
+def test_generate_txt_files_stratifies_by_rarest_class(voc_output):
+    for i in range(60):
+        voc_output.add_image(f'common_{i:03d}', ['cat'])
+    for i in range(5):
+        voc_output.add_image(f'rare_{i:03d}', ['cat', 'bird'])
+    generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20, annotations_dir=voc_output.annotations_dir,
+                       labels=['cat', 'bird'])
+
+    splits = voc_output.read_splits()
+    rare = {f'rare_{i:03d}' for i in range(5)}
+    assert all(rare & names for names in splits.values())
+    assert sorted(voc_output.read_list('trainval.txt')) == sorted(splits['train'] | splits['val'])
+
+
+def test_find_missing_class_splits():
+    membership = np.array([[1, -1], [1, -1], [1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.int8)
+    splits = np.array([SPLIT_TRAIN, SPLIT_TRAIN, SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST, SPLIT_TRAIN], dtype=np.int8)
+    assert find_missing_class_splits(membership, splits, ['cat', 'bird'], 20) == []
+    splits[3] = SPLIT_TRAIN
+    assert find_missing_class_splits(membership, splits, ['cat', 'bird'], 20) == [('cat', 'val')]
+
+
+def test_lists_of_an_empty_output(voc_output):
+    generate_txt_files(voc_output.jpg_dir, voc_output.txt_dir, 20, annotations_dir=voc_output.annotations_dir)
+    assert voc_output.read_splits() == {'train': set(), 'val': set(), 'test': set()}
@@ -0,0 +1,72 @@
+import os
+import shutil
+import pytest
+from PIL import Image
+from watch_mode import WatchDaemon, append_to_txt_files
+from voc_helpers import SPLIT_TRAIN, SPLIT_TEST
+from conftest import write_annotation
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_input(input_dir, name, class_names):
+    image_path = os.path.join(input_dir, f'{name}.jpg')
+    xml_path = os.path.join(input_dir, f'{name}.xml')
+    Image.new('RGB', (64, 48)).save(image_path)
+    write_annotation(xml_path, f'{name}.jpg', class_names)
+    for path in (image_path, xml_path):
+        os.utime(path, (1, 1))  # settled, the daemon takes it on the first poll
+
+
+@pytest.fixture
+def workspace(tmp_path, voc_output):
+    for directory in ('input', 'negativesInput', 'negativeDataSet'):
+        (tmp_path / directory).mkdir()
+    shutil.copy(os.path.join(REPO_DIR, 'negative.xml'), tmp_path)
+    return tmp_path, voc_output
+
+
+def make_daemon(root, voc_output):
+    return WatchDaemon(str(root / 'input'), str(root / 'negativesInput'), str(root / 'negativeDataSet'),
+                       str(root / 'negative.xml'), voc_output.jpg_dir, voc_output.annotations_dir,
+                       voc_output.txt_dir, os.path.join(voc_output.root, 'manifest.json'),
+                       os.path.join(voc_output.root, 'negatives_manifest.json'), ['cat', 'dog'], interval=1)
+
+
+def listed_names(voc_output):
+    return set().union(*voc_output.read_splits().values())
+
+
+def test_images_converted_before_a_stop_are_listed_on_restart(workspace, monkeypatch):
+    root, voc_output = workspace
+    for i in range(10):
+        add_input(root / 'input', f'clip_{i:05d}', ['cat', 'dog'][i % 2:])
+    daemon = make_daemon(root, voc_output)
+    assert daemon.poll_once() == 10
+    assert len(listed_names(voc_output)) == 10
+
+    add_input(root / 'input', 'clip_00010', ['dog'])
+
+    def stopped(names):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(daemon, 'append_names', stopped)
+    with pytest.raises(KeyboardInterrupt):
+        daemon.poll_once()
+    # the new image is in the manifest and the output, but not in the lists
+    assert len(listed_names(voc_output)) == 10
+
+    restarted = make_daemon(root, voc_output)
+    restarted.poll_once()
+    assert len(listed_names(voc_output)) == 11
+    assert not os.path.exists(restarted.stale_marker_path)
+
+
+def test_appending_keeps_the_listed_names(voc_output):
+    append_to_txt_files(voc_output.txt_dir, ['a', 'b'], [SPLIT_TRAIN, SPLIT_TEST], [[1], [-1]], ['cat'])
+    append_to_txt_files(voc_output.txt_dir, ['c'], [SPLIT_TRAIN], [[0]], ['cat'])
+
+    assert voc_output.read_list('train.txt') == ['a', 'c']
+    assert voc_output.read_list('cat_trainval.txt') == ['a  1', 'c  0']
+    assert voc_output.read_list('test.txt') == ['b']
+    assert not [file_name for file_name in os.listdir(voc_output.txt_dir) if file_name.endswith('.tmp')]
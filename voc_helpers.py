@@ -12,8 +12,40 @@ import secrets
 import shutil
 import tqdm
 import datetime
+import threading
+from itertools import repeat
+import numpy as np
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape as xml_escape
 from PIL import Image
+from annotation_index import AnnotationIndex, parse_annotation, BLANK_CLASS_ID
+from annotation_cache import AnnotationCache
+from dedup_index import compute_image_hashes
+from profiling import PROFILER
+from input_inventory import InputInventory, JPEG_EXTENSIONS, PNG_EXTENSIONS
+
+MANIFEST_VERSION = 1
+
+# copy duplicates the bytes, the other modes make the output a metadata-only operation where possible
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink', 'move')
+
+# ImageSets/Main splits
+SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST = 0, 1, 2
+TXT_BUFFER_SIZE = 1 << 20
+# the ImageSets lists, the image pack and every reader take <name>.jpg, other jpeg files are left unlisted
+LISTED_IMAGE_EXTENSION = '.jpg'
+
+# tags filled in for every negative image written from the negative xml template
+NEGATIVE_TEMPLATE_KEYS = ('filename', 'path', 'width', 'height', 'xmax', 'ymax')
+
+# chroma subsampling names -> Pillow's JPEG subsampling values
+JPEG_SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
 
 
 def get_time_date():
@@ -96,106 +128,293 @@ def get_new_file_name(existing_names, length=15, max_attempts=100000):
     raise RuntimeError(f"Failed to generate a unique filename after {max_attempts} attempts.")
 
 
-def count_xml_labels(xml_dir, lbl_list):
+def get_file_digest(file_path, chunk_size=1 << 20):
     """
-    counts the amount of given labels in all xml files within provided directory
-    :param xml_dir: xml directory to scan
-    :param lbl_list: a list of label names to count
-    :return: dictionary of labels and their counts
+    hashes the contents of a file
+    :param file_path: file to hash
+    :param chunk_size: number of bytes to read at a time
+    :return: sha1 hex digest of the file contents
     """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    label_counts = dict.fromkeys(lbl_list, 0)
 
-    for dir_path, _, files in os.walk(xml_dir):
-        for xml_file in files:
-            if not xml_file.lower().endswith('.xml'):
-                continue
+def load_manifest(manifest_path):
+    """
+    loads the incremental build manifest, or returns an empty one if none exists yet
+    :param manifest_path: path to the manifest json file
+    :return: manifest dictionary, source files are keyed by their path relative to the input directory
+    """
+    if not os.path.exists(manifest_path):
+        return {'version': MANIFEST_VERSION, 'files': {}}
 
-            xml_path = os.path.join(dir_path, xml_file)
-            try:
-                tree = ElementTree.parse(xml_path)
-            except ElementTree.ParseError as e:
-                raise ElementTree.ParseError(f'error parsing {xml_file}: {e}')
+    try:
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    except (IOError, ValueError) as e:
+        raise IOError(f'error reading manifest {manifest_path}: {e}') from e
 
-            for name in tree.getroot().iter('name'):
-                if name.text in label_counts:
-                    label_counts[name.text] += 1
+    if manifest.get('version') != MANIFEST_VERSION:
+        print(f'Manifest {manifest_path} is from an older version, rebuilding')
+        return {'version': MANIFEST_VERSION, 'files': {}}
 
-    return label_counts
+    return manifest
 
 
-def remove_object_from_xml_files(xml_directory, object_names_set):
+def save_manifest(manifest_path, manifest):
     """
-    removes objects from xml files within a provided directory
-    :param xml_directory: directory path for xml files
-    :param object_names_set: a set of object names to be removed
+    writes the manifest to disk, replacing the previous one only once the new one is complete
+    :param manifest_path: path to the manifest json file
+    :param manifest: manifest dictionary to save
     """
-    for dir_path, _, files in os.walk(xml_directory):
-        for xml_file in tqdm.tqdm(files):
-            if not xml_file.lower().endswith('.xml'):
-                continue
+    try:
+        with atomic_write(manifest_path) as file:
+            json.dump(manifest, file, separators=(',', ':'))
+    except IOError as e:
+        raise IOError(f'error writing manifest {manifest_path}: {e}') from e
 
-            xml_path = os.path.join(dir_path, xml_file)
 
-            try:
-                tree = ElementTree.parse(xml_path)
-                tree_root = tree.getroot()
+def get_manifest_key(file_path, root_dir):
+    """
+    :param file_path: path of a source file
+    :param root_dir: directory the source file was found in (input directory)
+    :return: manifest key for the file
+    """
+    return os.path.relpath(file_path, root_dir).replace(os.sep, '/')
 
-                # collect items to be removed to avoid modifying the list while iterating over it
-                objects_to_remove = [obj for obj in tree_root.findall("object")
-                                     if obj.find('name') is not None and obj.find('name').text in object_names_set]
 
-                for obj in objects_to_remove:
-                    tree_root.remove(obj)
+def is_unchanged_in_manifest(manifest, key, file_path, inventory_entry=None):
+    """
+    checks a source file against its manifest entry
+    size and mtime are compared first, the content hash is only computed when they differ
+    :param manifest: manifest dictionary
+    :param key: manifest key of the file
+    :param file_path: path of the source file
+    :param inventory_entry: optional InventoryEntry of the file, its size and mtime are used instead of a stat
+    :return: True if the file was already processed and has not changed since
+    """
+    entry = manifest['files'].get(key)
+    if entry is None:
+        return False
 
-                if objects_to_remove:
-                    tree.write(xml_path)
+    if inventory_entry is not None:
+        size, mtime = inventory_entry.size, inventory_entry.mtime
+    else:
+        stat = os.stat(file_path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    if size != entry['size']:
+        return False
+    if mtime == entry['mtime']:
+        return True
 
-            except ElementTree.ParseError as e:
-                raise ElementTree.ParseError(f"Error parsing {xml_file}: {e}")
-            except IOError as e:
-                raise IOError(f"Error writing changes to {xml_file}: {e}")
+    # touched but possibly not modified, the hash decides
+    if get_file_digest(file_path) != entry['hash']:
+        return False
+
+    entry['mtime'] = mtime
+    return True
 
 
-def fix_missing_xml_object_name(xml_directory, label_text):
+def get_manifest_entry(file_path, voc_name):
     """
-    scans xml file for objects with no name and names them according
-    to the label_text
-    :param xml_directory: directory of xml files
-    :param label_text: label to replace object name with
+    :param file_path: path of the source file
+    :param voc_name: name the file was given in the VOC output
+    :return: manifest entry describing the current state of the file
     """
-    for dir_path, _, files in os.walk(xml_directory):
-        for xml_file in tqdm.tqdm(files):
-            if not xml_file.lower().endswith('.xml'):
-                continue
+    stat = os.stat(file_path)
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': get_file_digest(file_path),
+            'voc_name': voc_name}
 
-            xml_path = os.path.join(dir_path, xml_file)
 
-            try:
-                tree = ElementTree.parse(xml_path)
-                objects = tree.findall("object")
-                updated = False
+def update_manifest_entry(manifest, key, file_path, voc_name):
+    """
+    records the current state of a processed source file in the manifest
+    :param manifest: manifest dictionary
+    :param key: manifest key of the file
+    :param file_path: path of the source file
+    :param voc_name: name the file was given in the VOC output
+    """
+    manifest['files'][key] = get_manifest_entry(file_path, voc_name)
+
 
-                for obj in objects:
-                    class_name = obj.find('name')
-                    if class_name is not None and class_name.text is None:
-                        class_name.text = label_text
-                        updated = True
+def get_tmp_path(file_path):
+    """
+    :param file_path: output file
+    :return: path the output is written to before it is renamed into place
+    """
+    return f'{file_path}.tmp'
 
-                if updated:
-                    tree.write(xml_path)
 
-            except ElementTree.ParseError as e:
-                raise ElementTree.ParseError(f"Error parsing {xml_file}: {e}")
-            except Exception as e:
-                raise Exception(f"Error processing {xml_file}: {e}")
+@contextmanager
+def atomic_write(file_path, mode='w', **open_kwargs):
+    """
+    opens a temporary file next to file_path and renames it over file_path once the block finishes,
+    so a crash never leaves a partly written output behind
+    :param file_path: output file
+    :param mode: 'w', 'wb', or 'a' / 'ab' to append to a copy of the existing file
+    :param open_kwargs: passed on to open (encoding, buffering, ...)
+    """
+    tmp_path = get_tmp_path(file_path)
+    try:
+        if mode.startswith('a'):
+            if os.path.exists(file_path):
+                shutil.copyfile(file_path, tmp_path)
+            else:
+                mode = mode.replace('a', 'w')  # a temp file left by a crash is not appended to
+        with open(tmp_path, mode, **open_kwargs) as file:
+            yield file
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
-def replace_xml_file_information(xml_file, replace_dict):
+def write_xml_atomic(tree, xml_path):
+    """
+    writes an element tree with atomic_write, readers never see a partial file
+    :param tree: ElementTree to write
+    :param xml_path: destination xml file
+    """
+    try:
+        with atomic_write(xml_path, 'wb') as file:
+            tree.write(file)
+    except IOError as e:
+        raise IOError(f'error writing {xml_path}: {e}') from e
+
+
+def _reflink(source, destination):
+    """
+    clones source into destination with the FICLONE ioctl (btrfs, xfs, ...), linux only
+    """
+    import fcntl
+
+    ficlone = 0x40049409
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+
+
+def transfer_file(source, destination, link_mode='copy'):
+    """
+    places source at destination using the requested link mode
+    hardlink and reflink fall back to a normal copy when the filesystem can't do them
+    (e.g. when source and destination are on different filesystems)
+    the file is created next to destination and renamed into place, so destination is never partial
+    :param source: file to transfer
+    :param destination: destination file path
+    :param link_mode: one of LINK_MODES
+    :return: link mode that was actually used
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f'unknown link mode {link_mode}, expected one of {LINK_MODES}')
+
+    if link_mode == 'move':
+        shutil.move(source, destination)
+        return link_mode
+
+    tmp_path = get_tmp_path(destination)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)  # left behind by an interrupted build
+
+    used_link_mode = 'copy'
+    if link_mode != 'copy':
+        try:
+            if link_mode == 'hardlink':
+                os.link(source, tmp_path)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(source), tmp_path)
+            else:
+                _reflink(source, tmp_path)
+            used_link_mode = link_mode
+        except (OSError, ImportError):
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    try:
+        if used_link_mode == 'copy':
+            shutil.copy(source, tmp_path)
+        os.replace(tmp_path, destination)
+    except OSError:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return used_link_mode
+
+
+def get_transfer_bytes(file_path, used_link_mode):
+    """
+    :param file_path: transferred file (source or destination, they have the same size)
+    :param used_link_mode: link mode returned by transfer_file
+    :return: number of bytes the transfer read and wrote, only a copy moves any data
+    """
+    if used_link_mode != 'copy':
+        return 0
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def count_xml_labels(xml_dir, lbl_list, index=None):
+    """
+    counts the amount of given labels in all xml files within provided directory
+    :param xml_dir: xml directory to scan
+    :param lbl_list: a list of label names to count
+    :param index: optional AnnotationIndex of xml_dir to count from instead of parsing the directory
+    :return: dictionary of labels and their counts
+    """
+    if index is None:
+        with PROFILER.stage('parse xml'):
+            index = AnnotationIndex.build(xml_dir)
+
+    return index.count_labels(lbl_list)
+
+
+def remove_object_from_xml_files(xml_directory, object_names_set, index=None):
+    """
+    removes objects from xml files within a provided directory
+    only files that contain one of the objects are rewritten
+    :param xml_directory: directory path for xml files
+    :param object_names_set: a set of object names to be removed
+    :param index: optional AnnotationIndex of xml_directory, kept up to date with the removal
+    :return: number of xml files changed
+    """
+    if index is None:
+        with PROFILER.stage('parse xml'):
+            index = AnnotationIndex.build(xml_directory)
+
+    with PROFILER.stage('rewrite xml'):
+        return index.remove_objects(object_names_set)
+
+
+def fix_missing_xml_object_name(xml_directory, label_text, index=None):
+    """
+    scans xml file for objects with no name and names them according
+    to the label_text, only files with blank names are rewritten
+    :param xml_directory: directory of xml files
+    :param label_text: label to replace object name with
+    :param index: optional AnnotationIndex of xml_directory, kept up to date with the fix
+    :return: number of xml files changed
+    """
+    if index is None:
+        with PROFILER.stage('parse xml'):
+            index = AnnotationIndex.build(xml_directory)
+
+    with PROFILER.stage('rewrite xml'):
+        return index.fix_missing_names(label_text)
+
+
+def replace_xml_file_information(xml_file, replace_dict, output_file=None):
     """
     overwrites existing xml file with new values
     :param xml_file: xml file to edit
     :param replace_dict: dictionary of xml tags and the value to place in them
+    :param output_file: optional file to write the edited xml to instead, xml_file is then left untouched
     """
     try:
         tree = ElementTree.parse(xml_file)
@@ -206,7 +425,7 @@ def replace_xml_file_information(xml_file, replace_dict):
             for elem in elements:
                 elem.text = value
 
-        tree.write(xml_file)
+        write_xml_atomic(tree, output_file or xml_file)
 
     except ElementTree.ParseError as e:
         raise ElementTree.ParseError(f'error parsing {xml_file}: {e}')
@@ -214,147 +433,583 @@ def replace_xml_file_information(xml_file, replace_dict):
         raise Exception(f'error processing {xml_file}: {e}')
 
 
-def generate_negative_data_set(existing_names, negative_images, negative_output_dir, xml_template):
+def compile_xml_template(xml_template, keys):
+    """
+    parses an xml template once and compiles it into a format string
+    every element whose tag is in keys (at any depth) becomes a {tag} field
+    :param xml_template: xml template file
+    :param keys: tags to turn into fields
+    :return: format string, fill it with render_xml_template
+    """
+    try:
+        root = ElementTree.parse(xml_template).getroot()
+    except ElementTree.ParseError as e:
+        raise ElementTree.ParseError(f'error parsing {xml_template}: {e}')
+
+    for elem in root.iter():
+        if elem.tag in keys:
+            elem.text = f'__TEMPLATE_FIELD_{elem.tag}__'
+
+    xml_text = ElementTree.tostring(root, encoding='unicode')
+    xml_text = xml_text.replace('{', '{{').replace('}', '}}')
+    for key in keys:
+        xml_text = xml_text.replace(f'__TEMPLATE_FIELD_{key}__', f'{{{key}}}')
+
+    return xml_text
+
+
+def render_xml_template(compiled_template, values):
+    """
+    :param compiled_template: format string from compile_xml_template
+    :param values: dictionary of tag -> value
+    :return: xml text with every field filled in
+    """
+    return compiled_template.format(**{key: xml_escape(str(value)) for key, value in values.items()})
+
+
+def generate_negative_data_set(existing_names, negative_images, negative_output_dir, xml_template,
+                               link_mode='copy', duplicate_index=None, dedup_mode='drop', journal=None,
+                               name_allocator=None, inventory=None):
     """
     generates new filename for both xml and jpg
-    copies images to output folder -> copies xml template to output -> edits xml file to match image
+    copies images to output folder -> writes the xml for each image from the compiled template
     :param existing_names: list of existing file names
     :param negative_images: folder containing negative image files (jpg)
     :param negative_output_dir: folder to output the negative data set (jpg & xml)
     :param xml_template: negative xml template to use
+    :param link_mode: how images are placed in negative_output_dir, one of LINK_MODES
+    :param duplicate_index: optional DuplicateIndex, images matching one already in it are handled per dedup_mode
+    :param dedup_mode: 'drop' skips duplicates, 'flag' only records them in the index report
+    :param journal: optional BuildJournal, negatives it has as complete are skipped and allocated names reused
+    :param name_allocator: optional NameAllocator new names are taken from, instead of random sampling
+    :param inventory: optional InputInventory of the negative images to generate from, negative_images is
+    scanned if not given
+    :return: list of (source image path, new name, new image file name) tuples of the negatives generated
     """
     print('Generating negative data set...')
+    generated = []
+    dropped = 0
+    resumed = 0
+    if journal is not None:
+        existing_names.update(journal.names())
+
+    # parsed once, each negative is then a single write
+    compiled_template = compile_xml_template(xml_template, NEGATIVE_TEMPLATE_KEYS)
+
+    if inventory is None:
+        inventory = InputInventory.scan(negative_images)
+
+    with PROFILER.stage('generate negatives'):
+        for entry in tqdm.tqdm(inventory.files(JPEG_EXTENSIONS)):
+            dir_path, image_file, file_ext = entry.dir_path, entry.name, entry.ext[1:]
+
+            if PROFILER.enabled:
+                start = time.perf_counter()
 
-    for dir_path, _, files in os.walk(negative_images):
-        for image_file in tqdm.tqdm(files):
-            file_ext = image_file.lower().split('.')[-1]
-            if file_ext not in ['jpg', 'jpeg']:
+            img_path = os.path.join(dir_path, image_file)
+            journal_key = get_manifest_key(img_path, negative_images)
+            if journal is not None and journal.is_complete('negatives', journal_key):
+                resumed += 1
+                continue
+            if duplicate_index is not None and dedup_mode == 'drop' and \
+                    duplicate_index.is_dropped(img_path, entry.size, entry.mtime):
+                dropped += 1
                 continue
 
             try:
-                # process image
-                img_path = os.path.join(dir_path, image_file)
-                img = Image.open(img_path)
-                width, height = img.size
+                # process image, only the header is read to get the size
+                with Image.open(img_path) as img:
+                    width, height = img.size
             except IOError as e:
                 raise IOError(f'error opening {image_file}: {e}')
 
+            if duplicate_index is not None:
+                hashes = compute_image_hashes(img_path, duplicate_index.hash_kind)
+                if duplicate_index.check(img_path, *hashes) is not None and dedup_mode == 'drop':
+                    duplicate_index.drop(img_path, entry.size, entry.mtime)
+                    dropped += 1
+                    continue
+
             try:
-                # generate new filename and prepare file paths
-                filename = get_new_file_name(existing_names)
-                existing_names.add(filename)
+                # generate new filename (or reuse the one journaled by an interrupted build)
+                filename = journal.get_name('negatives', journal_key) if journal is not None else None
+                if filename is None:
+                    if name_allocator is not None:
+                        filename = name_allocator.allocate(existing_names)
+                    else:
+                        filename = get_new_file_name(existing_names)
+                    existing_names.add(filename)
+                    if journal is not None:
+                        journal.allocate('negatives', journal_key, filename)
                 image_name = f'{filename}.{file_ext}'
                 image_out_path = os.path.join(negative_output_dir, image_name)
                 xml_file = f'{filename}.xml'
                 xml_path = os.path.join(negative_output_dir, xml_file)
 
-                # copy image and XML template
-                shutil.copy(img_path, image_out_path)
-                shutil.copy(xml_template, xml_path)
-            except IOError as e:
-                raise IOError(f'error copying {image_file} to {negative_output_dir}: {e}')
-
-            try:
-                # replace information in XML
-                replace_dict = {
+                # copy image and write XML
+                used_link_mode = transfer_file(img_path, image_out_path, link_mode)
+                xml_text = render_xml_template(compiled_template, {
                     'filename': image_name,
                     'path': image_name,
-                    'width': str(width),
-                    'height': str(height),
-                    'xmax': str(width),
-                    'ymax': str(height)
-                }
+                    'width': width,
+                    'height': height,
+                    'xmax': width,
+                    'ymax': height
+                })
+                with atomic_write(xml_path, 'w', encoding='utf-8') as file:
+                    file.write(xml_text)
+            except IOError as e:
+                raise IOError(f'error writing {image_file} to {negative_output_dir}: {e}')
+
+            if duplicate_index is not None:
+                # only once it is in the output, a failed negative must not be matched by later ones
+                duplicate_index.add(filename, img_path, *hashes)
+
+            if journal is not None:
+                journal.complete('negatives', journal_key)
+            generated.append((img_path, filename, image_name))
+
+            if PROFILER.enabled:
+                image_bytes = get_transfer_bytes(image_out_path, used_link_mode)
+                PROFILER.record_file('generate negatives', img_path, time.perf_counter() - start,
+                                     bytes_read=image_bytes, bytes_written=image_bytes + len(xml_text))
+
+    if dropped:
+        print(f'..{dropped} duplicate negatives dropped')
+    if resumed:
+        print(f'..{resumed} negatives already generated by the interrupted build')
+    print(f'..Negative data set generated in {negative_output_dir} directory')
+    return generated
+
+
+def run_io_tasks(function, tasks, threads=1, total=None):
+    """
+    calls function(*task) for every task, overlapping up to `threads` calls on a thread pool
+    at most threads * 2 tasks are in flight at a time, so a lazy task generator is never read far ahead
+    errors are collected rather than raised, see raise_io_errors
+    :param function: function to call for each task
+    :param tasks: iterable of argument tuples
+    :param threads: number of concurrent calls (1 runs every task in this thread)
+    :param total: number of tasks for the progress bar, if known
+    :return: list of (task, exception) tuples for the tasks that failed
+    """
+    errors = []
+
+    with tqdm.tqdm(total=total) as progress:
+        if threads <= 1:
+            for task in tasks:
                 try:
-                    replace_xml_file_information(xml_path, replace_dict)
+                    function(*task)
                 except Exception as e:
-                    raise Exception(f'error processing {xml_file}: {e}')
-            except ElementTree.ParseError as e:
-                raise ElementTree.ParseError(f'error parsing {xml_file}: {e}')
+                    errors.append((task, e))
+                progress.update()
+            return errors
+
+        def collect(finished):
+            for future in finished:
+                task = pending.pop(future)
+                if future.exception() is not None:
+                    errors.append((task, future.exception()))
+                progress.update()
+
+        pending = {}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for task in tasks:
+                if len(pending) >= threads * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending[executor.submit(function, *task)] = task
+            collect(list(pending))
+
+    return errors
+
+
+def raise_io_errors(errors, action, max_listed=10):
+    """
+    raises a single IOError describing every failed task returned by run_io_tasks
+    :param errors: list of (task, exception) tuples
+    :param action: what was being done, used in the error message
+    :param max_listed: maximum number of individual errors to include in the message
+    """
+    if not errors:
+        return
 
-    print(f'..Negative data set generated in {negative_output_dir} directory')
+    listed = '\n'.join(f'  {task[0]}: {error}' for task, error in errors[:max_listed])
+    more = f'\n  ...and {len(errors) - max_listed} more' if len(errors) > max_listed else ''
+    raise IOError(f'{len(errors)} files failed while {action}:\n{listed}{more}')
 
 
-def collect_current_data_set(data_set_path, jpg_dir, annotations_dir):
+def collect_current_data_set(data_set_path, jpg_dir, annotations_dir, manifest=None, link_mode='copy',
+                             io_threads=1, duplicate_index=None, dedup_mode='drop', journal=None, inventory=None):
     """
     copies existing data set to appropriate output directories, making a note of file names
     :param data_set_path: directory containing existing data set's jpg and xml files
     :param jpg_dir: output jpg directory
     :param annotations_dir: output annotations directory
+    :param manifest: optional incremental build manifest, unchanged files are not copied again
+    :param link_mode: how images are placed in jpg_dir, one of LINK_MODES (xml files are always
+    copied so later edits never reach the source, unless link_mode is move)
+    :param io_threads: number of files to stat and copy concurrently
+    :param duplicate_index: optional DuplicateIndex, images matching one already in it are handled per dedup_mode
+    :param dedup_mode: 'drop' skips duplicates, 'flag' only records them in the index report
+    :param journal: optional BuildJournal, files it has as complete are skipped
+    :param inventory: optional InputInventory of data_set_path, scanned here if not given
     :return: list of unique file names in the data set that has been collected
     """
     print('Collecting current data set...')
     existing_names = set()
+    skipped = []
+    dropped = []
+    resumed = []
+    dedup_lock = threading.Lock()
+    xml_link_mode = 'move' if link_mode == 'move' else 'copy'
+
+    if manifest is not None:
+        # names handed out on previous runs are still in use in the output
+        existing_names.update(entry['voc_name'] for entry in manifest['files'].values())
+    if journal is not None:
+        existing_names.update(journal.names())
+
+    def collect_file(entry):
+        start = time.perf_counter() if PROFILER.enabled else None
+        file, filename = entry.name, entry.stem
+        jpg_path = entry.path
+        xml_file = f'{filename}.xml'
+        # a jpg without an annotation fails below when its xml cannot be transferred
+        xml_path = entry.annotation.path if entry.annotation is not None else os.path.join(entry.dir_path, xml_file)
+
+        journal_key = get_manifest_key(jpg_path, data_set_path)
+        if journal is not None and journal.is_complete('collect', journal_key):
+            resumed.append(file)
+            if manifest is not None and journal_key not in manifest['files'] and os.path.exists(xml_path):
+                # the interrupted build died before it could save its manifest
+                update_manifest_entry(manifest, journal_key, jpg_path, filename)
+                update_manifest_entry(manifest, get_manifest_key(xml_path, data_set_path), xml_path, filename)
+            return
+
+        if manifest is not None:
+            jpg_key = get_manifest_key(jpg_path, data_set_path)
+            xml_key = get_manifest_key(xml_path, data_set_path)
+            if is_unchanged_in_manifest(manifest, jpg_key, jpg_path, entry) and \
+                    is_unchanged_in_manifest(manifest, xml_key, xml_path, entry.annotation):
+                skipped.append(file)
+                return
+            # taken before the transfer, a move takes the source away
+            jpg_entry = get_manifest_entry(jpg_path, filename)
+            xml_entry = get_manifest_entry(xml_path, filename)
+
+        if duplicate_index is not None:
+            if dedup_mode == 'drop' and duplicate_index.is_dropped(jpg_path, entry.size, entry.mtime):
+                dropped.append(file)
+                return
+            hashes = compute_image_hashes(jpg_path, duplicate_index.hash_kind)
+            with dedup_lock:
+                if duplicate_index.check(jpg_path, *hashes) is not None and dedup_mode == 'drop':
+                    duplicate_index.drop(jpg_path, entry.size, entry.mtime)
+                    dropped.append(file)
+                    return
+                # added under the lock that checked it, so concurrent copies of the same frame are caught
+                duplicate_index.add(filename, jpg_path, *hashes)
 
-    for dir_path, _, files in os.walk(data_set_path):
-        for file in tqdm.tqdm(files):
-            file_ext = file.lower().split('.')[-1]  # last element of the split is the file extension
-            if file_ext not in ['jpg', 'jpeg']:
-                continue
+        try:
+            jpg_link_mode = transfer_file(jpg_path, os.path.join(jpg_dir, file), link_mode)
+            used_xml_link_mode = transfer_file(xml_path, os.path.join(annotations_dir, xml_file), xml_link_mode)
+        except IOError as e:
+            if duplicate_index is not None:
+                with dedup_lock:
+                    duplicate_index.remove(jpg_path)
+            raise IOError(f'error copying {file} to {jpg_dir} or {annotations_dir}: {e}')
+
+        if manifest is not None:
+            manifest['files'][jpg_key] = jpg_entry
+            manifest['files'][xml_key] = xml_entry
+        if journal is not None:
+            journal.complete('collect', journal_key, filename)
+
+        if start is not None:
+            copied_bytes = get_transfer_bytes(os.path.join(jpg_dir, file), jpg_link_mode) + \
+                get_transfer_bytes(os.path.join(annotations_dir, xml_file), used_xml_link_mode)
+            PROFILER.record_file('collect', jpg_path, time.perf_counter() - start,
+                                 bytes_read=copied_bytes, bytes_written=copied_bytes)
+
+    if inventory is None:
+        with PROFILER.stage('inventory'):
+            inventory = InputInventory.scan(data_set_path)
+    jpg_entries = inventory.files(JPEG_EXTENSIONS)
+    existing_names.update(entry.stem for entry in jpg_entries)
+
+    with PROFILER.stage('collect'):
+        errors = run_io_tasks(collect_file, ((entry,) for entry in jpg_entries), threads=io_threads,
+                              total=len(jpg_entries))
+    raise_io_errors([((entry.path,), error) for (entry,), error in errors], 'collecting current data set')
+
+    if skipped:
+        print(f'..{len(skipped)} unchanged files skipped')
+    if dropped:
+        print(f'..{len(dropped)} duplicate images dropped')
+    if resumed:
+        print(f'..{len(resumed)} files already collected by the interrupted build')
+    print('..Finished collecting current data set')
+    return existing_names
+
+
+def get_split_position(name, seed):
+    """
+    hashes a file name to a fixed position in [0, 1), new names of a stratum are ranked by it
+    only the name and the seed go in, so an image keeps its position whatever its labels are
+    :param name: file name without extension
+    :param seed: split seed, a different seed gives a different (but equally fixed) ranking
+    :return: float in [0, 1)
+    """
+    digest = hashlib.blake2b(f'{seed}:{name}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def get_rarest_class(class_names, images_per_class):
+    """
+    :param class_names: names of the classes in an image
+    :param images_per_class: dictionary of class name -> number of images it appears in
+    :return: the stratum of the image, its class that appears in the fewest images (ties go to the name
+    that sorts first), '' if it has none
+    """
+    return min((name for name in class_names if name), key=lambda name: (images_per_class.get(name, 0), name),
+               default='')
+
+
+def get_stratum_quotas(size, split_percentage):
+    """
+    :param size: number of images in a stratum
+    :param split_percentage: split percentage for test and validation sets together
+    :return: tuple of (test, val) image counts, each rounded half up so a stratum big enough to expect an
+    image in a split gets one
+    """
+    share = int(size * split_percentage / 200 + 0.5)
+    return min(share, size), min(share, max(size - share, 0))
 
-            filename, _ = os.path.splitext(file)
-            existing_names.add(filename)
 
-            jpg_path = os.path.join(dir_path, file)
-            xml_file = f'{filename}.xml'
-            xml_path = os.path.join(dir_path, xml_file)
+def split_stratum(positions, listed_counts, size, split_percentage):
+    """
+    splits the new names of a stratum: ranked by hashed position they fill what the stratum is short of
+    its test quota, then of its val quota, and the rest go to train
+    :param positions: hashed position of each new name (see get_split_position)
+    :param listed_counts: number of names of the stratum already listed, indexed by split
+    :param size: number of names in the stratum, listed and new
+    :param split_percentage: split percentage for test and validation sets together
+    :return: int8 array with SPLIT_TRAIN, SPLIT_VAL or SPLIT_TEST per new name
+    """
+    test_quota, val_quota = get_stratum_quotas(size, split_percentage)
+    test_count = max(0, test_quota - int(listed_counts[SPLIT_TEST]))
+    val_count = max(0, val_quota - int(listed_counts[SPLIT_VAL]))
 
+    order = np.argsort(np.asarray(positions, dtype=np.float64), kind='stable')
+    splits = np.full(len(order), SPLIT_TRAIN, dtype=np.int8)
+    splits[order[:test_count]] = SPLIT_TEST
+    splits[order[test_count:test_count + val_count]] = SPLIT_VAL
+    return splits
+
+
+def assign_splits(names, strata, split_percentage, seed, listed_splits=None):
+    """
+    assigns every name to train, val or test, stratified by strata
+    names already listed keep their split, so adding images or editing labels never moves one, and the
+    new names of each stratum are split with split_stratum
+    :param names: list of file names without extension
+    :param strata: array with the stratum of each name (the rarest class id in generate_txt_files)
+    :param split_percentage: split percentage for test and validation sets together
+    :param seed: split seed
+    :param listed_splits: optional int8 array with the split each name is listed in, -1 for new names
+    :return: int8 array with SPLIT_TRAIN, SPLIT_VAL or SPLIT_TEST per name
+    """
+    if not 0 <= split_percentage <= 100:
+        raise ValueError("Percentage must be between 0 and 100")
+
+    if listed_splits is None:
+        splits = np.full(len(names), -1, dtype=np.int8)
+    else:
+        splits = np.array(listed_splits, dtype=np.int8)
+    new = np.flatnonzero(splits < 0)
+    if not len(new):
+        return splits
+
+    positions = np.zeros(len(names), dtype=np.float64)
+    positions[new] = np.fromiter((get_split_position(names[row], seed) for row in new.tolist()),
+                                 dtype=np.float64, count=len(new))
+
+    # one group of rows per stratum, from a single sort instead of a pass over the names per stratum
+    strata = np.asarray(strata)
+    order = np.argsort(strata, kind='stable')
+    boundaries = np.flatnonzero(strata[order][1:] != strata[order][:-1]) + 1
+    for members in np.split(order, boundaries):
+        member_splits = splits[members]
+        new_members = members[member_splits < 0]
+        if len(new_members):
+            listed_counts = np.bincount(member_splits[member_splits >= 0], minlength=3)
+            splits[new_members] = split_stratum(positions[new_members], listed_counts, len(members),
+                                                split_percentage)
+    return splits
+
+
+def read_listed_splits(txt_dir):
+    """
+    :param txt_dir: ImageSets/Main directory
+    :return: dictionary of name -> split of every name in train.txt, val.txt and test.txt, empty if they
+    have not been written yet
+    """
+    listed = {}
+    for split, file_name in ((SPLIT_TRAIN, 'train.txt'), (SPLIT_VAL, 'val.txt'), (SPLIT_TEST, 'test.txt')):
+        file_path = os.path.join(txt_dir, file_name)
+        if not os.path.exists(file_path):
+            continue
+        try:
+            with open(file_path, 'r', buffering=TXT_BUFFER_SIZE) as file:
+                for line in file:
+                    name = line.strip()
+                    if name:
+                        listed[name] = split
+        except IOError as e:
+            raise IOError(f'error reading {file_path}: {e}') from e
+    return listed
+
+
+def find_missing_class_splits(membership, splits, labels, split_percentage):
+    """
+    :param membership: int8 array (names x labels) of flags, see AnnotationCache.class_membership
+    :param splits: int8 array with the split of each name
+    :param labels: class names, one per membership column
+    :param split_percentage: split percentage for test and validation sets together
+    :return: list of (label, split name) for classes with enough images to expect some in a split but none in it
+    """
+    missing = []
+    for column, label in enumerate(labels):
+        class_splits = splits[membership[:, column] >= 0]
+        test_quota, val_quota = get_stratum_quotas(len(class_splits), split_percentage)
+        counts = np.bincount(class_splits, minlength=3)
+        for split, split_name, expected in ((SPLIT_TRAIN, 'train', len(class_splits) - test_quota - val_quota),
+                                            (SPLIT_VAL, 'val', val_quota), (SPLIT_TEST, 'test', test_quota)):
+            if expected > 0 and counts[split] == 0:
+                missing.append((label, split_name))
+    return missing
+
+
+def write_class_txt_files(txt_dir, names, splits, membership, labels, chunk_size=65536):
+    """
+    writes the per-class PASCAL VOC lists <class>_{train,val,trainval,test}.txt
+    every line is the image name and its flag: 1 present, 0 difficult only, -1 not present
+    :param txt_dir: output txt directory
+    :param names: list of file names without extension
+    :param splits: int8 array with the split of each name (see assign_splits)
+    :param membership: int8 array (names x labels) of flags
+    :param labels: list of class names, one per membership column
+    :param chunk_size: number of lines joined before each write, bounds memory use
+    """
+    split_rows = {'train': np.flatnonzero(splits == SPLIT_TRAIN),
+                  'val': np.flatnonzero(splits == SPLIT_VAL),
+                  'trainval': np.flatnonzero(splits != SPLIT_TEST),
+                  'test': np.flatnonzero(splits == SPLIT_TEST)}
+
+    for column, label in enumerate(labels):
+        flags = membership[:, column]
+        for split_name, rows in split_rows.items():
+            filename = os.path.join(txt_dir, f'{label}_{split_name}.txt')
             try:
-                shutil.copy(jpg_path, os.path.join(jpg_dir, file))
-                shutil.copy(xml_path, os.path.join(annotations_dir, xml_file))
+                with atomic_write(filename, 'w', buffering=TXT_BUFFER_SIZE) as file:
+                    for start in range(0, len(rows), chunk_size):
+                        chunk = rows[start:start + chunk_size]
+                        file.write(''.join(f'{names[row]} {flag:2d}\n'
+                                           for row, flag in zip(chunk.tolist(), flags[chunk].tolist())))
             except IOError as e:
-                raise IOError(f'error copying {file} to {jpg_dir} or {annotations_dir}: {e}')
+                raise IOError(f"Error writing to {filename}: {e}")
 
-    print('..Finished collecting current data set')
-    return existing_names
+    print(f'{len(labels) * len(split_rows)} per-class txt files saved')
 
 
-def generate_txt_files(jpg_dir, txt_dir, split_percentage):
+def generate_txt_files(jpg_dir, txt_dir, split_percentage, annotations_dir=None, seed=0, labels=None,
+                       image_store=None):
     """
     scans image directory and generates text file lists for the data set
+    splits are stratified by the rarest class in each image when annotations_dir is given, names already
+    listed in txt_dir keep their split and new ones are ranked by a hash of their name and the seed,
+    so regenerating the lists never moves an image (delete the lists to split from scratch)
     :param jpg_dir: directory containing jpgs to be listed
     :param txt_dir: output txt directory
     :param split_percentage: split percentage for test and validation sets (recommended 20)
+    :param annotations_dir: optional annotations directory used to stratify the splits by class
+    :param seed: split seed
+    :param labels: optional list of class names (labels.txt) to also write <class>_<split>.txt files for,
+    requires annotations_dir
+    :param image_store: optional PackedImageStore, images in it are listed along with the ones in jpg_dir
     """
     print('Generating txt files...')
 
     try:
-        jpeg_names = [file for file in os.listdir(jpg_dir) if file.lower().endswith('.jpg')]
+        with PROFILER.stage('list images'), os.scandir(jpg_dir) as entries:
+            jpeg_names = [entry.name.rsplit('.', 1)[0] for entry in entries
+                          if entry.name.lower().endswith(LISTED_IMAGE_EXTENSION)]
     except OSError as e:
         raise OSError(f"error listing {jpg_dir}: {e}")
 
-    # split the list into training list and split_set list
+    if image_store is not None:
+        jpeg_names = list(set(jpeg_names).union(image_store.stems()))
+    jpeg_names.sort()
+
+    strata = np.full(len(jpeg_names), -1, dtype=np.int32)
+    cache_rows = None
+    if annotations_dir is not None:
+        with PROFILER.stage('annotation cache'):
+            annotation_cache = AnnotationCache.open(annotations_dir)
+        row_of_stem = {stem: row for row, stem in enumerate(annotation_cache.image_stems().tolist())}
+        cache_rows = np.array([row_of_stem.get(name, -1) for name in jpeg_names], dtype=np.int64)
+        has_annotation = cache_rows >= 0
+        strata[has_annotation] = annotation_cache.rarest_class_per_image()[cache_rows[has_annotation]]
+
+    listed = read_listed_splits(txt_dir)
+    listed_splits = np.fromiter((listed.get(name, -1) for name in jpeg_names), dtype=np.int8, count=len(jpeg_names))
     try:
-        split_set, train_set = partition_list(jpeg_names, split_percentage, shuffle=True)
-        print(f'Split test count: {len(split_set)}')
-        print(f'Train set count: {len(train_set)}')
+        splits = assign_splits(jpeg_names, strata, split_percentage, seed, listed_splits)
     except ValueError as e:
         raise ValueError(f"error partitioning list: {e}")
 
-    # split the split_set list into validation and test lists
-    test_set, val_set = split_list_in_half(split_set)
-    print(f'Test set count: {len(test_set)}')
-    print(f'Validation set count: {len(val_set)}')
+    split_counts = np.bincount(splits, minlength=3)
+    print(f'Split test count: {split_counts[SPLIT_TEST] + split_counts[SPLIT_VAL]}')
+    print(f'Train set count: {split_counts[SPLIT_TRAIN]}')
+    print(f'Test set count: {split_counts[SPLIT_TEST]}')
+    print(f'Validation set count: {split_counts[SPLIT_VAL]}')
 
     print('Writing txt files...')
 
-    file_mappings = {
-        'train.txt': (train_set, False),
-        'test.txt': (test_set, False),
-        'val.txt': (val_set, False),
-        'trainval.txt': (train_set, False),  # first write with train_set
-        'trainval.txt': (val_set, True)  # then append with val_set
-    }
-
-    for filename, (set_to_write, is_existing) in file_mappings.items():
+    with PROFILER.stage('write txt files'):
+        # one buffered pass over the names writes all four lists
+        file_names = {SPLIT_TRAIN: 'train.txt', SPLIT_VAL: 'val.txt', SPLIT_TEST: 'test.txt'}
         try:
-            write_to_txt_file(os.path.join(txt_dir, filename), set_to_write, existing=is_existing)
+            with atomic_write(os.path.join(txt_dir, 'train.txt'), buffering=TXT_BUFFER_SIZE) as train_file, \
+                    atomic_write(os.path.join(txt_dir, 'val.txt'), buffering=TXT_BUFFER_SIZE) as val_file, \
+                    atomic_write(os.path.join(txt_dir, 'test.txt'), buffering=TXT_BUFFER_SIZE) as test_file, \
+                    atomic_write(os.path.join(txt_dir, 'trainval.txt'), buffering=TXT_BUFFER_SIZE) as trainval_file:
+                split_files = {SPLIT_TRAIN: train_file, SPLIT_VAL: val_file, SPLIT_TEST: test_file}
+                for name, split in zip(jpeg_names, splits.tolist()):
+                    line = f'{name}\n'
+                    split_files[split].write(line)
+                    if split != SPLIT_TEST:
+                        trainval_file.write(line)
         except IOError as e:
-            raise IOError(f"Error writing to {filename}: {e}")
+            raise IOError(f"Error writing txt files to {txt_dir}: {e}")
+
+        for filename in list(file_names.values()) + ['trainval.txt']:
+            print(f'{os.path.join(txt_dir, filename)} saved')
+
+        if labels and cache_rows is not None:
+            # membership matrix built once for every class, instead of a pass over the data per class
+            membership = np.full((len(jpeg_names), len(labels)), -1, dtype=np.int8)
+            membership[has_annotation] = annotation_cache.class_membership(labels)[cache_rows[has_annotation]]
+            write_class_txt_files(txt_dir, jpeg_names, splits, membership, labels)
+            for label, split_name in find_missing_class_splits(membership, splits, labels, split_percentage):
+                print(f'warning: no {label} images in {split_name}, their images are stratified by rarer classes')
 
     print(f'..All txt files saved in: {txt_dir}')
 
 
-def inject_negative_data_set(negatives_dir, jpg_dir, annotations_dir, txt_dir, val_test_percentage):
+def inject_negative_data_set(negatives_dir, jpg_dir, annotations_dir, txt_dir, val_test_percentage,
+                             link_mode='copy', io_threads=1, seed=0, labels=None, image_store=None, journal=None):
     """
     takes negative data set, copies to output folders, generates text files for new data set
     :param negatives_dir: directory containing negative jpg and xml files
@@ -362,28 +1017,62 @@ def inject_negative_data_set(negatives_dir, jpg_dir, annotations_dir, txt_dir, v
     :param annotations_dir: output annotations directory
     :param txt_dir: output txt directory
     :param val_test_percentage: split percentage for test and validation sets (recommended 20)
+    :param link_mode: how images are placed in jpg_dir, one of LINK_MODES
+    :param io_threads: number of files to copy concurrently
+    :param seed: split seed, see generate_txt_files
+    :param labels: optional list of class names to write per-class txt files for, see generate_txt_files
+    :param image_store: optional PackedImageStore, negative .jpg images are appended to it as well as copied to
+    jpg_dir, which the shard, export and VOCDataset readers list from
+    :param journal: optional BuildJournal, files it has as injected are skipped
     """
     print('Injecting negative data set...')
+    image_files = []
+
+    def inject_file(source, destination, file_link_mode):
+        transfer_file(source, destination, file_link_mode)
+        if journal is not None:
+            journal.complete('inject', get_manifest_key(source, negatives_dir))
+
+    def inject_tasks():
+        for dirpath, _, files in os.walk(negatives_dir):
+            for file in files:
+                source = os.path.join(dirpath, file)
+                file_ext = file.lower().split('.')[-1]
+                if file_ext in ['jpg', 'jpeg']:
+                    image_files.append(file)
+                if journal is not None and journal.is_complete('inject', get_manifest_key(source, negatives_dir)):
+                    continue
+
+                if file_ext in ['jpg', 'jpeg']:
+                    destination = os.path.join(jpg_dir, file)
+                    file_link_mode = link_mode
+                elif file_ext == 'xml':
+                    destination = os.path.join(annotations_dir, file)
+                    file_link_mode = 'move' if link_mode == 'move' else 'copy'
+                else:
+                    print(f'File is neither .jpg, .jpeg nor .xml: {file}')
+                    continue
+
+                yield source, destination, file_link_mode
+
+    with PROFILER.stage('inject negatives'):
+        errors = run_io_tasks(inject_file, inject_tasks(), threads=io_threads)
+    raise_io_errors(errors, f'copying negatives to {jpg_dir} and {annotations_dir}')
+
+    if image_store is not None:
+        with PROFILER.stage('pack images'):
+            # appended from jpg_dir, a move has taken the sources away
+            for file in tqdm.tqdm(image_files):
+                stem, file_ext = os.path.splitext(file)
+                if file_ext.lower() != LISTED_IMAGE_EXTENSION:
+                    continue  # never listed, a packed .jpeg would be listed without a JPEGImages file
+                if stem not in image_store:  # otherwise appended and flushed by an earlier or interrupted build
+                    image_store.append_file(stem, os.path.join(jpg_dir, file))
+            image_store.flush()
 
-    for dirpath, _, files in os.walk(negatives_dir):
-        for file in files:
-            file_ext = file.lower().split('.')[-1]
-            if file_ext in ['jpg', 'jpeg']:
-                destination = os.path.join(jpg_dir, file)
-            elif file_ext == 'xml':
-                destination = os.path.join(annotations_dir, file)
-            else:
-                print(f'File is neither .jpg, .jpeg nor .xml: {file}')
-                continue
-
-            source_path = os.path.join(dirpath, file)
-
-            try:
-                shutil.copy(source_path, destination)
-            except IOError as e:
-                raise IOError(f'error copying {file} to {destination}: {e}')
     try:
-        generate_txt_files(jpg_dir, txt_dir, val_test_percentage)
+        generate_txt_files(jpg_dir, txt_dir, val_test_percentage, annotations_dir=annotations_dir, seed=seed,
+                           labels=labels, image_store=image_store)
     except (OSError, ValueError, IOError) as e:
         print(f'error generating txt files: {e}')
         traceback.print_tb(e.__traceback__)
@@ -392,7 +1081,148 @@ def inject_negative_data_set(negatives_dir, jpg_dir, annotations_dir, txt_dir, v
     print('..Finished injecting negative data set into current data set')
 
 
-def prepare_voc(input_directory, image_directory, annotations_directory, existing_names):
+def get_jpeg_save_options(quality=None, optimize=False, progressive=False, subsampling=None):
+    """
+    :param quality: JPEG quality 1-95, None for Pillow's default (75)
+    :param optimize: compute optimal Huffman tables (smaller files, slower encode)
+    :param progressive: write a progressive JPEG
+    :param subsampling: chroma subsampling, one of JPEG_SUBSAMPLING, None for Pillow's default
+    :return: keyword arguments for PIL.Image.save
+    """
+    options = {}
+    if quality is not None:
+        if not 1 <= quality <= 95:
+            raise ValueError(f'JPEG quality must be between 1 and 95, got {quality}')
+        options['quality'] = quality
+    if optimize:
+        options['optimize'] = True
+    if progressive:
+        options['progressive'] = True
+    if subsampling is not None:
+        if subsampling not in JPEG_SUBSAMPLING:
+            raise ValueError(f'unknown subsampling {subsampling}, expected one of {tuple(JPEG_SUBSAMPLING)}')
+        options['subsampling'] = JPEG_SUBSAMPLING[subsampling]
+    return options
+
+
+def get_scaled_size(width, height, max_side):
+    """
+    :param width: image width
+    :param height: image height
+    :param max_side: maximum length of the longest side, None or 0 for no limit
+    :return: (width, height) scaled down to fit max_side keeping the aspect ratio, or the original size
+    """
+    if not max_side or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def write_converted_xml(xml_input_path, xml_path, new_filename, original_size=None, new_size=None):
+    """
+    writes the xml of a converted image to the output, the input xml is never modified
+    filename and path are set to the new jpg name, and when the image was resized the size and
+    every bndbox are rescaled in the same pass
+    :param xml_input_path: Dark Label xml file
+    :param xml_path: output xml file
+    :param new_filename: new file name without extension
+    :param original_size: (width, height) of the source image, if it was resized
+    :param new_size: (width, height) of the resized image
+    """
+    try:
+        tree = ElementTree.parse(xml_input_path)
+    except ElementTree.ParseError as e:
+        raise ElementTree.ParseError(f'error parsing {xml_input_path}: {e}')
+
+    root = tree.getroot()
+    for key in ('filename', 'path'):
+        for elem in root.findall(key):
+            elem.text = f'{new_filename}.jpg'
+
+    if new_size is not None and new_size != original_size:
+        scale_x = new_size[0] / original_size[0]
+        scale_y = new_size[1] / original_size[1]
+        for tag, value in zip(('width', 'height'), new_size):
+            for elem in root.findall(f'size/{tag}'):
+                elem.text = str(value)
+        for bndbox in root.iter('bndbox'):
+            for tag, scale, limit in (('xmin', scale_x, new_size[0]), ('ymin', scale_y, new_size[1]),
+                                      ('xmax', scale_x, new_size[0]), ('ymax', scale_y, new_size[1])):
+                elem = bndbox.find(tag)
+                try:
+                    elem.text = str(min(max(round(float(elem.text) * scale), 0), limit))
+                except (AttributeError, TypeError, ValueError):
+                    continue  # missing or not a number, left for --validate to report
+
+    write_xml_atomic(tree, xml_path)
+
+
+def convert_dark_label_image(task):
+    """
+    converts a single Dark Label png to jpg and writes its renamed xml alongside it
+    runs in a worker process when prepare_voc is given more than one worker
+    :param task: tuple of (png path, xml input path or None, jpg output path, xml output path, new filename,
+    jpeg options, max side, measure): jpeg options are PIL save arguments (see get_jpeg_save_options),
+    max side limits the longest side of the jpg (None for full size), measure is True when the worker
+    should time each step for the profiler
+    :return: tuple of (png path, error message or None, dictionary of timings and byte counts or None)
+    """
+    png_path, xml_input_path, jpg_path, xml_path, new_filename, jpeg_options, max_side, measure = task
+    timings = None
+
+    try:
+        # convert PNG to JPG
+        start = time.perf_counter() if measure else None
+        with Image.open(png_path) as img:
+            img.load()
+            decoded = time.perf_counter() if measure else None
+            rgb_img = img.convert('RGB')
+            original_size = rgb_img.size
+            new_size = get_scaled_size(*original_size, max_side)
+            if new_size != original_size:
+                rgb_img = rgb_img.resize(new_size, Image.LANCZOS, reducing_gap=3.0)
+            with atomic_write(jpg_path, 'wb') as file:
+                rgb_img.save(file, 'JPEG', **jpeg_options)
+        encoded = time.perf_counter() if measure else None
+
+        # write the renamed (and rescaled) XML file if it exists
+        if xml_input_path is not None:
+            write_converted_xml(xml_input_path, xml_path, new_filename, original_size, new_size)
+
+        if measure:
+            xml_bytes = os.path.getsize(xml_path) if xml_input_path is not None else 0
+            timings = {'decode_seconds': decoded - start,
+                       'encode_seconds': encoded - decoded,
+                       'xml_seconds': time.perf_counter() - encoded,
+                       'png_bytes': os.path.getsize(png_path),
+                       'jpg_bytes': os.path.getsize(jpg_path),
+                       'xml_bytes': xml_bytes}
+    except Exception as e:
+        return png_path, str(e), None
+
+    return png_path, None, timings
+
+
+def hash_images(image_paths, hash_kind, workers=1):
+    """
+    computes exact and perceptual hashes for a list of images, on a process pool if workers > 1
+    :param image_paths: list of image paths
+    :param hash_kind: perceptual hash kind, see dedup_index.HASH_KINDS
+    :param workers: number of worker processes
+    :return: list of (digest, perceptual hash) tuples in the order of image_paths
+    """
+    if workers > 1 and len(image_paths) > 1:
+        chunk_size = max(1, min(64, len(image_paths) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(tqdm.tqdm(executor.map(compute_image_hashes, image_paths, repeat(hash_kind),
+                                               chunksize=chunk_size), total=len(image_paths)))
+
+    return [compute_image_hashes(image_path, hash_kind) for image_path in tqdm.tqdm(image_paths)]
+
+
+def prepare_voc(input_directory, image_directory, annotations_directory, existing_names, workers=1,
+                manifest=None, duplicate_index=None, dedup_mode='drop', journal=None, jpeg_options=None,
+                max_side=None, name_allocator=None, inventory=None):
     """
     takes current data set and renames all files unique, converts any pngs into jpgs
     saves new files into VOC output directories
@@ -400,37 +1230,388 @@ def prepare_voc(input_directory, image_directory, annotations_directory, existin
     :param image_directory: output directory for images
     :param annotations_directory: output directory for annotations
     :param existing_names: set containing current filenames
+    :param workers: number of worker processes for png conversion (1 converts in this process)
+    :param manifest: optional incremental build manifest, only new or modified pngs are converted
+    :param duplicate_index: optional DuplicateIndex, pngs matching an image already in it are handled per dedup_mode
+    :param dedup_mode: 'drop' skips duplicates, 'flag' only records them in the index report
+    :param journal: optional BuildJournal, pngs it has as complete are skipped and allocated names reused
+    :param jpeg_options: PIL save arguments for the jpgs, see get_jpeg_save_options
+    :param max_side: optional maximum length of the longest jpg side, larger images are scaled down along
+    with their boxes
+    :param name_allocator: optional NameAllocator new names are taken from in a single batch, instead of random sampling
+    :param inventory: optional InputInventory of input_directory, scanned here if not given
+    :return: list of (png path, error message) tuples for files that failed to convert
     """
-    for dir_path, _, files in os.walk(input_directory):
-        for file_name in tqdm.tqdm(files):
-            filename_no_ext, file_ext = os.path.splitext(file_name)
-            file_ext = file_ext.lower()
+    candidates = []
+    skipped = 0
+    resumed = 0
+    dropped = 0
+    if journal is not None:
+        existing_names.update(journal.names())
+
+    # pngs converted with other settings are converted again
+    encoding = {'jpeg_options': jpeg_options or {}, 'max_side': max_side or None}
+    default_encoding = {'jpeg_options': {}, 'max_side': None}
+    encoding_changed = manifest is not None and manifest.get('encoding', default_encoding) != encoding
+    if manifest is not None:
+        manifest['encoding'] = encoding
+
+    if inventory is None:
+        with PROFILER.stage('inventory'):
+            inventory = InputInventory.scan(input_directory)
+
+    with PROFILER.stage('scan input'):
+        for png_entry in inventory.files(PNG_EXTENSIONS):
+            png_path = png_entry.path
+            xml_entry = png_entry.annotation
+            xml_input_path = xml_entry.path if xml_entry is not None else None
+
+            png_key = get_manifest_key(png_path, input_directory)
+            previous_name = None
+            if journal is not None:
+                if journal.is_complete('prepare_voc', png_key):
+                    resumed += 1
+                    if manifest is not None and png_key not in manifest['files']:
+                        # the interrupted build died before it could save its manifest
+                        voc_name = journal.get_name('prepare_voc', png_key)
+                        update_manifest_entry(manifest, png_key, png_path, voc_name)
+                        if xml_input_path is not None:
+                            update_manifest_entry(manifest, get_manifest_key(xml_input_path, input_directory),
+                                                  xml_input_path, voc_name)
+                    continue
+                previous_name = journal.get_name('prepare_voc', png_key)
+
+            if manifest is not None:
+                entry = manifest['files'].get(png_key)
+                png_unchanged = is_unchanged_in_manifest(manifest, png_key, png_path, png_entry)
+                xml_unchanged = xml_input_path is None or \
+                    is_unchanged_in_manifest(manifest, get_manifest_key(xml_input_path, input_directory),
+                                             xml_input_path, xml_entry)
+                if png_unchanged and xml_unchanged and not encoding_changed:
+                    skipped += 1
+                    continue
+                if entry is not None and previous_name is None:
+                    # modified since the last run, overwrite the output it produced
+                    previous_name = entry['voc_name']
+
+            if duplicate_index is not None and dedup_mode == 'drop' and \
+                    duplicate_index.is_dropped(png_path, png_entry.size, png_entry.mtime):
+                dropped += 1
+                continue
 
-            if file_ext == '.png':
-                new_filename = get_new_file_name(existing_names)
-                jpg_path = os.path.join(image_directory, f'{new_filename}.jpg')
-                xml_path = os.path.join(annotations_directory, f'{new_filename}.xml')
-                xml_file_name = f'{filename_no_ext}.xml'
-                xml_input_path = os.path.join(dir_path, xml_file_name)
+            candidates.append((png_path, xml_input_path, previous_name, png_entry))
+
+    image_hashes = [None] * len(candidates)
+    if duplicate_index is not None:
+        print('Hashing pngs for duplicate detection...')
+        with PROFILER.stage('hash images'):
+            image_hashes = hash_images([png_path for png_path, _, _, _ in candidates], duplicate_index.hash_kind,
+                                       workers)
+
+    # allocate every new name up front, in walk order, so names stay deterministic
+    # and collision free no matter which worker finishes first
+    new_names = None
+    if name_allocator is not None:
+        # names of pngs dropped as duplicates below are simply never used
+        new_names = iter(name_allocator.allocate_batch(sum(1 for _, _, name, _ in candidates if name is None),
+                                                       existing_names))
+    tasks = []
+    for (png_path, xml_input_path, new_filename, png_entry), hashes in zip(candidates, image_hashes):
+        if hashes is not None and duplicate_index.check(png_path, *hashes) is not None and dedup_mode == 'drop':
+            duplicate_index.drop(png_path, png_entry.size, png_entry.mtime)
+            dropped += 1
+            continue
+
+        if new_filename is None:
+            new_filename = next(new_names) if new_names is not None else get_new_file_name(existing_names)
+            existing_names.add(new_filename)
+        if journal is not None:
+            journal.allocate('prepare_voc', get_manifest_key(png_path, input_directory), new_filename)
+
+        if hashes is not None:
+            duplicate_index.add(new_filename, png_path, *hashes)
+
+        tasks.append((png_path,
+                      xml_input_path,
+                      os.path.join(image_directory, f'{new_filename}.jpg'),
+                      os.path.join(annotations_directory, f'{new_filename}.xml'),
+                      new_filename,
+                      jpeg_options or {},
+                      max_side,
+                      PROFILER.enabled))
+
+    if journal is not None:
+        # every name is durable before anything is written under it
+        journal.sync()
+
+    if dropped:
+        print(f'{dropped} duplicate pngs dropped')
+    if skipped:
+        print(f'{skipped} unchanged pngs skipped')
+    if resumed:
+        print(f'{resumed} pngs already converted by the interrupted build')
+
+    failures = []
+
+    def handle_result(task, png_path, error, timings):
+        if error is not None:
+            failures.append((png_path, error))
+            if duplicate_index is not None:
+                # added before the conversion so pngs of the same batch are checked against it
+                duplicate_index.remove(png_path)
+            return
+
+        _, xml_input_path, _, _, new_filename, _, _, _ = task
+        if journal is not None:
+            journal.complete('prepare_voc', get_manifest_key(png_path, input_directory))
+
+        if timings is not None:
+            # worker time per step, the 'convert pngs' stage holds the wall time of the whole pool
+            PROFILER.record_file('png decode', png_path, timings['decode_seconds'], bytes_read=timings['png_bytes'])
+            PROFILER.record_file('jpeg encode', png_path, timings['encode_seconds'],
+                                 bytes_written=timings['jpg_bytes'])
+            if xml_input_path is not None:
+                PROFILER.record_file('xml rewrite', xml_input_path, timings['xml_seconds'],
+                                     bytes_read=timings['xml_bytes'], bytes_written=timings['xml_bytes'])
+
+        if manifest is not None:
+            update_manifest_entry(manifest, get_manifest_key(png_path, input_directory), png_path, new_filename)
+            if xml_input_path is not None:
+                update_manifest_entry(manifest, get_manifest_key(xml_input_path, input_directory),
+                                      xml_input_path, new_filename)
+
+    # results are handled as they arrive, so the journal keeps up with the workers
+    with PROFILER.stage('convert pngs'):
+        if workers > 1 and len(tasks) > 1:
+            chunk_size = max(1, min(64, len(tasks) // (workers * 4)))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(convert_dark_label_image, tasks, chunksize=chunk_size)
+                for task, result in zip(tasks, tqdm.tqdm(results, total=len(tasks))):
+                    handle_result(task, *result)
+        else:
+            for task in tqdm.tqdm(tasks):
+                handle_result(task, *convert_dark_label_image(task))
+
+    for png_path, error in failures:
+        print(f'Error processing file {png_path}: {error}')
+
+    if failures:
+        print(f'..{len(failures)} of {len(tasks)} files failed to convert')
+
+    return failures
+
+
+class LRUCache:
+    """
+    thread safe least recently used cache bounded by the summed size of its values
+    """
 
-                try:
-                    # convert PNG to JPG
-                    with Image.open(os.path.join(dir_path, file_name)) as img:
-                        rgb_img = img.convert('RGB')
-                        rgb_img.save(jpg_path)
+    def __init__(self, max_size, size_of=lambda value: 1):
+        """
+        :param max_size: maximum summed size of the cached values, 0 disables the cache
+        :param size_of: function returning the size of a value (default: every value counts as 1)
+        """
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: cached value, or None
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= self.size_of(previous)
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= self.size_of(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class VOCSample:
+    """
+    annotation of a single image, boxes are (xmin, ymin, xmax, ymax) rows and class ids index
+    VOCDataset.class_names
+    """
+    __slots__ = ('name', 'width', 'height', 'class_ids', 'boxes', 'difficult', 'truncated')
 
-                    # update and copy XML file if it exists
-                    if xml_file_name in files:
-                        replace_dict = {'filename': f'{new_filename}.jpg', 'path': f'{new_filename}.jpg'}
+    def __init__(self, name, width, height, class_ids, boxes, difficult, truncated):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.class_ids = class_ids
+        self.boxes = boxes
+        self.difficult = difficult
+        self.truncated = truncated
 
-                        try:
-                            replace_xml_file_information(xml_input_path, replace_dict)
-                        except (ElementTree.ParseError, Exception) as e:
-                            raise Exception(f"Error replacing xml file information {xml_file_name}: {e}")
+    def __len__(self):
+        return len(self.class_ids)
 
-                        shutil.copy(xml_input_path, xml_path)
 
-                    existing_names.add(new_filename)
+class VOCDataset:
+    """
+    reads back a VOC tree written by prepare_voc and generate_txt_files (JPEGImages, Annotations, ImageSets/Main)
+    split lists are read when first used, annotations are parsed on demand and decoded images are kept
+    in a size bounded LRU cache, so a data set of any size can be streamed through
+    """
 
-                except IOError as e:
-                    raise IOError(f"Error processing file {file_name}: {e}")
+    def __init__(self, voc_dir, image_cache_mb=512, sample_cache_size=100000, image_store=None):
+        """
+        :param voc_dir: VOC output directory (output/)
+        :param image_cache_mb: megabytes of decoded images to keep, 0 disables the image cache
+        :param sample_cache_size: number of parsed annotations to keep
+        :param image_store: optional PackedImageStore, images in it are read from it instead of JPEGImages
+        """
+        self.voc_dir = voc_dir
+        self.jpg_dir = os.path.join(voc_dir, 'JPEGImages')
+        self.annotations_dir = os.path.join(voc_dir, 'Annotations')
+        self.txt_dir = os.path.join(voc_dir, 'ImageSets', 'Main')
+        self.image_store = image_store
+        self.images = LRUCache(image_cache_mb * 1000000, lambda image: image.nbytes)
+        self.samples = LRUCache(sample_cache_size)
+        self._split_names = {}
+        self._class_ids = {}
+        self._lock = threading.Lock()
+
+        # labels.txt order comes first, so class ids match the per-class lists and exports
+        labels_path = os.path.join(voc_dir, 'labels.txt')
+        if os.path.exists(labels_path):
+            with open(labels_path, 'r') as file:
+                for label in file:
+                    if label.strip():
+                        self._class_ids.setdefault(label.strip(), len(self._class_ids))
+
+    @property
+    def class_names(self):
+        """
+        :return: list of class names, indexed by the class ids of the samples
+        """
+        with self._lock:
+            return sorted(self._class_ids, key=self._class_ids.get)
+
+    def names(self, split):
+        """
+        :param split: split name (train, val, trainval, test)
+        :return: list of image names in the split, read from ImageSets/Main once
+        """
+        names = self._split_names.get(split)
+        if names is None:
+            split_path = os.path.join(self.txt_dir, f'{split}.txt')
+            try:
+                with open(split_path, 'r') as file:
+                    names = [line.strip() for line in file if line.strip()]
+            except IOError as e:
+                raise IOError(f'error reading {split_path}: {e}')
+            self._split_names[split] = names
+        return names
+
+    def sample(self, name):
+        """
+        :param name: image name
+        :return: VOCSample parsed from the annotation of the image
+        """
+        sample = self.samples.get(name)
+        if sample is not None:
+            return sample
+
+        # parsed with ids local to the file, which are mapped to the shared ids under the lock
+        local_ids = {}
+        record = parse_annotation(os.path.join(self.annotations_dir, f'{name}.xml'), local_ids)
+        local_names = {class_id: class_name for class_name, class_id in local_ids.items()}
+        objects = record.objects
+        with self._lock:
+            class_ids = [BLANK_CLASS_ID if obj.class_id == BLANK_CLASS_ID else
+                         self._class_ids.setdefault(local_names[obj.class_id], len(self._class_ids))
+                         for obj in objects]
+
+        sample = VOCSample(name, record.width, record.height,
+                           np.array(class_ids, dtype=np.int32),
+                           np.array([(obj.xmin, obj.ymin, obj.xmax, obj.ymax) for obj in objects],
+                                    dtype=np.float32).reshape(-1, 4),
+                           np.array([obj.difficult for obj in objects], dtype=bool),
+                           np.array([obj.truncated for obj in objects], dtype=bool))
+        self.samples.put(name, sample)
+        return sample
+
+    def image(self, name):
+        """
+        :param name: image name
+        :return: read-only RGB uint8 NumPy array of shape (height, width, 3)
+        """
+        image = self.images.get(name)
+        if image is not None:
+            return image
+
+        try:
+            if self.image_store is not None and name in self.image_store:
+                with self._lock:
+                    img = self.image_store.open_image(name)
+            else:
+                img = Image.open(os.path.join(self.jpg_dir, f'{name}.jpg'))
+            with img:
+                image = np.asarray(img.convert('RGB'))
+        except IOError as e:
+            raise IOError(f'error reading image {name}: {e}')
+
+        image.flags.writeable = False  # shared with every later reader through the cache
+        self.images.put(name, image)
+        return image
+
+    def load(self, name):
+        """
+        :param name: image name
+        :return: tuple of (image array, VOCSample)
+        """
+        return self.image(name), self.sample(name)
+
+    def batches(self, split, batch_size=32, threads=4, prefetch=2, shuffle=False, seed=0):
+        """
+        yields the split in batches, loading the next `prefetch` batches on a thread pool while the
+        current one is used (Pillow decodes without holding the GIL)
+        :param split: split name
+        :param batch_size: number of images per batch
+        :param threads: number of loader threads
+        :param prefetch: number of batches loaded ahead
+        :param shuffle: shuffle the split, reproducibly for a given seed
+        :param seed: shuffle seed
+        :return: iterator of lists of (name, image array, VOCSample) tuples
+        """
+        names = self.names(split)
+        if shuffle:
+            names = list(names)
+            random.Random(seed).shuffle(names)
+
+        def load_named(name):
+            image, sample = self.load(name)
+            return name, image, sample
+
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            pending = deque()
+            for start in range(0, len(names), batch_size):
+                if len(pending) > prefetch:
+                    yield [future.result() for future in pending.popleft()]
+                pending.append([executor.submit(load_named, name) for name in names[start:start + batch_size]])
+            while pending:
+                yield [future.result() for future in pending.popleft()]
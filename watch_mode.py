@@ -0,0 +1,459 @@
+"""
+Watch mode for PASCAL VOC Data Set Tools (see prepare_dataset.py)
+Polls input/ and negativesInput/ for new exports and pushes each batch of arrivals through the usual
+collect / convert / rename and negative generation / injection stages, then appends the new images to the
+ImageSets/Main lists and the label counts instead of regenerating them.
+Polling uses os.scandir and mtimes only (no inotify, which NFS mounts often lack): a directory is only
+listed again when its mtime changes, and a file is only picked up once its size and mtime have stopped
+changing, so half written exports are never read.
+Processed files are recorded in the incremental build manifests, so a restarted watcher carries on where
+it stopped.
+MIT License
+Copyright (c) 2023 @10XTMY, molmez.io
+"""
+import os
+import time
+import datetime
+import traceback
+import numpy as np
+from annotation_cache import AnnotationCache
+from annotation_index import parse_annotation
+from input_inventory import InputInventory, scan_directory, JPEG_EXTENSIONS, PNG_EXTENSIONS
+from voc_helpers import collect_current_data_set, prepare_voc, generate_negative_data_set, generate_txt_files, \
+    load_manifest, save_manifest, get_manifest_key, is_unchanged_in_manifest, update_manifest_entry, \
+    get_split_position, get_rarest_class, split_stratum, read_listed_splits, transfer_file, run_io_tasks, \
+    raise_io_errors, atomic_write, LISTED_IMAGE_EXTENSION, SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST
+
+# kept next to the manifests while a batch is in them but not yet in the lists, a restart rebuilds the lists
+STALE_LISTS_MARKER = 'lists.stale'
+
+# a listing taken this soon after its directory's mtime may have missed files created in the same clock tick
+RACY_NS = 2 * 10 ** 9
+
+TXT_SPLITS = (('train', (SPLIT_TRAIN,)), ('val', (SPLIT_VAL,)), ('trainval', (SPLIT_TRAIN, SPLIT_VAL)),
+              ('test', (SPLIT_TEST,)))
+
+
+class DirectoryPoller:
+    """
+    keeps the listing of every directory below root and only lists a directory again when its mtime changes
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        self._directories = {}
+
+    def poll(self, restat=()):
+        """
+        :param restat: paths of files to stat again even if their directory is unchanged (files still being written)
+        :return: InputInventory of the current state of root, empty if root does not exist
+        """
+        now = time.time_ns()
+        directories = {}
+        pending = [self.root]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            known = self._directories.get(dir_path)
+            if known is None or known[0] != mtime or known[1] - mtime < RACY_NS:
+                sub_directories, entries = scan_directory(dir_path)
+                known = (mtime, now, sub_directories, entries)
+            else:
+                for entry in known[3]:
+                    if entry.path in restat:
+                        try:
+                            stat = os.stat(entry.path)
+                            entry.size, entry.mtime = stat.st_size, stat.st_mtime_ns
+                        except FileNotFoundError:
+                            pass  # its directory's mtime changes too, it is dropped on the next listing
+            directories[dir_path] = known
+            pending.extend(known[2])
+
+        self._directories = directories
+        return InputInventory(self.root, [entry for dir_path in sorted(directories)
+                                          for entry in directories[dir_path][3]])
+
+
+def append_to_txt_files(txt_dir, names, splits, memberships, labels):
+    """
+    appends new names to the ImageSets/Main split lists and the per-class lists
+    :param txt_dir: ImageSets/Main directory
+    :param names: list of new image names
+    :param splits: split of each name
+    :param memberships: list of per-label flags of each name (1 present, 0 only difficult, -1 not present)
+    :param labels: class names of the per-class lists
+    """
+    for split_name, split_values in TXT_SPLITS:
+        rows = [row for row, split in enumerate(splits) if split in split_values]
+        if not rows:
+            continue
+
+        lists = [(f'{split_name}.txt', ''.join(f'{names[row]}\n' for row in rows))]
+        lists.extend((f'{label}_{split_name}.txt', ''.join(f'{names[row]} {memberships[row][column]:2d}\n'
+                                                           for row in rows))
+                     for column, label in enumerate(labels))
+        for file_name, text in lists:
+            txt_path = os.path.join(txt_dir, file_name)
+            try:
+                with atomic_write(txt_path, 'a') as file:
+                    file.write(text)
+            except IOError as e:
+                raise IOError(f'error appending to {txt_path}: {e}') from e
+
+
+class WatchDaemon:
+    """
+    polls the input directories and processes new arrivals in batches, see the module docstring
+    input images are picked up together with their xml file, so an image waits until its annotation is exported
+    negatives already generated are not generated again when they change, only new negatives are
+    """
+
+    def __init__(self, input_dir, negatives_dir, negative_output_dir, negative_xml_template, jpg_dir,
+                 annotations_dir, txt_dir, manifest_path, negatives_manifest_path, labels, name_allocator=None,
+                 split_percentage=20, seed=0, interval=10, workers=1, io_threads=1, link_mode='copy',
+                 jpeg_options=None, max_side=None):
+        """
+        :param input_dir: Dark Label export directory (input/)
+        :param negatives_dir: negative images directory (negativesInput/)
+        :param negative_output_dir: directory negatives are generated in before injection (negativeDataSet/)
+        :param negative_xml_template: negative xml template
+        :param jpg_dir: output JPEGImages directory
+        :param annotations_dir: output Annotations directory
+        :param txt_dir: output ImageSets/Main directory
+        :param manifest_path: incremental build manifest of input_dir
+        :param negatives_manifest_path: manifest of the negatives generated from negatives_dir
+        :param labels: class names (labels.txt) to count and write per-class lists for
+        :param name_allocator: optional NameAllocator for new names
+        :param split_percentage: split percentage for test and validation sets
+        :param seed: split seed
+        :param interval: seconds between polls, a file is also taken as complete once unchanged for this long
+        :param workers: number of worker processes for png conversion
+        :param io_threads: number of files to copy concurrently
+        :param link_mode: how images are placed in the output, one of LINK_MODES
+        :param jpeg_options: PIL save arguments for converted jpgs, see get_jpeg_save_options
+        :param max_side: optional maximum length of the longest side of converted jpgs
+        """
+        self.input_dir = input_dir
+        self.negatives_dir = negatives_dir
+        self.negative_output_dir = negative_output_dir
+        self.negative_xml_template = negative_xml_template
+        self.jpg_dir = jpg_dir
+        self.annotations_dir = annotations_dir
+        self.txt_dir = txt_dir
+        self.manifest_path = manifest_path
+        self.negatives_manifest_path = negatives_manifest_path
+        self.labels = [label for label in labels if label]
+        self.name_allocator = name_allocator
+        self.split_percentage = split_percentage
+        self.seed = seed
+        self.interval = interval
+        self.workers = workers
+        self.io_threads = io_threads
+        self.link_mode = link_mode
+        self.jpeg_options = jpeg_options
+        self.max_side = max_side
+
+        self.manifest = load_manifest(manifest_path)
+        self.negatives_manifest = load_manifest(negatives_manifest_path)
+        self.input_poller = DirectoryPoller(input_dir)
+        self.negatives_poller = DirectoryPoller(negatives_dir)
+        self.label_counts = None
+        self.images_per_class = None
+        self.stratum_counts = None
+        self._versions = {}
+        self._done = {}
+        self._unsettled = set()
+        self.stale_marker_path = os.path.join(os.path.dirname(manifest_path), STALE_LISTS_MARKER)
+        # left by a watcher stopped between saving a manifest and writing the lists
+        self._lists_stale = os.path.exists(self.stale_marker_path)
+
+    def _set_lists_stale(self, stale):
+        """
+        records on disk whether the manifests have images the lists are missing, before the manifests are saved
+        and after the lists are written, so a stop in between is replayed on the next start
+        """
+        try:
+            if stale:
+                with atomic_write(self.stale_marker_path):
+                    pass
+            elif os.path.exists(self.stale_marker_path):
+                os.remove(self.stale_marker_path)
+        except IOError as e:
+            raise IOError(f'error updating {self.stale_marker_path}: {e}') from e
+        self._lists_stale = stale
+
+    def _ready(self, inventory, extensions, manifest, require_annotation):
+        """
+        :return: list of (entry, version) of new or changed files that have stopped changing, their annotations
+        included. they are only marked done once they have been processed, see _mark_done
+        """
+        now = time.time_ns()
+        settle_ns = int(self.interval * 10 ** 9)
+        ready = []
+        for entry in inventory.files(extensions):
+            annotation = entry.annotation
+            if require_annotation and annotation is None:
+                continue
+
+            version = (entry.size, entry.mtime) + ((annotation.size, annotation.mtime) if annotation else ())
+            if self._done.get(entry.path) == version:
+                continue
+
+            previous = self._versions.get(entry.path)
+            self._versions[entry.path] = version
+            newest = max(entry.mtime, annotation.mtime if annotation else 0)
+            if previous != version and now - newest < settle_ns:
+                self._unsettled.add(entry.path)
+                if annotation is not None:
+                    self._unsettled.add(annotation.path)
+                continue
+
+            key = get_manifest_key(entry.path, inventory.root)
+            if is_unchanged_in_manifest(manifest, key, entry.path, entry) and \
+                    (annotation is None or is_unchanged_in_manifest(manifest, get_manifest_key(
+                        annotation.path, inventory.root), annotation.path, annotation)):
+                self._done[entry.path] = version
+                continue
+            ready.append((entry, version))
+        return ready
+
+    def _mark_done(self, ready, manifest, root):
+        """
+        marks the files the manifest now has, as they were when they were polled, as done
+        the others failed or changed while they were processed and are tried again on the next poll
+        :param ready: list of (entry, version) returned by _ready
+        :param manifest: manifest the files are recorded in once processed
+        :param root: directory the manifest keys are relative to
+        :return: number of files that are tried again
+        """
+        retried = 0
+        for entry, version in ready:
+            recorded = [manifest['files'].get(get_manifest_key(item.path, root))
+                        for item in (entry, entry.annotation) if item is not None]
+            if all(item is not None for item in recorded) and \
+                    tuple(value for item in recorded for value in (item['size'], item['mtime'])) == version:
+                self._done[entry.path] = version
+            else:
+                retried += 1
+        return retried
+
+    def _existing_names(self, input_inventory):
+        names = {entry['voc_name'] for entry in self.manifest['files'].values()}
+        names.update(entry['voc_name'] for entry in self.negatives_manifest['files'].values())
+        names.update(entry.stem for entry in input_inventory.files(JPEG_EXTENSIONS))
+        return names
+
+    def process_inputs(self, entries, existing_names):
+        """
+        collects and converts a batch of input images
+        files that fail are left out of the manifest, see _mark_done
+        :return: tuple of (names of images new to the output, True if images already in the output changed)
+        """
+        keys = [get_manifest_key(entry.path, self.input_dir) for entry in entries]
+        known = {key for key in keys if key in self.manifest['files']}
+        batch = InputInventory(self.input_dir, entries)
+        try:
+            collect_current_data_set(self.input_dir, self.jpg_dir, self.annotations_dir, manifest=self.manifest,
+                                     link_mode=self.link_mode, io_threads=self.io_threads, inventory=batch)
+        except IOError as e:
+            # the files that were collected are in the manifest, the batch carries on with the pngs
+            print(f'error collecting new files: {e}')
+        try:
+            failures = prepare_voc(self.input_dir, self.jpg_dir, self.annotations_dir, existing_names,
+                                   workers=self.workers, manifest=self.manifest, jpeg_options=self.jpeg_options,
+                                   max_side=self.max_side, name_allocator=self.name_allocator, inventory=batch)
+        finally:
+            save_manifest(self.manifest_path, self.manifest)
+        if failures:
+            print(f'..{len(failures)} pngs failed, they are retried on the next poll')
+
+        new_names = [self.manifest['files'][key]['voc_name'] for key in keys
+                     if key not in known and key in self.manifest['files']]
+        return new_names, bool(known)
+
+    def process_negatives(self, entries, existing_names):
+        """
+        generates and injects a batch of new negatives
+        :return: names of the negatives injected
+        """
+        new_entries = [entry for entry in entries
+                       if get_manifest_key(entry.path, self.negatives_dir) not in self.negatives_manifest['files']]
+        if not new_entries:
+            return []
+
+        generated = generate_negative_data_set(existing_names, self.negatives_dir, self.negative_output_dir,
+                                               self.negative_xml_template, link_mode=self.link_mode,
+                                               name_allocator=self.name_allocator,
+                                               inventory=InputInventory(self.negatives_dir, new_entries))
+
+        xml_link_mode = 'move' if self.link_mode == 'move' else 'copy'
+        tasks = []
+        for _, name, image_name in generated:
+            tasks.append((os.path.join(self.negative_output_dir, image_name), os.path.join(self.jpg_dir, image_name),
+                          self.link_mode))
+            tasks.append((os.path.join(self.negative_output_dir, f'{name}.xml'),
+                          os.path.join(self.annotations_dir, f'{name}.xml'), xml_link_mode))
+        errors = run_io_tasks(transfer_file, tasks, threads=self.io_threads, total=len(tasks))
+        failed = {task[0] for task, _ in errors}
+
+        for image_path, name, image_name in generated:
+            if os.path.join(self.negative_output_dir, image_name) in failed or \
+                    os.path.join(self.negative_output_dir, f'{name}.xml') in failed:
+                continue  # left out of the manifest, so it is generated again on the next poll
+            if os.path.exists(image_path):  # moved away with link mode move, it is never seen again
+                update_manifest_entry(self.negatives_manifest, get_manifest_key(image_path, self.negatives_dir),
+                                      image_path, name)
+        save_manifest(self.negatives_manifest_path, self.negatives_manifest)
+        raise_io_errors(errors, f'injecting negatives into {self.jpg_dir} and {self.annotations_dir}')
+
+        # jpeg negatives keep their extension, like inject_negative_data_set the lists only take .jpg images
+        return [name for _, name, image_name in generated if image_name.endswith(LISTED_IMAGE_EXTENSION)]
+
+    def rebuild_lists(self):
+        """
+        regenerates ImageSets/Main and recounts the labels from the annotation cache
+        """
+        generate_txt_files(self.jpg_dir, self.txt_dir, self.split_percentage, annotations_dir=self.annotations_dir,
+                           seed=self.seed, labels=self.labels)
+        self.load_counts()
+
+    def load_counts(self):
+        """
+        counts the labels, the images of every class and the listed images of every stratum (rarest class),
+        which are then kept up to date as images are appended
+        """
+        annotation_cache = AnnotationCache.open(self.annotations_dir)
+        self.label_counts = annotation_cache.label_counts(self.labels)
+        class_names = annotation_cache.class_names
+        self.images_per_class = dict(zip(class_names, annotation_cache.images_per_class().tolist()))
+
+        listed = read_listed_splits(self.txt_dir)
+        self.stratum_counts = {}
+        for stem, class_id in zip(annotation_cache.image_stems().tolist(),
+                                  annotation_cache.rarest_class_per_image().tolist()):
+            if stem in listed:
+                stratum = class_names[class_id] if class_id >= 0 else ''
+                self.stratum_counts.setdefault(stratum, np.zeros(3, dtype=np.int64))[listed[stem]] += 1
+
+    def assign_splits(self, names, image_classes):
+        """
+        splits new images the way generate_txt_files splits the new names of each stratum
+        :param names: new image names
+        :param image_classes: set of class names in each image
+        :return: list with the split of each name
+        """
+        for classes in image_classes:
+            for class_name in classes:
+                self.images_per_class[class_name] = self.images_per_class.get(class_name, 0) + 1
+
+        members_of_stratum = {}
+        for index, classes in enumerate(image_classes):
+            members_of_stratum.setdefault(get_rarest_class(classes, self.images_per_class), []).append(index)
+
+        splits = [None] * len(names)
+        for stratum, members in members_of_stratum.items():
+            listed_counts = self.stratum_counts.setdefault(stratum, np.zeros(3, dtype=np.int64))
+            member_splits = split_stratum([get_split_position(names[index], self.seed) for index in members],
+                                          listed_counts, int(listed_counts.sum()) + len(members),
+                                          self.split_percentage)
+            listed_counts += np.bincount(member_splits, minlength=3)
+            for index, split in zip(members, member_splits.tolist()):
+                splits[index] = split
+        return splits
+
+    def append_names(self, names):
+        """
+        appends new images to ImageSets/Main and adds their objects to the label counts
+        """
+        class_map = {label: column for column, label in enumerate(self.labels)}
+        image_classes = []
+        memberships = []
+        for name in names:
+            class_ids = dict(class_map)
+            record = parse_annotation(os.path.join(self.annotations_dir, f'{name}.xml'), class_ids)
+            class_names = {class_id: class_name for class_name, class_id in class_ids.items()}
+            flags = [-1] * len(self.labels)
+            for obj in record.objects:
+                if 0 <= obj.class_id < len(self.labels):
+                    self.label_counts[self.labels[obj.class_id]] += 1
+                    flags[obj.class_id] = max(flags[obj.class_id], 0 if obj.difficult else 1)
+            image_classes.append({class_names[obj.class_id] for obj in record.objects if obj.class_id >= 0})
+            memberships.append(flags)
+        splits = self.assign_splits(names, image_classes)
+
+        append_to_txt_files(self.txt_dir, names, splits, memberships, self.labels)
+        print(f'..{len(names)} images added to {self.txt_dir}')
+
+    def poll_once(self):
+        """
+        polls both directories and processes whatever has arrived
+        :return: number of new images added to the data set
+        """
+        restat, self._unsettled = self._unsettled, set()
+        input_inventory = self.input_poller.poll(restat)
+        negatives_inventory = self.negatives_poller.poll(restat)
+        inputs = self._ready(input_inventory, JPEG_EXTENSIONS + PNG_EXTENSIONS, self.manifest, True)
+        negatives = self._ready(negatives_inventory, JPEG_EXTENSIONS, self.negatives_manifest, False)
+        if not inputs and not negatives and not self._lists_stale:
+            return 0
+
+        if self.label_counts is None:
+            # counted once, before the first batch, and kept up to date from then on
+            self.load_counts()
+
+        print(f'{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {len(inputs)} new files in {self.input_dir}, '
+              f'{len(negatives)} in {self.negatives_dir}')
+        existing_names = self._existing_names(input_inventory)
+        new_names = []
+        changed = self._lists_stale
+        # a batch that fails or is interrupted part way is in the manifests but not in the lists,
+        # the next poll (or the next start) rebuilds them
+        self._set_lists_stale(True)
+        if inputs:
+            names, inputs_changed = self.process_inputs([entry for entry, _ in inputs], existing_names)
+            new_names.extend(names)
+            existing_names.update(names)
+            changed = changed or inputs_changed
+        if negatives:
+            new_names.extend(self.process_negatives([entry for entry, _ in negatives], existing_names))
+
+        if changed or not os.path.exists(os.path.join(self.txt_dir, 'train.txt')):
+            # images already listed changed, their split and class flags are rebuilt from scratch
+            self.rebuild_lists()
+        elif new_names:
+            self.append_names(new_names)
+        self._set_lists_stale(False)
+
+        retried = self._mark_done(inputs, self.manifest, self.input_dir) + \
+            self._mark_done(negatives, self.negatives_manifest, self.negatives_dir)
+        if retried:
+            print(f'..{retried} files are tried again on the next poll')
+        print(self.label_counts)
+        return len(new_names)
+
+    def run(self, max_polls=None):
+        """
+        polls every interval seconds until interrupted
+        :param max_polls: optional number of polls to stop after
+        """
+        print(f'Watching {self.input_dir} and {self.negatives_dir} every {self.interval}s, press Ctrl+C to stop')
+
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                started = time.monotonic()
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    # nothing of a failed batch is marked done, its files are retried on the next poll
+                    print(f'error processing new files: {e}')
+                    traceback.print_tb(e.__traceback__)
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            print('Stopped watching')